@@ -0,0 +1,48 @@
+"""
+In-memory registry of verified Telegram users.
+
+The set is loaded once from storage and answers membership checks without
+I/O. It reloads when the backend reports a new version (file mtime or SQLite
+data version), checked at most every VERIFIED_POLL_INTERVAL seconds, so
+several bot workers sharing a volume see each other's verifications.
+"""
+import os
+import time
+import threading
+import metrics
+
+VERIFIED_POLL_INTERVAL = float(os.environ.get("VERIFIED_POLL_INTERVAL", "2"))
+
+class VerifiedUsers:
+
+    def __init__(self, storage):
+        self.storage = storage
+        self._lock = threading.Lock()
+        self._users = frozenset()
+        self._version = None
+        self._checked = 0.0
+        self._reload()
+
+    def _reload(self):
+        version = self.storage.verified_users_version()
+        users = frozenset(self.storage.read_verified_users())
+        with self._lock:
+            self._users, self._version = users, version
+            self._checked = time.time()
+        metrics.incr("auth.reloads")
+
+    def _poll(self):
+        if time.time() - self._checked < VERIFIED_POLL_INTERVAL:
+            return
+        self._checked = time.time()
+        if self.storage.verified_users_version() != self._version:
+            self._reload()
+
+    def __contains__(self, user_id) -> bool:
+        self._poll()
+        return user_id in self._users
+
+    def add(self, user_id):
+        """Persist a verification and publish it to this process at once."""
+        self.storage.add_verified_user(user_id)
+        self._reload()
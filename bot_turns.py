@@ -0,0 +1,181 @@
+"""
+Telegram turn pipeline, independent of where the Telegram client lives.
+
+`client` is anything with `send_message(chat_id, text, parse_mode=...)`
+returning a message with `edit(text)`: the Telethon client in single-process
+mode, or a bot_worker.RemoteClient that forwards through the ingress when
+turns run in worker processes. A turn is a plain dict built by turn_input()
+({"user", "chat", "text", "photo"}), so it can cross a process boundary.
+"""
+import time
+import asyncio
+from llm import llm
+from hist import read_history, write_history, clear_history
+import image_store
+import image_prep
+from history_format import assistant_message
+from profile_jobs import schedule_profile_update
+from compaction import schedule_compaction
+from tools.tools_description import tool_msg_beautify
+from tools.general_utils import get_current_time
+from telegram_render import StreamRenderer
+from turn_queue import TurnScheduler
+
+# In-flight turns per sender, so /cancel can abandon a running request
+ACTIVE_TURNS: dict[int, asyncio.Task] = {}
+
+async def turn_input(event, sender_id) -> dict:
+    """Everything a turn needs from a Telegram event; photos are downloaded into memory."""
+    request = event.raw_text
+    # if you use @bot_name as a trigger, remove it before processing the request
+    # request = request.removeprefix('@bot_name')
+    photo_message = None
+    if event.is_reply:
+        reply = await event.get_reply_message()
+        if reply.photo:
+            photo_message = reply
+        else:
+            request = request + reply.raw_text
+    elif event.photo:
+        photo_message = event
+
+    photo = await photo_message.download_media(file=bytes) if photo_message else None
+    return {"user": sender_id, "chat": event.chat_id, "text": request, "photo": photo}
+
+async def store_photo(data: bytes) -> tuple[str, str]:
+    """Preprocess and store downloaded photo bytes. Returns (reference, detail)."""
+    try:
+        data, detail = await image_prep.prepare(data)
+    except Exception as e:
+        raise Exception(f"Failed to convert image: {str(e)}")
+    # The content-addressed blob is the only copy on disk
+    return await asyncio.to_thread(image_store.put_bytes, data), detail
+
+async def submit_turn(client, turn: dict, done=None):
+    """Queue a turn behind the chat's earlier ones; `done()` is called once it ran or was dropped."""
+    status = asyncio.get_running_loop().create_future()
+    position = turns.submit(turn["user"], client, turn, status, done)
+    message = None
+    try:
+        if position:
+            message = await client.send_message(turn["chat"], f"⏳ Queued (position {position})", parse_mode="md")
+    finally:
+        status.set_result(message)
+
+async def cancel_turn(client, user_id, chat_id):
+    task = ACTIVE_TURNS.get(user_id)
+
+    # Queued turns are dropped too, so nothing starts after the cancel
+    dropped = turns.drop(user_id)
+    for _, _, status, done in dropped:
+        if done is not None:
+            done()
+        if status.done() and status.result() is not None:
+            try:
+                await status.result().edit("🛑 Cancelled.")
+            except Exception:
+                pass  # Ignore edit failures
+
+    if task is not None and not task.done():
+        # Propagates into llm() and the tool executor, which stop running tools
+        task.cancel()
+        text = "Request cancelled."
+    elif dropped:
+        text = "Request cancelled."
+    else:
+        text = "Nothing to cancel."
+    await client.send_message(chat_id, text, parse_mode="md")
+
+async def empty_history(client, user_id, chat_id):
+    clear_history(user_id, user_id)
+    text = "Your chat history has been cleared. You can start a new conversation now."
+    await client.send_message(chat_id, text, parse_mode="md")
+
+async def run_turn(client, turn: dict, status, done=None):
+    SENDER = turn["user"]
+    CHAT_ID = turn["chat"]
+    try:
+        photo = None
+        detail = "auto"
+        hist = read_history(SENDER, SENDER)
+
+        request = turn["text"]
+        print(request)
+
+        ACTIVE_TURNS[SENDER] = asyncio.current_task()
+
+        # Reuse the "queued" status message when the turn had to wait
+        session = await status
+        if session is not None:
+            await session.edit("Thinking ...")
+        else:
+            session = await client.send_message(CHAT_ID, "Thinking ...", parse_mode="md")
+        if turn["photo"] is not None:
+            photo, detail = await store_photo(turn["photo"])
+            user_message = {
+                "role": "user",
+                "content": [
+                    {"type": "input_text", "text": request},
+                    {"type": "input_image",
+                        "image_url": photo,
+                        "detail": detail,
+                    }
+                ],
+            }
+        else:
+            user_message = {
+                "role": "user",
+                "content": request
+            }
+
+        start = time.time()
+        stream, tools = await llm(request, SENDER, hist, photo, chat_id=SENDER, photo_detail=detail)
+        end = time.time()
+
+        print("---")
+        print(f"Starting Response takes {end-start}s")
+        print("---")
+
+        # Immediately update message to show streaming has started
+        try:
+            await session.edit("💬 ")
+        except Exception:
+            pass  # Ignore edit failures
+
+        answer = ""
+        renderer = StreamRenderer(client, CHAT_ID, session)
+        try:
+            async for event in stream:
+                if event.type == "response.output_text.delta":
+                    delta = event.delta or ""
+                    answer += delta
+                    renderer.append(delta)
+        except BaseException:
+            renderer.cancel()
+            raise
+
+        footer = "\n\n" + f"🔌 Module Used: {tool_msg_beautify(tools)}" if tools else ""
+        response = await renderer.finish(footer)
+        hist.extend([
+            user_message,
+            assistant_message(answer, display=f"Time:{get_current_time()} \n {response}"),
+        ])
+
+        await asyncio.to_thread(write_history, SENDER, SENDER, hist)
+
+        # Merge this turn into the user profile and fold old messages into the chat summary in the background
+        schedule_profile_update(SENDER, hist[-2:])
+        schedule_compaction(SENDER, SENDER)
+
+    except asyncio.CancelledError:
+        await client.send_message(CHAT_ID, "🛑 Cancelled.", parse_mode="md")
+    except Exception as e:
+        await client.send_message(CHAT_ID, f"Sorry, error: {str(e)}", parse_mode="md")
+    finally:
+        if ACTIVE_TURNS.get(SENDER) is asyncio.current_task():
+            ACTIVE_TURNS.pop(SENDER, None)
+        if done is not None:
+            done()
+
+# Per-chat FIFO of turns drained by TURN_WORKERS workers (see turn_queue.py)
+turns = TurnScheduler(run_turn)
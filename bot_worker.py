@@ -0,0 +1,101 @@
+"""
+Worker process of the multi-process Telegram bot (see ingress.py).
+
+Connects to the ingress on BOT_SOCKET, takes the slot it is given and runs
+the turns of that slot's chats with the usual pipeline (bot_turns). Telegram
+messages are sent and edited through the ingress. The worker exits when the
+link closes, so its history cache is flushed and a restarted worker starts
+clean. Start as many as BOT_WORKERS; extras stand by.
+
+    python bot_worker.py
+"""
+import sys
+import signal
+import asyncio
+import itertools
+from telethon.errors import FloodWaitError
+import bot_turns
+from ingress import BOT_SOCKET, LINK_LIMIT, encode, read_message, unpack_turn
+
+CONNECT_RETRY_SECONDS = 2
+
+class RemoteMessage:
+
+    def __init__(self, client, chat_id, message_id):
+        self.client = client
+        self.chat_id = chat_id
+        self.id = message_id
+
+    async def edit(self, text):
+        await self.client.call("edit", chat=self.chat_id, message=self.id, text=text)
+
+class RemoteClient:
+    """The part of TelegramClient that bot_turns uses, executed by the ingress."""
+
+    def __init__(self, writer):
+        self._writer = writer
+        self._calls: dict = {}
+        self._ids = itertools.count(1)
+
+    async def call(self, method: str, **params):
+        call_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._calls[call_id] = future
+        self._writer.write(encode({"op": "call", "id": call_id, "method": method, **params}))
+        try:
+            await self._writer.drain()
+            reply = await future
+        finally:
+            self._calls.pop(call_id, None)
+        if "flood" in reply:
+            raise FloodWaitError(request=None, capture=reply["flood"])
+        if "error" in reply:
+            raise Exception(reply["error"])
+        return reply.get("result")
+
+    def resolve(self, reply: dict):
+        future = self._calls.get(reply["id"])
+        if future is not None and not future.done():
+            future.set_result(reply)
+
+    async def send_message(self, chat_id, text, parse_mode="md"):
+        return RemoteMessage(self, chat_id, await self.call("send", chat=chat_id, text=text))
+
+async def connect():
+    while True:
+        try:
+            return await asyncio.open_unix_connection(BOT_SOCKET, limit=LINK_LIMIT)
+        except (FileNotFoundError, ConnectionError):
+            print(f"Waiting for the ingress on {BOT_SOCKET} ...")
+            await asyncio.sleep(CONNECT_RETRY_SECONDS)
+
+async def main():
+    reader, writer = await connect()
+    client = RemoteClient(writer)
+
+    def done(turn_id):
+        if not writer.is_closing():
+            writer.write(encode({"op": "done", "id": turn_id}))
+
+    while (message := await read_message(reader)) is not None:
+        op = message["op"]
+        if op == "reply":
+            client.resolve(message)
+        elif op == "turn":
+            # Tasks start in creation order, so turns reach the chat queue in order
+            turn = unpack_turn(message["turn"])
+            asyncio.create_task(bot_turns.submit_turn(client, turn, done=lambda turn_id=message["id"]: done(turn_id)))
+        elif op == "cancel":
+            asyncio.create_task(bot_turns.cancel_turn(client, message["user"], message["chat"]))
+        elif op == "empty":
+            asyncio.create_task(bot_turns.empty_history(client, message["user"], message["chat"]))
+        elif op == "hello":
+            print(f"Worker Started! Slot {message['slot']}/{message['slots']}")
+        elif op == "standby":
+            print("All slots are taken, standing by.")
+    print("Ingress closed the link, exiting.")
+
+if __name__ == '__main__':
+    # Exit through SystemExit on `docker stop` so pending history writes are flushed
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    asyncio.run(main())
@@ -0,0 +1,100 @@
+"""
+Rolling compaction of long chats.
+
+Messages older than the live window (hist.TOTAL_HIST_LIMIT) are folded, one
+chunk at a time, into a running summary per chat. Every chunk is
+checkpointed with the number of messages the summary covers and a hash of
+the last one, so an interrupted run resumes from the last checkpoint on the
+next turn and an edited or recreated chat starts over. hist.summary_context
+injects the summary as one system message, so the context stays the same
+size however long the thread gets.
+"""
+import os
+import time
+import asyncio
+import metrics
+from storage import get_storage
+from hist import TOTAL_HIST_LIMIT, _history_view, _record_hash
+from profile_jobs import run_in_background
+
+COMPACT_MIN_MESSAGES = int(os.environ.get("HIST_COMPACT_MIN", "20"))  # fold once this many messages left the window
+COMPACT_CHUNK_MESSAGES = 40      # messages folded per summarization call
+SUMMARY_MODEL = "gpt-5-nano"
+SUMMARY_CHAR_LIMIT = 3000
+MESSAGE_CHAR_LIMIT = 1500
+
+_running: set = set()   # touched on the worker loop only
+
+def schedule_compaction(user_id, chat_id):
+    """Fold the chat's older messages into its summary in the background (non-blocking)."""
+    run_in_background(compact_chat, user_id, chat_id)
+
+def _summary_prompt(summary: str, records: list, first: int) -> str:
+    lines = []
+    for n, record in enumerate(records, start=first):
+        text = record.text
+        if len(text) > MESSAGE_CHAR_LIMIT:
+            text = text[:MESSAGE_CHAR_LIMIT] + "..."
+        lines.append(f"{n}. {record.role}: {text}")
+    return f"""
+You maintain a running summary of a long conversation between a user and an AI assistant.
+Current summary of the earlier messages:
+{summary or "(empty)"}
+
+Fold the later messages below into the summary. Keep facts, decisions, names, numbers, preferences and open questions the assistant may need later; drop greetings and filler. Use short plain bullets in the language of the conversation, at most {SUMMARY_CHAR_LIMIT} characters. Return only the updated summary.
+
+Messages:
+{chr(10).join(lines)}
+"""
+
+def _next_chunk(total: int, covered: int) -> int:
+    """End of the next chunk to fold, or 0 if not enough messages left the window."""
+    foldable = total - TOTAL_HIST_LIMIT - covered
+    if foldable < COMPACT_MIN_MESSAGES:
+        return 0
+    end = covered + min(foldable, COMPACT_CHUNK_MESSAGES)
+    # Never split a (user, assistant) pair
+    return end - (end - covered) % 2
+
+async def compact_chat(user_id, chat_id, client=None):
+    key = (str(user_id), str(chat_id))
+    if key in _running:
+        metrics.incr("compaction.coalesced")
+        return
+    _running.add(key)
+    storage = get_storage()
+    try:
+        while True:
+            records = _history_view(await asyncio.to_thread(storage.read_messages, user_id, chat_id))
+            summary = await asyncio.to_thread(storage.load_summary, user_id, chat_id)
+            covered = summary.get("covered", 0)
+            if covered and (covered > len(records) or summary.get("covered_hash") != _record_hash(records[covered - 1])):
+                # Chat was edited or recreated: start over
+                summary, covered = {}, 0
+            end = _next_chunk(len(records), covered)
+            if not end:
+                return
+
+            start = time.time()
+            response = await client.responses.create(
+                model=SUMMARY_MODEL,
+                reasoning={"effort": "low"},
+                text={"verbosity": "low"},
+                input=[{"role": "user", "content": _summary_prompt(summary.get("summary", ""), records[covered:end], covered + 1)}],
+            )
+            text = response.output_text.strip()[:SUMMARY_CHAR_LIMIT]
+            if not text:
+                return
+            await asyncio.to_thread(storage.save_summary, user_id, chat_id, {
+                "summary": text,
+                "covered": end,
+                "covered_hash": _record_hash(records[end - 1]),
+                "updated": time.time(),
+            })
+            metrics.incr("compaction.chunks")
+            metrics.observe("compaction.latency", time.time() - start)
+            print(f"🗜️ Compacted {user_id}/{chat_id}: messages 1-{end} summarized ({len(text)} chars) | Cost: {round(time.time()-start,2)}s")
+    except Exception as e:
+        print(f"⚠️ Compaction failed for {user_id}/{chat_id} ({str(e)})")
+    finally:
+        _running.discard(key)
@@ -0,0 +1,169 @@
+"""
+Token-budgeted request context.
+
+Counts tokens locally (tiktoken when installed, otherwise a character
+heuristic; images by detail level) and fills the model's budget in priority
+order: current message, short-term pairs (newest first), profile and chat
+summary, relevant long-term pairs, recent-conversation preview lines.
+History items over ITEM_TOKEN_LIMIT are truncated in the middle. Every build
+logs what was dropped and the final token count.
+"""
+import os
+import re
+import metrics
+from router import MODEL_NANO, MODEL_MINI, MODEL_STANDARD
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("o200k_base")
+except Exception:
+    _encoding = None
+
+CONTEXT_BUDGETS = {
+    MODEL_NANO: 8000,
+    MODEL_MINI: 16000,
+    MODEL_STANDARD: 32000,
+}
+# Overrides the per-model budgets when set
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "0"))
+ITEM_TOKEN_LIMIT = int(os.environ.get("CONTEXT_ITEM_TOKEN_LIMIT", "2000"))
+MESSAGE_OVERHEAD = 4
+IMAGE_TOKENS = {"low": 85, "high": 765, "auto": 765}
+
+_WIDE = re.compile(r"[　-鿿가-힯＀-￯]")
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    # ~4 chars per token for Latin text, ~1 token per CJK character
+    wide = len(_WIDE.findall(text))
+    return wide + (len(text) - wide) // 4 + 1
+
+def _image_tokens(item: dict) -> int:
+    return IMAGE_TOKENS.get(item.get("detail", "auto"), IMAGE_TOKENS["auto"])
+
+def message_tokens(message) -> int:
+    if not isinstance(message, dict):
+        # Reasoning / tool call items from earlier rounds
+        return MESSAGE_OVERHEAD + count_tokens(str(message))
+    content = message.get("content", message.get("output", ""))
+    if isinstance(content, list):
+        tokens = 0
+        for item in content:
+            if not isinstance(item, dict):
+                continue
+            if item.get("type") == "input_image":
+                tokens += _image_tokens(item)
+            else:
+                tokens += count_tokens(item.get("text", ""))
+        return MESSAGE_OVERHEAD + tokens
+    return MESSAGE_OVERHEAD + count_tokens(str(content))
+
+def _truncate_text(text: str, limit: int) -> str:
+    tokens = count_tokens(text)
+    if tokens <= limit:
+        return text
+    # Character cut proportional to the token overshoot, keeping head and tail
+    keep = max(1, len(text) * limit // tokens)
+    head, tail = keep * 2 // 3, keep // 3
+    return f"{text[:head]}\n…[{tokens - limit} tokens truncated]…\n{text[len(text) - tail:] if tail else ''}"
+
+def _truncate_message(message: dict) -> dict:
+    """`message` itself, or a copy with over-long text parts cut to ITEM_TOKEN_LIMIT."""
+    content = message.get("content")
+    if isinstance(content, str):
+        text = _truncate_text(content, ITEM_TOKEN_LIMIT)
+        return message if text is content else {**message, "content": text}
+    if isinstance(content, list):
+        items = [
+            {**item, "text": _truncate_text(item["text"], ITEM_TOKEN_LIMIT)}
+            if isinstance(item, dict) and item.get("type") == "input_text" and count_tokens(item.get("text", "")) > ITEM_TOKEN_LIMIT
+            else item
+            for item in content
+        ]
+        if any(new is not old for new, old in zip(items, content)):
+            return {**message, "content": items}
+    return message
+
+def _pairs(messages: list) -> list:
+    return [messages[i:i+2] for i in range(0, len(messages), 2)]
+
+def budget_for(model: str) -> int:
+    return CONTEXT_TOKEN_BUDGET or CONTEXT_BUDGETS.get(model, CONTEXT_BUDGETS[MODEL_MINI])
+
+def build_context(model: str, current: list, short_pairs: list, profile: list, long_term: list, recent: list) -> list:
+    """
+    Return the history part of the request input (everything before `current`).
+    Stable parts come first so consecutive requests share a cacheable prefix:
+    profile and summary, short-term pairs, long-term pairs, recent preview.
+    """
+    budget = budget_for(model)
+    used = sum(message_tokens(m) for m in current)
+    dropped = []
+    truncated = 0
+
+    def take(messages: list, label: str) -> list:
+        nonlocal used, truncated
+        fitted = []
+        for message in messages:
+            item = _truncate_message(message)
+            truncated += item is not message
+            fitted.append(item)
+        cost = sum(message_tokens(m) for m in fitted)
+        if used + cost > budget:
+            dropped.append(f"{label} ({cost})")
+            return []
+        used += cost
+        return fitted
+
+    # Newest short-term pair first, the oldest is the first to go; after the
+    # first pair that does not fit, older ones are dropped too (no gaps)
+    kept_short = []
+    short_full = False
+    for pair in reversed(_pairs(short_pairs)):
+        if short_full:
+            dropped.append("short pair (older)")
+            continue
+        kept = take(pair, "short pair")
+        short_full = not kept
+        kept_short.append(kept)
+    kept_profile = [take([m], "profile") for m in profile]
+    kept_long = [take(pair, "long-term pair") for pair in _pairs(long_term)]
+
+    kept_recent = []
+    for message in recent:
+        lines = message["content"].split("\n")
+        header, lines = lines[0], lines[1:]
+        cost = message_tokens({"content": header})
+        if used + cost > budget:
+            dropped.append(f"recent preview ({len(lines)} lines)")
+            continue
+        kept_lines = []
+        for line in reversed(lines):
+            line_cost = count_tokens(line) + 1
+            if used + cost + line_cost > budget:
+                break
+            cost += line_cost
+            kept_lines.append(line)
+        if len(kept_lines) < len(lines):
+            dropped.append(f"recent preview ({len(lines) - len(kept_lines)} lines)")
+        if kept_lines:
+            used += cost
+            kept_recent.append({**message, "content": "\n".join([header] + kept_lines[::-1])})
+
+    context = (
+        [m for kept in kept_profile for m in kept]
+        + [m for kept in reversed(kept_short) for m in kept]
+        + [m for kept in kept_long for m in kept]
+        + kept_recent
+    )
+    metrics.observe("context.tokens", used)
+    if dropped:
+        metrics.incr("context.dropped", len(dropped))
+    print(
+        f"🧮 Context: {used}/{budget} tokens ({model}) | "
+        f"Truncated: {truncated} | Dropped: {', '.join(dropped) if dropped else 'none'}"
+    )
+    return context
@@ -2,11 +2,16 @@
 
 import os
 import json
-import copy
 import time
 import asyncio
-import base64
+import hashlib
+from collections.abc import Sequence
 from openai import AsyncOpenAI
+import retrieval
+import image_store
+from storage import get_storage
+import verdict_cache
+from history_format import MODULE_FOOTER, strip_decorations
 from tools.general_utils import get_current_time
 
 from dotenv import load_dotenv
@@ -22,74 +27,61 @@ RECENT_CHAT_LIMIT = 40  # mirrors how ChatGPT surfaces recent conversation conte
 PROFILE_SOURCE_LIMIT = 80
 PROFILE_MODEL = "gpt-5-nano"
 
+# Long-term memory selection: "index" (local BM25 top-k), "llm" (one judge call per pair)
+# or "batch" (one numbered judge call per token-budget chunk of pairs)
+HIST_RELEVANCE_MODE = os.environ.get("HIST_RELEVANCE_MODE", "index")
+HIST_EMBEDDINGS = os.environ.get("HIST_EMBEDDINGS") == "1"  # blend embeddings into the index score
+HIST_RERANK = os.environ.get("HIST_RERANK") == "1"          # LLM judge re-ranks the top candidates
+LONG_TERM_TOP_K = 3
+RERANK_CANDIDATES = 5
+BATCH_SELECT_TOKEN_BUDGET = 6000  # estimated prompt tokens per batched judge call
+BATCH_PAIR_CHAR_LIMIT = 600       # each pair is clipped to this many chars in the numbered prompt
+
 # Profile limits matching ChatGPT's architecture
 MAX_RESPONSE_PREFERENCES = 15
 MAX_TOPIC_HIGHLIGHTS = 8
 MAX_USER_INSIGHTS = 5
 
-def read_history(user_id: str, chat_id: str = None) -> list:
+def read_history(user_id: str, chat_id: str = None, last_n: int = None) -> list:
     if chat_id is None:
         chat_id = user_id
-    # Ensure history directory exists
-    if not os.path.exists("history"):
-        os.makedirs("history", exist_ok=True)
-    fn = f"history/{user_id}/hist_{chat_id}.json"
-    if not os.path.exists(fn):
-        init_chat = []
-        with open(fn,"w") as f: json.dump(init_chat,f)
-    with open(fn) as f:
-        return json.load(f)
+    return get_storage().read_messages(user_id, chat_id, last_n)
 
 def write_history(user_id: str, chat_id: str = None, hist: list = None):
+    """Blocking (storage write and index update), run it via asyncio.to_thread from async code."""
     if chat_id is None:
         chat_id = user_id
     if hist is None:
         hist = []
-    # Ensure history directory exists
-    if not os.path.exists(f"history/{user_id}"):
-        os.makedirs(f"history/{user_id}", exist_ok=True)
-    with open(f"history/{user_id}/hist_{chat_id}.json","w") as f:
-        json.dump(hist,f,indent=2,ensure_ascii=False)
-
-def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8") 
+    # Appends only the messages added since the last write
+    get_storage().write_messages(user_id, chat_id, hist)
+    try:
+        retrieval.update_index(user_id, chat_id, _pair_texts(_history_view(hist)))
+    except Exception as e:
+        # The index is rebuilt lazily by hist_handler, never break the chat flow
+        print(f"⚠️ Failed to update retrieval index ({str(e)})")
 
 def clear_history(user_id: str, chat_id: str = None):
     if chat_id is None:
         chat_id = user_id
-    fn = f"history/{user_id}"
-    if os.path.exists(fn):
-        os.remove(fn)
+    get_storage().delete_messages(user_id, chat_id)
 
-def _ensure_parent_dir(path: str):
-    parent = os.path.dirname(path)
-    if parent and not os.path.exists(parent):
-        os.makedirs(parent, exist_ok=True)
-
-def _load_profile_sections(profile_path: str) -> dict:
-    if not profile_path or not os.path.exists(profile_path):
-        return {}
+def _load_profile_sections(user_id) -> dict:
     try:
-        with open(profile_path) as f:
-            data = json.load(f)
-            return {k: v for k, v in data.items() if k != "meta"}
+        data = get_storage().load_profile(user_id)
+        return {k: v for k, v in data.items() if k != "meta"}
     except Exception:
         return {}
 
 
-def _save_profile_sections(profile_path: str, sections: dict, hist_len: int):
-    if not profile_path:
-        return
+def _save_profile_sections(user_id, sections: dict, hist_len: int):
     try:
-        _ensure_parent_dir(profile_path)
         payload = dict(sections)
         payload["meta"] = {
             "last_updated": time.time(),
             "source_messages": hist_len,
         }
-        with open(profile_path, "w") as f:
-            json.dump(payload, f, indent=2, ensure_ascii=False)
+        get_storage().save_profile(user_id, payload)
     except Exception:
         # Do not break chat flow if persistence fails
         pass
@@ -114,15 +106,99 @@ def _normalize_text_blob(content) -> str:
     return ""
 
 
-def _clean_history_messages(hist: list) -> list:
-    """Strip noisy tool audit text and return a shallow copy of messages."""
-    cleaned = []
-    for item in hist:
-        new_item = dict(item)
-        if isinstance(new_item.get("content"), str):
-            new_item["content"] = new_item["content"].split("🔌 Module Used")[0].strip()
-        cleaned.append(new_item)
-    return cleaned
+class HistoryRecord:
+    """
+    Read-only view of one stored message. Shares the stored dict instead of
+    copying it; the cleaned content and plain text are computed on first use.
+    """
+    __slots__ = ("raw", "_content", "_text")
+
+    def __init__(self, raw: dict):
+        self.raw = raw
+        self._content = _UNSET
+        self._text = None
+
+    @property
+    def role(self):
+        return self.raw.get("role")
+
+    @property
+    def content(self):
+        """Canonical content, i.e. without UI decorations."""
+        if self._content is _UNSET:
+            content = self.raw.get("content")
+            if isinstance(content, str) and "display" not in self.raw:
+                # Written before content/display were split
+                if self.role == "assistant":
+                    content = strip_decorations(content)
+                else:
+                    content = content.split(MODULE_FOOTER)[0].strip()
+            self._content = content
+        return self._content
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = _normalize_text_blob(self.content)
+        return self._text
+
+    def as_dict(self) -> dict:
+        """Cleaned message sharing nested content with the stored one (read-only use)."""
+        message = {k: v for k, v in self.raw.items() if k != "display"}
+        message["content"] = self.content
+        return message
+
+    def to_message(self) -> dict:
+        """Fresh message for the API; content items are copied so image encoding never touches the stored history."""
+        message = self.as_dict()
+        if isinstance(message["content"], list):
+            message["content"] = [dict(item) if isinstance(item, dict) else item for item in message["content"]]
+        return message
+
+_UNSET = object()
+
+
+def _history_view(hist: list) -> list:
+    """Wrap stored messages as HistoryRecords without copying them."""
+    return [HistoryRecord(item) for item in hist]
+
+
+def _record_hash(record: HistoryRecord) -> str:
+    raw = json.dumps(record.as_dict(), sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:12]
+
+
+def _materialize(records: list) -> list:
+    return [record.to_message() for record in records]
+
+
+def _pair_text(record_pair: list) -> str:
+    """Image-free text of a history pair, as indexed and shown to the relevance judge."""
+    return "\n".join(f"{record.role}: {record.text}" for record in record_pair)
+
+
+class _PairTexts(Sequence):
+    """Text of every complete (user, assistant) pair, oldest first, rendered on access."""
+    __slots__ = ("_records",)
+
+    def __init__(self, records: list):
+        self._records = records
+
+    def __len__(self) -> int:
+        return len(self._records) // 2
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return _pair_text(self._records[2*i:2*i+2])
+
+
+def _pair_texts(records: list) -> Sequence:
+    return _PairTexts(records)
 
 
 def _recent_conversation_content(hist: list) -> list:
@@ -138,9 +214,9 @@ def _recent_conversation_content(hist: list) -> list:
     pairs = []
     i = 0
     while i < len(hist):
-        if i < len(hist) and hist[i].get("role") == "user":
+        if hist[i].role == "user":
             user_msg = hist[i]
-            assistant_msg = hist[i+1] if i+1 < len(hist) and hist[i+1].get("role") == "assistant" else None
+            assistant_msg = hist[i+1] if i+1 < len(hist) and hist[i+1].role == "assistant" else None
             pairs.append((user_msg, assistant_msg))
             i += 2
         else:
@@ -152,7 +228,7 @@ def _recent_conversation_content(hist: list) -> list:
 
     recent_lines = []
     for idx, (user_msg, assistant_msg) in enumerate(trimmed_pairs, start=start_idx):
-        user_content = _normalize_text_blob(user_msg.get("content"))
+        user_content = user_msg.text
 
         # Create preview (first 100 chars for compactness)
         preview = user_content[:100]
@@ -165,32 +241,39 @@ def _recent_conversation_content(hist: list) -> list:
     return recent_lines
 
 
-async def _profile_sections_from_history(hist: list) -> dict:
-    """
-    Build lightweight profile sections inspired by ChatGPT's memory architecture:
-    - assistant_response_preferences (with confidence metrics)
-    - notable_topic_highlights (with confidence tags)
-    - helpful_user_insights
-    """
-    user_msgs = [msg for msg in hist if msg.get("role") == "user"]
+def _profile_history_blob(hist: list) -> str:
+    user_msgs = [msg for msg in hist if msg.role == "user"]
     if not user_msgs:
-        return {}
+        return ""
 
     samples = []
     total_chars = 0
     # Take up to PROFILE_SOURCE_LIMIT user turns while keeping payload bounded
     for msg in user_msgs[-PROFILE_SOURCE_LIMIT:]:
-        rendered = _normalize_text_blob(msg.get("content"))
+        rendered = msg.text
         total_chars += len(rendered)
         if total_chars > 4000:
             break
         samples.append(rendered)
 
-    history_blob = "\n".join(samples[-PROFILE_SOURCE_LIMIT:])
-    prompt = f"""
+    return "\n".join(samples[-PROFILE_SOURCE_LIMIT:])
+
+
+def _profile_prompt(history_blob: str, previous_sections: dict = None) -> str:
+    if previous_sections:
+        intro = f"""
 You maintain compact memory sections modeled after ChatGPT's chat history features.
-Analyze the user's recent messages (newest last) and extract:
+Current memory sections (JSON):
+{json.dumps(previous_sections, ensure_ascii=False)}
 
+Merge in what the user's NEW messages below (newest last) add. Keep existing entries that are not contradicted, update confidences, drop entries the new messages contradict, and stay within the limits:
+"""
+    else:
+        intro = """
+You maintain compact memory sections modeled after ChatGPT's chat history features.
+Analyze the user's recent messages (newest last) and extract:
+"""
+    return intro + f"""
 1. assistant_response_preferences: What formatting/style/language preferences did the USER explicitly request for responses? Return as list of objects with "preference" and "confidence" (high/medium/low). Max {MAX_RESPONSE_PREFERENCES} entries.
    Example: {{"preference": "use Chinese for responses", "confidence": "high"}}
    Do NOT include meta-instructions about this JSON format itself.
@@ -207,8 +290,24 @@ User messages:
 {history_blob}
 """
 
+
+async def _profile_sections_from_history(hist: list, previous_sections: dict = None, client=None) -> dict:
+    """
+    Build lightweight profile sections inspired by ChatGPT's memory architecture:
+    - assistant_response_preferences (with confidence metrics)
+    - notable_topic_highlights (with confidence tags)
+    - helpful_user_insights
+
+    With `previous_sections`, `hist` only holds the new messages and the model
+    merges them into the existing profile instead of re-reading the whole chat.
+    """
+    history_blob = _profile_history_blob(hist)
+    if not history_blob:
+        return {}
+    prompt = _profile_prompt(history_blob, previous_sections)
+
     try:
-        response = await openai.responses.create(
+        response = await (client or openai).responses.create(
             model=PROFILE_MODEL,
             reasoning={ "effort": "low" },
             text={"verbosity": "low" },
@@ -219,6 +318,10 @@ User messages:
     except Exception:
         return {}
 
+    return _normalize_profile_sections(data)
+
+
+def _normalize_profile_sections(data: dict) -> dict:
     normalized = {}
 
     # Handle assistant_response_preferences with confidence
@@ -347,21 +450,133 @@ Output ONLY: true or false"""
     content = response.output_text.lower().strip()
     return content in ["true", "yes", "relevant", "1"]
 
-async def update_profile(user_id: str, hist_input: list):
+async def hist_select_batch(numbered_texts: list, current_request):
+    """
+    Ask once which of the numbered history pairs are relevant to the latest request.
+    Returns the set of relevant 1-based numbers, or None when the call failed.
+    """
+    listing = "\n\n".join(f"[{i}] {text}" for i, text in enumerate(numbered_texts, start=1))
+    command = f"""Which of these numbered history entries are relevant to the current request?
+
+{listing}
+
+Current: {current_request}
+
+Return the numbers of the relevant entries (empty list if none)."""
+
+    try:
+        response = await openai.responses.create(
+            model=PROFILE_MODEL,
+            reasoning={"effort": "minimal"},
+            text={
+                "verbosity": "low",
+                "format": {
+                    "type": "json_schema",
+                    "name": "relevant_entries",
+                    "strict": True,
+                    "schema": {
+                        "type": "object",
+                        "properties": {"relevant": {"type": "array", "items": {"type": "integer"}}},
+                        "required": ["relevant"],
+                        "additionalProperties": False,
+                    },
+                },
+            },
+            input=[{"role": "user", "content": command}],
+        )
+        data = json.loads(response.output_text)
+    except Exception as e:
+        print(f"⚠️ Batched hist selection failed ({str(e)})")
+        return None
+    return {i for i in data.get("relevant", []) if isinstance(i, int) and 1 <= i <= len(numbered_texts)}
+
+def _estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+def _chunk_by_budget(texts: list, budget: int) -> list:
+    """Split texts into consecutive chunks whose estimated token total stays under budget."""
+    chunks, current, used = [], [], 0
+    for text in texts:
+        cost = _estimate_tokens(text)
+        if current and used + cost > budget:
+            chunks.append(current)
+            current, used = [], 0
+        current.append(text)
+        used += cost
+    if current:
+        chunks.append(current)
+    return chunks
+
+async def cached_hist_evaluate(user_id, record_pair: list, current_request) -> bool:
     """
-    Update user profile based on complete conversation history.
-    Should be called AFTER assistant response is saved to history.
+    hist_evaluate over the image-free pair text, memoized per (pair content, query bucket).
     """
-    hist_cleaned = _clean_history_messages(copy.deepcopy(hist_input))
-    profile_path = os.path.join("history", f"{user_id}/profile.json")
+    key, text = verdict_cache.pair_text(record_pair, _pair_text)
+    bucket = verdict_cache.query_bucket(current_request)
+    verdict = verdict_cache.get(user_id, key, bucket)
+    if verdict is None:
+        verdict = await hist_evaluate(text, current_request)
+        verdict_cache.put(user_id, key, bucket, verdict)
+    return verdict
+
+def _report_verdict_cache(user_id):
+    verdict_cache.flush(user_id)
+    cache_stats = verdict_cache.stats()
+    print(f"🗂️ Verdict cache: {cache_stats['hits']} hits / {cache_stats['misses']} misses | Hit ratio: {round(cache_stats['hit_ratio'],2)}")
+
+async def update_profile_incremental(user_id: str, new_messages: list, client=None):
+    """
+    Merge messages added since the last profile run into the stored profile.
+    Run by profile_jobs in the background, never on the response path.
+    Returns False when the merge failed, so the caller can keep the messages.
+    """
+    stored = await asyncio.to_thread(get_storage().load_profile, user_id)
+    previous_sections = {k: v for k, v in stored.items() if k != "meta"}
+    source_messages = stored.get("meta", {}).get("source_messages", 0)
+
+    new_cleaned = _history_view(new_messages)
+    if not _profile_history_blob(new_cleaned):
+        # Nothing to merge
+        return True
+    profile_sections = await _profile_sections_from_history(new_cleaned, previous_sections, client)
+    if not profile_sections:
+        return False
+    await asyncio.to_thread(_save_profile_sections, user_id, profile_sections, source_messages + len(new_cleaned))
+    print(f"✅ Profile updated for user {user_id} (+{len(new_cleaned)} messages)")
+    return True
 
+async def update_profile(user_id: str, hist_input: list):
+    """
+    Rebuild user profile from the complete conversation history.
+    Turns use profile_jobs.schedule_profile_update instead.
+    """
+    hist_cleaned = _history_view(hist_input)
     profile_sections = await _profile_sections_from_history(hist_cleaned)
     if profile_sections:
-        _save_profile_sections(profile_path, profile_sections, len(hist_cleaned))
+        _save_profile_sections(user_id, profile_sections, len(hist_cleaned))
         print(f"✅ Profile updated for user {user_id}")
 
-async def hist_handler(user_message, user_id, hist_input):
-    hist_cleaned = _clean_history_messages(copy.deepcopy(hist_input))
+def _encode_record_images(record_pair: list):
+    for record in record_pair:
+        if isinstance(record.get("content"), list):
+            for item in record["content"]:
+                if item.get("type") == "input_image":
+                    # Memoized per image, see image_store
+                    try:
+                        item["image_url"] = image_store.data_url(item["image_url"])
+                    except FileNotFoundError:
+                        # Old upload whose file is gone; keep the rest of the pair
+                        item.clear()
+                        item.update({"type": "input_text", "text": "[image no longer available]"})
+
+def split_history(hist_input: list) -> tuple[list, list, list]:
+    """
+    Split raw history into (history view, short-term pairs, long-term candidate pairs).
+    Pairs hold HistoryRecords sharing the stored messages; stages materialize
+    dicts only for the pairs they actually send.
+    Pure CPU work, no I/O, so every downstream stage can start from its result at once.
+    """
+    hist_cleaned = _history_view(hist_input)
     hist = hist_cleaned[-TOTAL_HIST_LIMIT:]
 
     hist_record_pairs = []
@@ -369,59 +584,178 @@ async def hist_handler(user_message, user_id, hist_input):
         pair = hist[i:i+2]
         hist_record_pairs.append(pair)
 
-    short_term_memory = []
+    short_time_pairs = hist_record_pairs[-SHORT_HIST_LIMIT:]
+    long_time_pairs = hist_record_pairs[:-SHORT_HIST_LIMIT] if len(hist_record_pairs) > SHORT_HIST_LIMIT else []
+    return hist_cleaned, short_time_pairs, long_time_pairs
 
-    # Load cached profile (do NOT update here - will update after response)
-    profile_path = os.path.join("history", f"{user_id}/profile.json")
-    cached_profile = _load_profile_sections(profile_path)
+async def profile_context(user_id) -> list:
+    """Load the cached profile as a system message (do NOT update here - will update after response)."""
+    cached_profile = await asyncio.to_thread(_load_profile_sections, user_id)
 
     profile_msg = _profile_message(cached_profile)
     if profile_msg:
-        short_term_memory.append({"role": "system", "content": profile_msg})
-
+        return [{"role": "system", "content": profile_msg}]
+    return []
+
+async def summary_context(user_id, chat_id, hist_cleaned: list) -> list:
+    """Rolling summary of the chat's older messages (written by compaction.py) as one system message."""
+    summary = await asyncio.to_thread(get_storage().load_summary, user_id, chat_id)
+    covered = summary.get("covered", 0)
+    # Skip checkpoints that no longer match the chat (cleared, edited, recreated)
+    if not covered or covered > len(hist_cleaned) or summary.get("covered_hash") != _record_hash(hist_cleaned[covered - 1]):
+        return []
+    return [{
+        "role": "system",
+        "content": f"Summary of the earlier conversation (messages 1-{covered}):\n{summary['summary']}"
+    }]
+
+def recent_context(hist_cleaned: list) -> list:
     recent_lines = _recent_conversation_content(hist_cleaned)
     if recent_lines:
-        short_term_memory.append({
+        return [{
             "role": "system",
             "content": "Recent conversation content (user-only, newest last):\n" + "\n".join(recent_lines)
-        })
+        }]
+    return []
+
+async def short_term_context(short_time_pairs: list) -> list:
+    """Short-term memory: always include recent messages without evaluation (faster)."""
+    def encode_all():
+        memory = []
+        for pairs in short_time_pairs:
+            record_pair = _materialize(pairs)
+            _encode_record_images(record_pair)
+            memory += record_pair
+        return memory
+    return await asyncio.to_thread(encode_all)
+
+async def _evaluated_long_term_context(user_message, user_id, long_time_pairs: list) -> list:
+    """Processing long time history with parallel evaluation."""
+    long_term_memory = []
+    if not long_time_pairs:
+        return long_term_memory
+
+    async def evaluate_content(record_pair, user_message):
+        if_relevant = await cached_hist_evaluate(user_id, record_pair, user_message)
+        if if_relevant:
+            record_pair = _materialize(record_pair)
+            await asyncio.to_thread(_encode_record_images, record_pair)
+            return record_pair
+        return []
+
+    start = time.time()
+    coros_hist_evaluation = [evaluate_content(record_pair, user_message) for record_pair in long_time_pairs]
+    results = await asyncio.gather(*coros_hist_evaluation)
+    for res in results:
+        long_term_memory += res
+    await asyncio.to_thread(_report_verdict_cache, user_id)
+    e1 = time.time()
+    print("---")
+    print(f"📚 Hist evaluation: {len(long_time_pairs)} pairs | Cost: {round(e1-start,2)}s")
+    print("---")
+    return long_term_memory
+
+async def _batched_long_term_context(user_message, user_id, long_time_pairs: list) -> list:
+    """All uncached candidate pairs judged in one numbered prompt per token-budget chunk."""
+    start = time.time()
+    bucket = verdict_cache.query_bucket(user_message)
+    verdicts = {}
+    pending = []
+    for i, record_pair in enumerate(long_time_pairs):
+        key, text = verdict_cache.pair_text(record_pair, _pair_text)
+        verdict = verdict_cache.get(user_id, key, bucket)
+        if verdict is None:
+            pending.append((i, key, text[:BATCH_PAIR_CHAR_LIMIT]))
+        else:
+            verdicts[i] = verdict
+
+    chunks = _chunk_by_budget([text for _, _, text in pending], BATCH_SELECT_TOKEN_BUDGET)
+    results = await asyncio.gather(*[hist_select_batch(chunk, user_message) for chunk in chunks])
+    offset = 0
+    for chunk, relevant in zip(chunks, results):
+        if relevant is None:
+            # Not judged: leave these pairs out this turn, uncached so the next turn asks again
+            offset += len(chunk)
+            continue
+        for n in range(1, len(chunk) + 1):
+            i, key, _ = pending[offset + n - 1]
+            verdicts[i] = n in relevant
+            verdict_cache.put(user_id, key, bucket, verdicts[i])
+        offset += len(chunk)
 
-    # Short-term memory: always include recent messages without evaluation (faster)
-    short_time_pairs = hist_record_pairs[-SHORT_HIST_LIMIT:]
-    for pairs in short_time_pairs:
-        for record in pairs:
-            if isinstance(record.get("content"), list):
-                for item in record["content"]:
-                    if item.get("type") == "input_image":
-                        photo = encode_image(item["image_url"])
-                        item["image_url"] = f"data:image/jpeg;base64,{photo}"
-        short_term_memory += pairs
-
-    # Processing long time history with parallel evaluation
     long_term_memory = []
-    if len(hist_record_pairs) > SHORT_HIST_LIMIT:
-        long_time_pairs = hist_record_pairs[:-SHORT_HIST_LIMIT]
-
-        async def evaluate_content(record_pair, user_message):
-            if_relevant = await hist_evaluate(str(record_pair), user_message)
-            if if_relevant:
-                for record in record_pair:
-                    if isinstance(record.get("content"), list):
-                        for item in record["content"]:
-                            if item.get("type") == "input_image":
-                                photo = encode_image(item["image_url"])
-                                item["image_url"] = f"data:image/jpeg;base64,{photo}"
-                return record_pair
-            return []
-
-        start = time.time()
-        coros_hist_evaluation = [evaluate_content(record_pair, user_message) for record_pair in long_time_pairs]
-        results = await asyncio.gather(*coros_hist_evaluation)
-        for res in results:
-            long_term_memory += res
-        e1 = time.time()
-        print("---")
-        print(f"📚 Hist evaluation: {len(long_time_pairs)} pairs | Cost: {round(e1-start,2)}s")
-        print("---")
+    for i, record_pair in enumerate(long_time_pairs):
+        if verdicts.get(i):
+            record_pair = _materialize(record_pair)
+            await asyncio.to_thread(_encode_record_images, record_pair)
+            long_term_memory += record_pair
+    await asyncio.to_thread(_report_verdict_cache, user_id)
+    print("---")
+    print(f"📚 Hist batch evaluation: {len(long_time_pairs)} pairs in {len(chunks)} calls | Cost: {round(time.time()-start,2)}s")
+    print("---")
+    return long_term_memory
+
+async def _indexed_long_term_context(user_message, user_id, chat_id, hist_cleaned: list) -> list:
+    """Top-k retrieval over every older pair of the chat, optionally re-ranked by the LLM judge."""
+    start = time.time()
+    pair_texts = _pair_texts(hist_cleaned)
+    candidates = len(pair_texts) - SHORT_HIST_LIMIT
+    if candidates <= 0:
+        return []
+
+    # Incremental: only pairs written since the last update get tokenized
+    index = await asyncio.to_thread(retrieval.update_index, user_id, chat_id, pair_texts)
+    top_k = RERANK_CANDIDATES if HIST_RERANK else LONG_TERM_TOP_K
+    hits = None
+    if HIST_EMBEDDINGS:
+        try:
+            hits = await retrieval.hybrid_search(openai, user_id, chat_id, index, pair_texts, user_message, candidates, top_k)
+        except Exception as e:
+            print(f"⚠️ Embedding search failed ({str(e)}), using BM25 only")
+    if hits is None:
+        hits = retrieval.search(index, user_message, candidates, top_k)
+    selected = [i for i, _ in hits]
+
+    if HIST_RERANK and selected:
+        try:
+            verdicts = await asyncio.gather(*[
+                cached_hist_evaluate(user_id, hist_cleaned[2*i:2*i+2], user_message) for i in selected
+            ])
+            selected = [i for i, relevant in zip(selected, verdicts) if relevant][:LONG_TERM_TOP_K]
+        except Exception as e:
+            # Keep the retrieval order without the judge
+            print(f"⚠️ Re-ranking failed ({str(e)}), using retrieval results")
+            selected = selected[:LONG_TERM_TOP_K]
+        await asyncio.to_thread(_report_verdict_cache, user_id)
 
+    long_term_memory = []
+    for i in sorted(selected):
+        record_pair = _materialize(hist_cleaned[2*i:2*i+2])
+        await asyncio.to_thread(_encode_record_images, record_pair)
+        long_term_memory += record_pair
+
+    print("---")
+    print(f"📚 Hist retrieval: {candidates} pairs -> {len(selected)} selected | Cost: {round(time.time()-start,4)}s")
+    print("---")
+    return long_term_memory
+
+async def long_term_context(user_message, long_time_pairs: list, user_id=None, chat_id=None, hist_cleaned: list = None) -> list:
+    if HIST_RELEVANCE_MODE == "index" and user_id is not None and hist_cleaned is not None:
+        if chat_id is None:
+            chat_id = user_id
+        return await _indexed_long_term_context(user_message, user_id, chat_id, hist_cleaned)
+    if HIST_RELEVANCE_MODE == "batch":
+        return await _batched_long_term_context(user_message, user_id, long_time_pairs)
+    return await _evaluated_long_term_context(user_message, user_id, long_time_pairs)
+
+async def hist_handler(user_message, user_id, hist_input, chat_id=None):
+    hist_cleaned, short_time_pairs, long_time_pairs = split_history(hist_input)
+
+    profile_memory, summary_memory, short_pairs_memory, long_term_memory = await asyncio.gather(
+        profile_context(user_id),
+        summary_context(user_id, chat_id if chat_id is not None else user_id, hist_cleaned),
+        short_term_context(short_time_pairs),
+        long_term_context(user_message, long_time_pairs, user_id, chat_id, hist_cleaned),
+    )
+    short_term_memory = profile_memory + summary_memory + recent_context(hist_cleaned) + short_pairs_memory
     return short_term_memory, long_term_memory
@@ -0,0 +1,74 @@
+"""
+Canonical history message format.
+
+Assistant messages keep what the model should see again in `content` and
+what the UIs render in `display` (Streamlit reasoning/output headers, the
+Telegram time prefix, the tool footer). Only `content` is ever sent back as
+context. Run `python history_format.py migrate` once to split messages
+written before `display` existed.
+"""
+import re
+import sys
+
+MODULE_FOOTER = "🔌 Module Used"
+_OUTPUT_HEADER = "### 💬 Output\n"
+_REASONING_HEADER = "### 🧠 Reasoning\n"
+_TIME_PREFIX = re.compile(r"^Time:[^\n]*\n\s*")
+_RULE = re.compile(r"\n+---\n+(###\s*)?$")
+
+def assistant_message(content: str, display: str = None) -> dict:
+    message = {"role": "assistant", "content": content}
+    if display is not None and display != content:
+        message["display"] = display
+    return message
+
+def display_text(message: dict):
+    """What the UIs render for a stored message."""
+    return message.get("display", message.get("content"))
+
+def strip_decorations(text: str) -> str:
+    """Canonical text of an assistant message stored with UI decorations."""
+    if _OUTPUT_HEADER in text:
+        text = text.split(_OUTPUT_HEADER, 1)[1]
+    elif text.startswith(_REASONING_HEADER):
+        # Reasoning without an output section carries no answer
+        text = ""
+    text = _TIME_PREFIX.sub("", text, count=1)
+    text = text.split(MODULE_FOOTER)[0]
+    return _RULE.sub("", text.rstrip()).strip()
+
+def canonicalize(hist: list) -> tuple[list, int]:
+    """Split legacy assistant messages into content/display. Returns (history, chars removed)."""
+    result = []
+    saved = 0
+    for message in hist:
+        if message.get("role") == "assistant" and "display" not in message and isinstance(message.get("content"), str):
+            content = strip_decorations(message["content"])
+            saved += len(message["content"]) - len(content)
+            message = {**message, **assistant_message(content, message["content"])}
+        result.append(message)
+    return result, saved
+
+def migrate_all() -> tuple[int, int]:
+    """Canonicalize every stored chat. Returns (chats rewritten, chars removed)."""
+    from storage import get_storage
+
+    storage = get_storage()
+    chats = saved_total = 0
+    for user_id in storage.list_users():
+        for chat_id in storage.list_chats(user_id):
+            hist, saved = canonicalize(storage.read_messages(user_id, chat_id))
+            if not saved:
+                continue
+            storage.replace_messages(user_id, chat_id, hist)
+            chats += 1
+            saved_total += saved
+            print(f"✅ {user_id}/{chat_id}: -{saved} chars (~{saved // 4} tokens)")
+    return chats, saved_total
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "migrate":
+        chats, saved = migrate_all()
+        print(f"Canonicalized {chats} chats, ~{saved // 4} context tokens removed.")
+    else:
+        print("Usage: python history_format.py migrate")
@@ -0,0 +1,209 @@
+"""
+Content-addressed image store.
+
+Images are saved once under `history/blobs/<aa>/<sha256>` and history
+messages reference them as `blob:<sha256>` in `image_url`, so identical
+uploads are stored once and chats never depend on download paths. The
+base64 data URLs sent to the model are memoized in a size-bounded LRU, so an
+image that stays in the short-term window is read and encoded once.
+Plain file paths (histories written before the store) are still accepted;
+`python image_store.py migrate` moves them into the store, and
+`python image_store.py cleanup` then deletes blobs no chat references and
+the photo files older versions left in the working directory.
+"""
+import os
+import sys
+import glob
+import time
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+import metrics
+
+BLOB_ROOT = "history/blobs"
+REF_PREFIX = "blob:"
+DATA_URL_CACHE_BYTES = int(os.environ.get("IMAGE_CACHE_BYTES", str(32 * 1024 * 1024)))
+# Blobs are stored before the turn writes its history; younger ones are never orphans
+CLEANUP_GRACE_SECONDS = 3600
+# Telethon's default download names in the working directory, and their PNG conversions
+LEGACY_DOWNLOAD_PATTERNS = ["photo_*.jpg", "photo_*.png"]
+
+_lock = threading.Lock()
+_data_urls: "OrderedDict[str, str]" = OrderedDict()
+_cached_bytes = 0
+
+def is_ref(image_url: str) -> bool:
+    return isinstance(image_url, str) and image_url.startswith(REF_PREFIX)
+
+def _blob_path(digest: str) -> str:
+    return os.path.join(BLOB_ROOT, digest[:2], digest)
+
+def put_bytes(data: bytes) -> str:
+    """Store image bytes (deduplicated by content) and return their `blob:` reference."""
+    digest = hashlib.sha256(data).hexdigest()
+    path = _blob_path(digest)
+    try:
+        # A new reference restarts the cleanup grace period of an old blob
+        os.utime(path)
+        metrics.incr("image_store.dedup")
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        metrics.incr("image_store.stored")
+    return REF_PREFIX + digest
+
+def put_file(file_path: str) -> str:
+    with open(file_path, "rb") as f:
+        return put_bytes(f.read())
+
+def local_path(image_url: str) -> str:
+    """File behind an image reference (legacy history entries are paths already)."""
+    if is_ref(image_url):
+        return _blob_path(image_url[len(REF_PREFIX):])
+    return image_url
+
+def read_bytes(image_url: str) -> bytes:
+    with open(local_path(image_url), "rb") as f:
+        return f.read()
+
+def sniff_mime(data: bytes) -> str:
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    return "image/jpeg"
+
+def _cache_key(image_url: str):
+    if is_ref(image_url):
+        return image_url
+    # Legacy path: invalidate when the file changes; None (never cached) if it is gone
+    try:
+        return f"{image_url}@{os.path.getmtime(image_url)}"
+    except OSError:
+        return None
+
+def data_url(image_url: str) -> str:
+    """`data:` URL for an image reference, encoded once while it stays in the LRU."""
+    global _cached_bytes
+    if image_url.startswith("data:"):
+        return image_url
+    key = _cache_key(image_url)
+    with _lock:
+        cached = _data_urls.get(key) if key is not None else None
+        if cached is not None:
+            _data_urls.move_to_end(key)
+            metrics.incr("image_store.hit")
+            return cached
+
+    metrics.incr("image_store.miss")
+    data = read_bytes(image_url)
+    url = f"data:{sniff_mime(data)};base64,{base64.b64encode(data).decode('utf-8')}"
+    with _lock:
+        if key is not None and key not in _data_urls:
+            _data_urls[key] = url
+            _cached_bytes += len(url)
+        while _cached_bytes > DATA_URL_CACHE_BYTES and len(_data_urls) > 1:
+            _, evicted = _data_urls.popitem(last=False)
+            _cached_bytes -= len(evicted)
+            metrics.incr("image_store.evicted")
+        metrics.gauge("image_store.cached_bytes", _cached_bytes)
+    return url
+
+def migrate_all() -> int:
+    """Replace file-path image references in every stored chat. Returns images moved."""
+    from storage import get_storage
+
+    storage = get_storage()
+    moved = 0
+    for user_id in storage.list_users():
+        for chat_id in storage.list_chats(user_id):
+            hist = storage.read_messages(user_id, chat_id)
+            changed = False
+            for i, message in enumerate(hist):
+                if not isinstance(message.get("content"), list):
+                    continue
+                content = []
+                for item in message["content"]:
+                    image_url = item.get("image_url") if isinstance(item, dict) else None
+                    if item.get("type") == "input_image" and image_url and not is_ref(image_url) and not image_url.startswith("data:"):
+                        if os.path.exists(image_url):
+                            item = {**item, "image_url": put_file(image_url)}
+                            changed = True
+                            moved += 1
+                        else:
+                            print(f"⚠️ Missing image {image_url} in {user_id}/{chat_id}")
+                    content.append(item)
+                # Never mutate the (possibly cached) stored message in place
+                hist[i] = {**message, "content": content}
+            if changed:
+                storage.replace_messages(user_id, chat_id, hist)
+                print(f"✅ {user_id}/{chat_id}: image references moved to the store")
+    return moved
+
+def referenced_images() -> set:
+    """Every image reference (blob or legacy path) in stored chats."""
+    from storage import get_storage
+
+    storage = get_storage()
+    refs = set()
+    for user_id in storage.list_users():
+        for chat_id in storage.list_chats(user_id):
+            for message in storage.read_messages(user_id, chat_id):
+                if not isinstance(message.get("content"), list):
+                    continue
+                for item in message["content"]:
+                    if isinstance(item, dict) and item.get("type") == "input_image" and item.get("image_url"):
+                        refs.add(item["image_url"])
+    return refs
+
+def cleanup(patterns: list = None, dry_run: bool = False) -> tuple[int, int]:
+    """
+    Delete unreferenced blobs and leftover photo files matching `patterns`
+    (default LEGACY_DOWNLOAD_PATTERNS). Files a chat still references by path
+    are kept; run migrate first. Returns (files deleted, bytes freed).
+    """
+    refs = referenced_images()
+    legacy = {os.path.abspath(ref) for ref in refs if not is_ref(ref) and not ref.startswith("data:")}
+    cutoff = time.time() - CLEANUP_GRACE_SECONDS
+
+    candidates = []
+    for path in glob.glob(os.path.join(BLOB_ROOT, "*", "*")):
+        if os.path.basename(path).endswith(".tmp") or REF_PREFIX + os.path.basename(path) not in refs:
+            candidates.append(path)
+    for pattern in patterns or LEGACY_DOWNLOAD_PATTERNS:
+        candidates += [path for path in glob.glob(pattern) if os.path.abspath(path) not in legacy]
+
+    deleted = freed = 0
+    for path in candidates:
+        try:
+            stat = os.stat(path)
+            if stat.st_mtime > cutoff or not os.path.isfile(path):
+                continue
+            if not dry_run:
+                os.remove(path)
+        except FileNotFoundError:
+            continue
+        deleted += 1
+        freed += stat.st_size
+        print(f"{'Would delete' if dry_run else '🗑️ Deleted'} {path}")
+    metrics.incr("image_store.cleaned", deleted)
+    return deleted, freed
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "migrate":
+        print(f"Moved {migrate_all()} images into {BLOB_ROOT}.")
+    elif len(sys.argv) >= 2 and sys.argv[1] == "cleanup":
+        args = sys.argv[2:]
+        dry_run = "--dry-run" in args
+        deleted, freed = cleanup([a for a in args if a != "--dry-run"], dry_run=dry_run)
+        print(f"{'Would free' if dry_run else 'Freed'} {round(freed/1024/1024,1)}MB in {deleted} files.")
+    else:
+        print("Usage: python image_store.py migrate | cleanup [--dry-run] [GLOB ...]")
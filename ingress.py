@@ -0,0 +1,176 @@
+"""
+Ingress side of the multi-process Telegram bot.
+
+With BOT_WORKERS > 0, bot.py keeps the only Telegram connection: it receives
+updates, checks verification and forwards turns, /cancel and /empty to
+worker processes (bot_worker.py) over the Unix socket BOT_SOCKET. Chats are
+sharded by sender id into BOT_WORKERS fixed slots and every worker owns one
+slot, so all turns of a chat run in the same process, behind its per-chat
+queue and history cache. Workers send and edit Telegram messages through
+the ingress. Messages for a slot without a worker wait here until one
+connects; extra workers stand by until a slot frees up (a standby worker
+that disconnects is skipped). Sends wait for the worker to drain its link,
+so a slow worker holds up the handlers feeding it instead of letting
+buffered turns grow without bound.
+
+The link carries one JSON object per line.
+"""
+import os
+import json
+import base64
+import asyncio
+from telethon.errors import FloodWaitError
+import metrics
+
+BOT_WORKERS = int(os.environ.get("BOT_WORKERS", "0"))          # 0: turns run in the bot process
+BOT_SOCKET = os.environ.get("BOT_SOCKET", "history/bot.sock")
+LINK_LIMIT = 64 * 1024 * 1024     # longest line: a turn with a base64 photo
+
+def encode(message: dict) -> bytes:
+    return (json.dumps(message, ensure_ascii=False) + "\n").encode("utf-8")
+
+async def read_message(reader) -> dict:
+    """Next message on the link, or None once it is closed."""
+    line = await reader.readline()
+    return json.loads(line) if line else None
+
+def pack_turn(turn: dict) -> dict:
+    if turn["photo"] is None:
+        return turn
+    return {**turn, "photo": base64.b64encode(turn["photo"]).decode("ascii")}
+
+def unpack_turn(turn: dict) -> dict:
+    if turn["photo"] is None:
+        return turn
+    return {**turn, "photo": base64.b64decode(turn["photo"])}
+
+async def _drain(writer):
+    try:
+        await writer.drain()
+    except ConnectionError:
+        pass  # The link is gone; _release reports the worker's turns as lost
+
+class Ingress:
+
+    def __init__(self, client, slots: int = BOT_WORKERS, path: str = BOT_SOCKET):
+        self.client = client
+        self.slots = slots
+        self.path = path
+        self._workers: dict = {}       # slot -> writer
+        self._pending: dict = {}       # slot -> messages waiting for a worker
+        self._inflight: dict = {}      # slot -> {turn id: chat id}
+        self._standby: list = []       # (future, reader, writer) of connected workers without a slot
+        self._next_turn = 0
+
+    async def start(self):
+        if os.path.exists(self.path):
+            # Left behind by a previous run
+            os.remove(self.path)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        await asyncio.start_unix_server(self._connected, path=self.path, limit=LINK_LIMIT)
+        print(f"🔀 Ingress listening on {self.path} for {self.slots} workers")
+
+    def slot(self, user_id) -> int:
+        return int(user_id) % self.slots
+
+    async def submit(self, turn: dict):
+        slot = self.slot(turn["user"])
+        self._next_turn += 1
+        self._inflight.setdefault(slot, {})[self._next_turn] = turn["chat"]
+        metrics.incr("ingress.turns")
+        await self._send(slot, {"op": "turn", "id": self._next_turn, "turn": pack_turn(turn)})
+
+    async def cancel(self, user_id, chat_id):
+        await self._send(self.slot(user_id), {"op": "cancel", "user": user_id, "chat": chat_id})
+
+    async def empty(self, user_id, chat_id):
+        await self._send(self.slot(user_id), {"op": "empty", "user": user_id, "chat": chat_id})
+
+    async def _send(self, slot: int, message: dict):
+        writer = self._workers.get(slot)
+        if writer is None:
+            self._pending.setdefault(slot, []).append(message)
+            metrics.gauge("ingress.pending", sum(len(p) for p in self._pending.values()))
+            return
+        writer.write(encode(message))
+        await _drain(writer)
+
+    async def _claim_slot(self, reader, writer):
+        """A free slot, or wait for one; None if the worker disconnects while standing by."""
+        free = [slot for slot in range(self.slots) if slot not in self._workers]
+        if free:
+            return free[0]
+        writer.write(encode({"op": "standby"}))
+        future = asyncio.get_running_loop().create_future()
+        self._standby.append((future, reader, writer))
+        return await future
+
+    def _hand_over(self, slot: int):
+        """Give a freed slot to the first standby worker that is still connected."""
+        while self._standby:
+            future, reader, writer = self._standby.pop(0)
+            if future.done():
+                continue
+            if reader.at_eof() or writer.is_closing():
+                future.set_result(None)
+                continue
+            future.set_result(slot)
+            return
+
+    async def _connected(self, reader, writer):
+        slot = await self._claim_slot(reader, writer)
+        if slot is None:
+            writer.close()
+            return
+        self._workers[slot] = writer
+        metrics.gauge("ingress.workers", len(self._workers))
+        writer.write(encode({"op": "hello", "slot": slot, "slots": self.slots}))
+        for message in self._pending.pop(slot, []):
+            writer.write(encode(message))
+        print(f"🔀 Worker joined slot {slot}/{self.slots}")
+        await _drain(writer)
+        try:
+            while (message := await read_message(reader)) is not None:
+                if message["op"] == "call":
+                    asyncio.create_task(self._call(writer, message))
+                elif message["op"] == "done":
+                    self._inflight.get(slot, {}).pop(message["id"], None)
+        except (ConnectionError, ValueError) as e:
+            print(f"⚠️ Worker link error on slot {slot}: {str(e)}")
+        finally:
+            await self._release(slot, writer)
+
+    async def _release(self, slot: int, writer):
+        del self._workers[slot]
+        metrics.gauge("ingress.workers", len(self._workers))
+        writer.close()
+        print(f"⚠️ Worker left slot {slot}")
+        self._hand_over(slot)
+        # Turns the worker had accepted are gone with it
+        lost = self._inflight.pop(slot, {})
+        metrics.incr("ingress.lost_turns", len(lost))
+        for chat_id in set(lost.values()):
+            try:
+                await self.client.send_message(chat_id, "⚠️ The bot restarted while answering. Please send your message again.", parse_mode="md")
+            except Exception as e:
+                print("Lost turn notice failed:", e)
+
+    async def _call(self, writer, message: dict):
+        """Run a worker's Telegram request and send back the result."""
+        reply = {"op": "reply", "id": message["id"]}
+        try:
+            if message["method"] == "send":
+                sent = await self.client.send_message(message["chat"], message["text"], parse_mode="md")
+                reply["result"] = sent.id
+            elif message["method"] == "edit":
+                await self.client.edit_message(message["chat"], message["message"], message["text"])
+            else:
+                reply["error"] = f"unknown method {message['method']}"
+        except FloodWaitError as e:
+            reply["error"] = str(e)
+            reply["flood"] = e.seconds
+        except Exception as e:
+            reply["error"] = str(e)
+        if not writer.is_closing():
+            writer.write(encode(reply))
+            await _drain(writer)
@@ -3,32 +3,44 @@ import os
 import json
 import re
 import time
-from openai import AsyncOpenAI
-from hist import hist_handler
+import asyncio
+from openai import AsyncOpenAI, NotFoundError, BadRequestError
+from hist import split_history, profile_context, summary_context, recent_context, short_term_context, long_term_context
 from tools.general_utils import get_current_time
 from tools.tools_description import call_function
 from tools.decorator import REGISTERED_TOOL_DESCRIPTIONS
+import metrics
+import image_store
+from storage import get_storage
+from context_budget import build_context
+from router import route, finalize_selection, MODEL_MINI
 
 from dotenv import load_dotenv
 load_dotenv()
 openai = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
 tools_description = REGISTERED_TOOL_DESCRIPTIONS
 
-# Model configuration
-MODEL_NANO = "gpt-5-nano"    # High-throughput tasks, simple instruction-following or classification
-MODEL_MINI = "gpt-5-mini"    # Cost-optimized reasoning and chat; balances speed, cost, and capability
-MODEL_STANDARD = "gpt-5.1"   # Complex reasoning, broad world knowledge, code-heavy or multi-step agentic tasks
+# Maximum number of tool-calling rounds before the model must answer
+MAX_TOOL_ROUNDS = int(os.environ.get("MAX_TOOL_ROUNDS", "3"))
 
-async def select_model_and_reasoning(user_message: str, has_tools: bool = True) -> tuple[str, str, str]:
+# Chain turns with previous_response_id instead of resending the whole context
+RESPONSE_CHAINING = os.environ.get("RESPONSE_CHAINING") == "1"
+RESPONSE_CHAIN_TTL = float(os.environ.get("RESPONSE_CHAIN_TTL", str(7 * 24 * 3600)))  # seconds a stored chain is trusted
+
+# Per-request token usage, including prompt cache hits
+USAGE_LOG_FILE = "history/usage_log.jsonl"
+
+async def select_model_and_reasoning(user_message: str, has_tools: bool = True):
     """
     Use a small model to intelligently select the best model, reasoning effort, and verbosity.
+    Remote fallback of the local router, see router.route().
 
     Args:
         user_message: The user's input message
         has_tools: Whether tools are available for this request
 
     Returns:
-        Tuple of (model_name, reasoning_effort, verbosity)
+        Tuple of (model_name, reasoning_effort, verbosity), or None if the selection failed
     """
 
     selection_prompt = f"""You are a model selector. Analyze the user's query and return ONLY a JSON object with three fields:
@@ -76,63 +88,24 @@ Return ONLY the JSON object, no other text."""
         reasoning = selection.get("reasoning", "minimal")
         verbosity = selection.get("verbosity", "medium")
 
-        # Validate values
-        if model not in [MODEL_NANO, MODEL_MINI, MODEL_STANDARD]:
-            model = MODEL_MINI  # Default to balanced model
-
-        # Validate reasoning based on model
-        if model == MODEL_STANDARD:
-            # gpt-5.1 supports none, minimal, low, medium, high
-            if reasoning not in ["none", "minimal", "low", "medium", "high"]:
-                reasoning = "none"
-        else:
-            # nano and mini only support minimal, low, medium, high (no "none")
-            if reasoning not in ["minimal", "low", "medium", "high"]:
-                reasoning = "minimal"
-
-        if verbosity not in ["low", "medium", "high"]:
-            verbosity = "medium"
-
-        # IMPORTANT: web_search tool requires reasoning >= "low"
-        # If reasoning is "minimal" or "none", upgrade to "low" when tools are available
-        if has_tools and reasoning in ["minimal", "none"]:
-            reasoning = "low"
-            print(f"⚠️ Upgraded reasoning to 'low' (required for web_search tool)")
-
-        # Determine emoji based on model and reasoning level
-        emoji_map = {
-            (MODEL_NANO, "minimal"): "⚡",
-            (MODEL_NANO, "low"): "⚡",
-            (MODEL_MINI, "minimal"): "💬",
-            (MODEL_MINI, "low"): "🔧",
-            (MODEL_STANDARD, "none"): "⚡",  # fastest option for 5.1
-            (MODEL_STANDARD, "minimal"): "📊",
-            (MODEL_STANDARD, "low"): "⚙️",
-            (MODEL_STANDARD, "medium"): "🧠",
-            (MODEL_STANDARD, "high"): "💻",
-        }
-        emoji = emoji_map.get((model, reasoning), "📊")
-
-        print(f"{emoji} Model: {model} | Reasoning: {reasoning} | Verbosity: {verbosity}")
-        return model, reasoning, verbosity
+        return finalize_selection(model, reasoning, verbosity, has_tools=has_tools)
 
     except Exception as e:
-        # Fallback to safe defaults if selection fails
-        print(f"⚠️ Model selection failed ({str(e)}), using defaults")
-        # Use "low" reasoning when tools are available (required for web_search)
-        fallback_reasoning = "low" if has_tools else "minimal"
-        print(f"💬 Model: {MODEL_MINI} | Reasoning: {fallback_reasoning} | Verbosity: medium")
-        return MODEL_MINI, fallback_reasoning, "medium"
-
-def assemble_photo_request(prompt_messages, user_message, photo):
-    if photo is not None:
+        # The router falls back to its local decision
+        print(f"⚠️ Model selection failed ({str(e)})")
+        return None
+
+def assemble_photo_request(prompt_messages, user_message, photo_url, detail="auto"):
+    """`photo_url` is the data URL of the image attached to this message (see _photo_url)."""
+    if photo_url is not None:
         prompt_messages.append({
             "role": "user",
             "content": [
                 { "type": "input_text", "text": user_message},
                 {
                     "type": "input_image",
-                    "image_url": f"data:image/jpeg;base64,{photo}",
+                    "image_url": photo_url,
+                    "detail": detail,
                 },
             ],
         })
@@ -141,87 +114,303 @@ def assemble_photo_request(prompt_messages, user_message, photo):
 
     return prompt_messages
 
-    
-async def llm(user_message, user_id, hist_input, photo=None):                
+async def _photo_url(photo):
+    """Read and encode the attached image off the event loop (memoized by image_store)."""
+    if photo is None:
+        return None
+    return await asyncio.to_thread(image_store.data_url, photo)
 
-    prompt = """
-    You are a helpful AI assistant. 
+async def _timed(name: str, aw, timings: dict):
+    """Await a pipeline stage and record its wall time in `timings`."""
+    start = time.time()
+    try:
+        return await aw
+    finally:
+        timings[name] = time.time() - start
+
+def _report_stage_timings(timings: dict, wall: float):
+    stages = " | ".join(f"{name} {round(cost, 2)}s" for name, cost in timings.items())
+    print("---")
+    print(f"⏱️ Stages: {stages}")
+    print(f"⏱️ Critical path: {round(wall, 2)}s (sequential sum would be {round(sum(timings.values()), 2)}s)")
+    print("---")
+
+async def _run_tool_call(tool_call):
+    name = tool_call.name
+    arguments = tool_call.arguments
+    print(f"Calling function: {name} with arguments: {arguments}")
+    try:
+        return await call_function(name, json.loads(arguments))
+    except Exception as e:
+        # Let the model see the failure instead of aborting the whole turn
+        return f"Error: {str(e)}"
+
+def _report_round(round_no: int, calls: int, latency: float):
+    metrics.observe("llm.round_latency", latency)
+    metrics.observe("llm.calls_per_round", calls)
+    metrics.incr("llm.rounds")
+    print(f"🔁 Round {round_no}: {calls} tool calls | Cost: {round(latency,2)}s")
+
+async def _context_stages(user_message, user_id, hist_input, chat_id, timings: dict) -> tuple[list, list, list, list]:
+    """
+    Rebuild the conversation context from local history.
+    Returns (profile + summary, recent preview, short-term pairs, long-term pairs).
+    """
+    start = time.time()
+    hist_cleaned, short_time_pairs, long_time_pairs = split_history(hist_input)
+    recent_memory = recent_context(hist_cleaned)
+    timings["context"] = time.time() - start
+
+    profile_memory, summary_memory, short_pairs_memory, long_term_memory = await asyncio.gather(
+        _timed("profile", profile_context(user_id), timings),
+        _timed("summary", summary_context(user_id, chat_id if chat_id is not None else user_id, hist_cleaned), timings),
+        _timed("images", short_term_context(short_time_pairs), timings),
+        _timed("long_term", long_term_context(user_message, long_time_pairs, user_id, chat_id, hist_cleaned), timings),
+    )
+    return profile_memory + summary_memory, recent_memory, short_pairs_memory, long_term_memory
+
+async def _load_chain(user_id, chat_id, hist_len: int):
+    """Stored response id to continue from, or None if it does not match the history (or expired)."""
+    chain = await asyncio.to_thread(get_storage().load_chain, user_id, chat_id)
+    if not chain:
+        return None
+    if chain.get("covered") != hist_len or time.time() - chain.get("created", 0) > RESPONSE_CHAIN_TTL:
+        metrics.incr("llm.chain_miss")
+        return None
+    metrics.incr("llm.chain_hit")
+    return chain["response_id"]
+
+def _time_message() -> dict:
+    # Kept out of the instructions and placed right before the user message,
+    # so the per-second change does not break the provider's prompt cache
+    return {"role": "system", "content": f"Current Tokyo time is {get_current_time()}."}
+
+def _append_usage(record: dict):
+    try:
+        os.makedirs(os.path.dirname(USAGE_LOG_FILE), exist_ok=True)
+        with open(USAGE_LOG_FILE, "a") as f:
+            f.write(json.dumps(record) + "\n")
+    except Exception as e:
+        print(f"⚠️ Failed to log usage ({str(e)})")
+
+async def _record_usage(usage, model: str):
+    """Log input and cached prompt tokens of one request to track the prompt cache hit rate."""
+    if usage is None:
+        return
+    input_tokens = usage.input_tokens or 0
+    details = getattr(usage, "input_tokens_details", None)
+    cached_tokens = (getattr(details, "cached_tokens", 0) or 0) if details else 0
+    metrics.incr("llm.input_tokens", input_tokens)
+    metrics.incr("llm.cached_tokens", cached_tokens)
+    total = metrics.snapshot()["counters"]
+    overall = total["llm.cached_tokens"] / total["llm.input_tokens"] if total.get("llm.input_tokens") else 0.0
+    print(f"🪙 Prompt cache: {cached_tokens}/{input_tokens} input tokens cached | Overall: {round(overall,2)}")
+    await asyncio.to_thread(_append_usage, {
+        "ts": time.time(),
+        "model": model,
+        "input_tokens": input_tokens,
+        "cached_tokens": cached_tokens,
+        "output_tokens": usage.output_tokens or 0,
+    })
+
+class _ResponseStream:
+    """
+    Passes the answer stream through. Once the response completed, records its
+    token usage and, with chaining on, stores its id for the next turn.
     """
 
-    prompt_messages = []
-    tool_used = []
-    short_term_memory, long_term_memory = await hist_handler(user_message, user_id, hist_input)
+    def __init__(self, stream, model: str, user_id=None, chat_id=None, covered: int = None):
+        self.stream = stream
+        self.model = model
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.covered = covered
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        async for event in self.stream:
+            if event.type == "response.completed":
+                await _record_usage(event.response.usage, self.model)
+                if self.covered is not None:
+                    await self._save_chain(event.response.id)
+            yield event
+
+    async def _save_chain(self, response_id: str):
+        try:
+            await asyncio.to_thread(get_storage().save_chain, self.user_id, self.chat_id, {
+                "response_id": response_id,
+                "covered": self.covered,
+                "created": time.time(),
+            })
+        except Exception as e:
+            print(f"⚠️ Failed to store response chain ({str(e)})")
 
-    prompt_messages = assemble_photo_request(prompt_messages, user_message, photo)
+def _request_bytes(request_kwargs: dict) -> int:
+    return len(json.dumps(request_kwargs, ensure_ascii=False, default=str).encode("utf-8"))
 
-    # Debug: print message count instead of full content
-    # print(short_term_memory + prompt_messages)  # Commented out to avoid JSON output
-    print(f"📝 Context loaded: {len(short_term_memory)} system messages, {len(prompt_messages)} user messages")
+def _report_turn_bytes(sent: int, chained: bool):
+    metrics.observe("llm.request_bytes", sent)
+    print(f"📤 Request payload this turn: {round(sent/1024,1)}KB ({'chained' if chained else 'full context'})")
 
-    # Select appropriate model, reasoning effort, and verbosity based on query complexity
-    selected_model, reasoning_effort, verbosity = await select_model_and_reasoning(user_message, has_tools=True)
-
-    stream = await openai.responses.create(
-        model=selected_model,
-        text={
-            "verbosity": verbosity
-        },
-        reasoning={
-            "effort": reasoning_effort
-        },
-        instructions= f"Current Tokyo time is {get_current_time()}. " + prompt,
-        input= short_term_memory + long_term_memory + prompt_messages,
-        tools= tools_description + [{ "type": "web_search_preview" }],
-        stream=True,
-    )
+async def llm(user_message, user_id, hist_input, photo=None, chat_id=None, photo_detail="auto"):                
 
-    final_tool_calls = []
-    async for event in stream:
-        print(event.type)
-        if event.type == 'response.content_part.added':
-            # No Tool is needed, the response is the answer, thus directly return the stream object
-            return stream, tool_used
-        if event.type == 'response.output_item.added':
-            final_tool_calls.append(event.item)
-        elif event.type == 'response.function_call_arguments.delta':
-            index = event.output_index
-            if final_tool_calls[index]:
-                final_tool_calls[index].arguments += event.delta
-    
-    print(f"Final Tool call: {final_tool_calls}")
+    prompt = """
+    You are a helpful AI assistant. 
+    """
 
+    prompt_messages = [_time_message()]
     tool_used = []
-    for tool_call in final_tool_calls:
-        print(tool_call.type)
-        if tool_call.type == "reasoning":
-            prompt_messages.append(tool_call)
-        if tool_call.type == "function_call":
-            call_id = tool_call.call_id
-            name = tool_call.name
-            arguments = tool_call.arguments
-            args = json.loads(arguments)
-            if name == "web_search":
-                result = await call_function(name, args)                                                         
-            else:
-                result = call_function(name, args)
-            
-            prompt_messages.append(tool_call)
-            prompt_messages.append({
+    if chat_id is None:
+        chat_id = user_id
+
+    # With a valid response chain the server already holds the conversation,
+    # so only the router runs and the context stages are skipped entirely
+    previous_response_id = await _load_chain(user_id, chat_id, len(hist_input)) if RESPONSE_CHAINING else None
+    chained = previous_response_id is not None
+
+    # Every stage below only depends on the raw inputs, so start them all at once
+    # and join just before the request. Critical path is max() of the stages.
+    timings = {}
+    pipeline_start = time.time()
+    # Select appropriate model, reasoning effort, and verbosity based on query complexity
+    selection = _timed("router", route(
+        user_message,
+        has_image=photo is not None,
+        has_tools=True,
+        fallback=select_model_and_reasoning,
+    ), timings)
+    photo_url = _timed("photo", _photo_url(photo), timings)
+    if chained:
+        (selected_model, reasoning_effort, verbosity), photo_url = await asyncio.gather(selection, photo_url)
+        stages = None
+    else:
+        (selected_model, reasoning_effort, verbosity), photo_url, stages = await asyncio.gather(
+            selection,
+            photo_url,
+            _context_stages(user_message, user_id, hist_input, chat_id, timings),
+        )
+    _report_stage_timings(timings, time.time() - pipeline_start)
+
+    prompt_messages = assemble_photo_request(prompt_messages, user_message, photo_url, photo_detail)
+
+    def fit_context(stages) -> list:
+        # Fill the model's token budget in priority order, log what did not fit
+        profile_memory, recent_memory, short_pairs_memory, long_term_memory = stages
+        return build_context(
+            selected_model,
+            current=prompt_messages,
+            short_pairs=short_pairs_memory,
+            profile=profile_memory,
+            long_term=long_term_memory,
+            recent=recent_memory,
+        )
+
+    def answer_stream(stream):
+        if RESPONSE_CHAINING:
+            return _ResponseStream(stream, selected_model, user_id, chat_id, len(hist_input) + 2)
+        return _ResponseStream(stream, selected_model)
+
+    context_messages = fit_context(stages) if stages else []
+    print(f"📝 Context loaded: {len(context_messages)} context messages, {len(prompt_messages)} new messages")
+
+    # Agent loop: every round may call several tools, which run concurrently.
+    # The last round may not call tools so the model must answer.
+    # Chained rounds send only what is new since the previous response.
+    round_input = context_messages + prompt_messages
+    sent_bytes = 0
+    for round_no in range(1, MAX_TOOL_ROUNDS + 2):
+        round_start = time.time()
+        request_kwargs = {
+            "model": selected_model,
+            "text": {
+                "verbosity": verbosity
+            },
+            "reasoning": {
+                "effort": reasoning_effort
+            },
+            "instructions": prompt,
+            "input": round_input,
+        }
+        # Tool schemas are part of the cached prefix, so the last round keeps them and disables calls instead
+        request_kwargs["tools"] = tools_description + [{ "type": "web_search_preview" }]
+        if round_no > MAX_TOOL_ROUNDS:
+            request_kwargs["tool_choice"] = "none"
+        if RESPONSE_CHAINING:
+            request_kwargs["store"] = True
+            # Let the server drop the oldest chained items instead of failing on long chats
+            request_kwargs["truncation"] = "auto"
+            if previous_response_id:
+                request_kwargs["previous_response_id"] = previous_response_id
+
+        sent_bytes += _request_bytes(request_kwargs)
+        try:
+            stream = await openai.responses.create(stream=True, **request_kwargs)
+        except (NotFoundError, BadRequestError) as e:
+            if not (chained and round_no == 1):
+                raise
+            # Chain missing or expired on the server: rebuild the full context once
+            print(f"⚠️ Response chain unavailable ({str(e)}), resending full context")
+            metrics.incr("llm.chain_expired")
+            chained = False
+            context_messages = fit_context(await _context_stages(user_message, user_id, hist_input, chat_id, timings))
+            round_input = context_messages + prompt_messages
+            request_kwargs["input"] = round_input
+            del request_kwargs["previous_response_id"]
+            sent_bytes += _request_bytes(request_kwargs)
+            stream = await openai.responses.create(stream=True, **request_kwargs)
+
+        final_tool_calls = []
+        async for event in stream:
+            print(event.type)
+            if event.type == 'response.created':
+                response_id = event.response.id
+            elif event.type == 'response.completed':
+                await _record_usage(event.response.usage, selected_model)
+            if event.type == 'response.content_part.added':
+                # The round produced text, thus directly return the stream object
+                _report_round(round_no, 0, time.time() - round_start)
+                _report_turn_bytes(sent_bytes, chained)
+                return answer_stream(stream), tool_used
+            if event.type == 'response.output_item.added':
+                final_tool_calls.append(event.item)
+            elif event.type == 'response.function_call_arguments.delta':
+                index = event.output_index
+                if final_tool_calls[index]:
+                    final_tool_calls[index].arguments += event.delta
+
+        print(f"Final Tool call: {final_tool_calls}")
+
+        function_calls = []
+        for tool_call in final_tool_calls:
+            print(tool_call.type)
+            if tool_call.type == "reasoning":
+                prompt_messages.append(tool_call)
+            if tool_call.type == "function_call":
+                function_calls.append(tool_call)
+
+        results = await asyncio.gather(*[_run_tool_call(tool_call) for tool_call in function_calls])
+        outputs = []
+        for tool_call, result in zip(function_calls, results):
+            outputs.append({
                 "type": "function_call_output",
-                "call_id": call_id,
+                "call_id": tool_call.call_id,
                 "output": str(result)
             })
+            prompt_messages.append(tool_call)
+            prompt_messages.append(outputs[-1])
+            tool_used.append({"name":f"{tool_call.name}", "arguments":f"{tool_call.arguments}"})
 
-            tool_used.append({"name":f"{name}", "arguments":f"{arguments}"})
-            print(f"Calling function: {name} with arguments: {arguments}")
-
-    # Return empty stream
-    stream = await openai.responses.create(
-        model=selected_model,
-        text={"verbosity": verbosity},
-        reasoning={"effort": reasoning_effort},
-        instructions= f"Current Tokyo time is {get_current_time()}. " + prompt,
-        input= short_term_memory + long_term_memory + prompt_messages,
-        stream=True,
-    )
-    return stream, tool_used
\ No newline at end of file
+        if RESPONSE_CHAINING:
+            # The stored response already holds the calls, send only their outputs
+            previous_response_id = response_id
+            round_input = outputs
+        else:
+            round_input = context_messages + prompt_messages
+
+        _report_round(round_no, len(function_calls), time.time() - round_start)
+
+    # Tool-less final round ended without text, return the (empty) stream
+    _report_turn_bytes(sent_bytes, chained)
+    return answer_stream(stream), tool_used
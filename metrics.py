@@ -0,0 +1,42 @@
+"""
+Process-wide counters and timings.
+
+Modules record into here next to their usual print() logging; snapshot()
+returns everything for dashboards or a debug command.
+"""
+import threading
+
+_lock = threading.Lock()
+_counters: dict[str, float] = {}
+_observations: dict[str, dict] = {}
+
+def incr(name: str, n: float = 1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+def gauge(name: str, value: float):
+    with _lock:
+        _counters[name] = value
+
+def observe(name: str, value: float):
+    """Record one sample (latency, size, ...) keeping count/sum/last/max."""
+    with _lock:
+        stat = _observations.setdefault(name, {"count": 0, "sum": 0.0, "last": 0.0, "max": 0.0})
+        stat["count"] += 1
+        stat["sum"] += value
+        stat["last"] = value
+        stat["max"] = max(stat["max"], value)
+
+def ratio(hits: str, misses: str) -> float:
+    with _lock:
+        h = _counters.get(hits, 0)
+        m = _counters.get(misses, 0)
+    return h / (h + m) if h + m else 0.0
+
+def snapshot() -> dict:
+    with _lock:
+        observations = {
+            name: dict(stat, avg=stat["sum"] / stat["count"] if stat["count"] else 0.0)
+            for name, stat in _observations.items()
+        }
+        return {"counters": dict(_counters), "observations": observations}
@@ -0,0 +1,195 @@
+"""
+Offline rebuild of every user's profile through the Batch API.
+
+    python profile_batch.py [--local DIR [--fixture FILE]] [--input PATH] [--poll-interval SECONDS]
+
+Builds one profile-extraction request per user from all of their stored
+chats (oldest chat first, so the latest messages come last), submits them as a single batch and writes each resulting profile
+atomically through the storage backend. `--local DIR` swaps the Batch
+endpoint for a file-based stand-in (answers come from `--fixture`, a JSONL of
+{"custom_id", "text"} lines, or default to the user's current profile) so
+the whole pipeline can be exercised without network access.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+from openai import OpenAI
+from dotenv import load_dotenv
+from storage import get_storage
+from hist import (
+    PROFILE_MODEL,
+    _history_view,
+    _profile_history_blob,
+    _profile_prompt,
+    _normalize_profile_sections,
+    _save_profile_sections,
+)
+
+load_dotenv()
+
+BATCH_ENDPOINT = "/v1/responses"
+CUSTOM_ID_PREFIX = "profile:"
+
+def build_requests(storage) -> tuple[list, dict]:
+    """Return (batch request lines, user_id -> number of source messages)."""
+    lines = []
+    sources = {}
+    for user_id in storage.list_users():
+        hist = []
+        chat_ids = sorted(storage.list_chats(user_id), key=lambda chat_id: storage.chat_updated_at(user_id, chat_id))
+        for chat_id in chat_ids:
+            hist += storage.read_messages(user_id, chat_id)
+        hist_cleaned = _history_view(hist)
+        history_blob = _profile_history_blob(hist_cleaned)
+        if not history_blob:
+            continue
+        lines.append({
+            "custom_id": f"{CUSTOM_ID_PREFIX}{user_id}",
+            "method": "POST",
+            "url": BATCH_ENDPOINT,
+            "body": {
+                "model": PROFILE_MODEL,
+                "reasoning": {"effort": "low"},
+                "text": {"verbosity": "low"},
+                "input": [{"role": "user", "content": _profile_prompt(history_blob)}],
+            },
+        })
+        sources[str(user_id)] = len(hist_cleaned)
+    return lines, sources
+
+def write_jsonl(path: str, lines: list):
+    parent = os.path.dirname(path)
+    if parent:
+        os.makedirs(parent, exist_ok=True)
+    with open(path, "w") as f:
+        for line in lines:
+            f.write(json.dumps(line, ensure_ascii=False) + "\n")
+
+class OpenAIBatchBackend:
+    """Uploads the input file and runs it on the Batch endpoint."""
+
+    def __init__(self, poll_interval: float = 30):
+        self.client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+        self.poll_interval = poll_interval
+
+    def run(self, input_path: str) -> str:
+        with open(input_path, "rb") as f:
+            batch_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window="24h",
+        )
+        print(f"📦 Submitted batch {batch.id}")
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            time.sleep(self.poll_interval)
+            batch = self.client.batches.retrieve(batch.id)
+            print(f"⏳ Batch {batch.id}: {batch.status} {batch.request_counts}")
+        if batch.status != "completed" or not batch.output_file_id:
+            raise RuntimeError(f"Batch {batch.id} ended with status {batch.status}")
+        return self.client.files.content(batch.output_file_id).text
+
+class LocalBatchBackend:
+    """File-based stand-in for the Batch endpoint, for testing."""
+
+    def __init__(self, root: str, fixture_path: str = None, storage=None):
+        self.root = root
+        self.fixture = {}
+        self.storage = storage or get_storage()
+        if fixture_path:
+            with open(fixture_path) as f:
+                for line in f:
+                    if line.strip():
+                        item = json.loads(line)
+                        self.fixture[item["custom_id"]] = item["text"]
+
+    def _answer(self, custom_id: str) -> str:
+        if custom_id in self.fixture:
+            return self.fixture[custom_id]
+        profile = self.storage.load_profile(custom_id[len(CUSTOM_ID_PREFIX):])
+        return json.dumps({k: v for k, v in profile.items() if k != "meta"}, ensure_ascii=False)
+
+    def run(self, input_path: str) -> str:
+        batch_id = f"batch_local_{uuid.uuid4().hex[:12]}"
+        batch_dir = os.path.join(self.root, batch_id)
+        os.makedirs(batch_dir, exist_ok=True)
+        output_lines = []
+        with open(input_path) as f:
+            requests = [json.loads(line) for line in f if line.strip()]
+        write_jsonl(os.path.join(batch_dir, "input.jsonl"), requests)
+        for request in requests:
+            output_lines.append({
+                "id": f"{batch_id}_{len(output_lines)}",
+                "custom_id": request["custom_id"],
+                "response": {
+                    "status_code": 200,
+                    "body": {"output": [{"type": "message", "content": [
+                        {"type": "output_text", "text": self._answer(request["custom_id"])}
+                    ]}]},
+                },
+                "error": None,
+            })
+        output_path = os.path.join(batch_dir, "output.jsonl")
+        write_jsonl(output_path, output_lines)
+        print(f"📦 Local batch {batch_id}: {len(output_lines)} requests -> {output_path}")
+        with open(output_path) as f:
+            return f.read()
+
+def _output_text(body: dict) -> str:
+    if body.get("output_text"):
+        return body["output_text"]
+    parts = []
+    for item in body.get("output", []):
+        if item.get("type") == "message":
+            parts += [c.get("text", "") for c in item.get("content", []) if c.get("type") == "output_text"]
+    return "".join(parts)
+
+def apply_results(output_text: str, sources: dict) -> tuple[int, int]:
+    """Write every successful profile. Returns (written, failed)."""
+    written = failed = 0
+    for line in output_text.splitlines():
+        if not line.strip():
+            continue
+        result = json.loads(line)
+        user_id = result["custom_id"][len(CUSTOM_ID_PREFIX):]
+        response = result.get("response") or {}
+        try:
+            if result.get("error") or response.get("status_code") != 200:
+                raise RuntimeError(result.get("error") or response.get("status_code"))
+            sections = _normalize_profile_sections(json.loads(_output_text(response["body"])))
+            _save_profile_sections(user_id, sections, sources.get(user_id, 0))
+            written += 1
+        except Exception as e:
+            print(f"⚠️ Profile rebuild failed for user {user_id} ({str(e)})")
+            failed += 1
+    return written, failed
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Rebuild all user profiles through the Batch API.")
+    parser.add_argument("--input", default="profile_batches/input.jsonl")
+    parser.add_argument("--local", metavar="DIR", help="use the file-based stand-in in DIR instead of the Batch endpoint")
+    parser.add_argument("--fixture", help="JSONL of {custom_id, text} answers for --local")
+    parser.add_argument("--poll-interval", type=float, default=30)
+    args = parser.parse_args(argv)
+
+    storage = get_storage()
+    lines, sources = build_requests(storage)
+    if not lines:
+        print("No users with messages found.")
+        return 0
+    write_jsonl(args.input, lines)
+    print(f"📝 Wrote {len(lines)} profile requests to {args.input}")
+
+    if args.local:
+        backend = LocalBatchBackend(args.local, args.fixture, storage)
+    else:
+        backend = OpenAIBatchBackend(args.poll_interval)
+    written, failed = apply_results(backend.run(args.input), sources)
+    print(f"✅ Profiles rebuilt: {written} written, {failed} failed")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,153 @@
+"""
+Debounced background profile maintenance.
+
+Turns hand their new messages to schedule_profile_update() and return
+immediately. A worker thread with its own event loop (so it outlives
+Streamlit's per-run asyncio.run) merges them into the stored profile once a
+user has PROFILE_UPDATE_EVERY new messages or has been idle for
+PROFILE_IDLE_SECONDS. Messages arriving while a run is in flight are
+coalesced into the next run. A failed run keeps its messages pending and is
+retried after PROFILE_IDLE_SECONDS; at exit, flush() merges whatever is still
+pending (for up to PROFILE_FLUSH_SECONDS). Other background jobs (chat
+compaction) share the same loop through run_in_background().
+"""
+import os
+import atexit
+import asyncio
+import threading
+from openai import AsyncOpenAI
+import metrics
+from hist import update_profile_incremental
+
+PROFILE_UPDATE_EVERY = int(os.environ.get("PROFILE_UPDATE_EVERY", "6"))
+PROFILE_IDLE_SECONDS = float(os.environ.get("PROFILE_IDLE_SECONDS", "60"))
+PROFILE_FLUSH_SECONDS = float(os.environ.get("PROFILE_FLUSH_SECONDS", "30"))
+
+_loop = None
+_client = None
+_states: dict = {}
+_start_lock = threading.Lock()
+_flushing = False
+
+def _ensure_worker():
+    with _start_lock:
+        if _loop is not None:
+            return
+        ready = threading.Event()
+
+        def run():
+            global _loop, _client
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            # The async client is bound to the loop that uses it
+            _client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+            _loop = loop
+            ready.set()
+            loop.run_forever()
+
+        threading.Thread(target=run, name="profile-jobs", daemon=True).start()
+        ready.wait()
+        atexit.register(flush)
+
+def schedule_profile_update(user_id, new_messages: list):
+    """Queue messages from a finished turn for the user's next profile merge (non-blocking)."""
+    _ensure_worker()
+    _loop.call_soon_threadsafe(_on_new_messages, user_id, list(new_messages))
+
+def run_in_background(job, *args):
+    """Run `await job(*args, client=...)` on the worker loop with its OpenAI client (non-blocking)."""
+    _ensure_worker()
+    _loop.call_soon_threadsafe(lambda: _loop.create_task(job(*args, client=_client)))
+
+def _state(user_id) -> dict:
+    return _states.setdefault(user_id, {"pending": [], "timer": None, "running": False, "task": None})
+
+def _on_new_messages(user_id, new_messages: list):
+    state = _state(user_id)
+    state["pending"] += new_messages
+    if _flushing:
+        # flush() picks the messages up
+        return
+    if state["running"]:
+        metrics.incr("profile_jobs.coalesced")
+        return
+    if state["timer"] is not None:
+        state["timer"].cancel()
+        state["timer"] = None
+    if not state["pending"]:
+        return
+
+    if len(state["pending"]) >= PROFILE_UPDATE_EVERY:
+        _start_run(user_id)
+    else:
+        # Wait for more messages or for the user to go idle
+        if new_messages:
+            metrics.incr("profile_jobs.skipped")
+        state["timer"] = _loop.call_later(PROFILE_IDLE_SECONDS, _start_run, user_id)
+
+def _start_run(user_id):
+    state = _state(user_id)
+    state["timer"] = None
+    if state["running"] or not state["pending"]:
+        return
+    batch, state["pending"] = state["pending"], []
+    state["running"] = True
+    state["task"] = _loop.create_task(_run(user_id, batch))
+
+async def _run(user_id, batch: list):
+    state = _state(user_id)
+    updated = False
+    try:
+        metrics.incr("profile_jobs.runs")
+        updated = await update_profile_incremental(user_id, batch, client=_client)
+    except Exception as e:
+        print(f"⚠️ Profile update failed for user {user_id} ({str(e)})")
+    finally:
+        state["running"] = False
+        if updated:
+            # Re-check anything that arrived during the run
+            _on_new_messages(user_id, [])
+        elif _flushing:
+            print(f"⚠️ Dropping {len(batch)} profile messages of user {user_id} at exit")
+        else:
+            # Keep the batch (older messages first) and retry once the user is idle
+            metrics.incr("profile_jobs.failed")
+            state["pending"] = batch + state["pending"]
+            if state["timer"] is not None:
+                state["timer"].cancel()
+            state["timer"] = _loop.call_later(PROFILE_IDLE_SECONDS, _start_run, user_id)
+
+async def _flush_all():
+    global _flushing
+    _flushing = True
+    while True:
+        running = [state["task"] for state in _states.values() if state["running"]]
+        if running:
+            await asyncio.wait(running)
+            continue
+        users = [user_id for user_id, state in _states.items() if state["pending"]]
+        if not users:
+            return
+        for user_id in users:
+            if _states[user_id]["timer"] is not None:
+                _states[user_id]["timer"].cancel()
+            _start_run(user_id)
+
+def flush(timeout: float = PROFILE_FLUSH_SECONDS):
+    """Merge every pending batch now instead of waiting for the debounce (run at exit)."""
+    if _loop is None or not any(state["pending"] or state["running"] for state in _states.values()):
+        return
+    try:
+        asyncio.run_coroutine_threadsafe(_flush_all(), _loop).result(timeout)
+    except Exception as e:
+        print(f"⚠️ Profile flush did not finish ({str(e) or type(e).__name__})")
+
+def stats() -> dict:
+    counters = metrics.snapshot()["counters"]
+    return {
+        "runs": counters.get("profile_jobs.runs", 0),
+        "skipped": counters.get("profile_jobs.skipped", 0),
+        "coalesced": counters.get("profile_jobs.coalesced", 0),
+        "failed": counters.get("profile_jobs.failed", 0),
+        "pending_users": sum(1 for state in _states.values() if state["pending"]),
+    }
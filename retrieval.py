@@ -0,0 +1,242 @@
+"""
+Per-chat local retrieval index over conversation pairs.
+
+Long-term memory used to be selected by asking gpt-5-nano about every older
+pair on every turn. This keeps a BM25 index per chat next to the history file
+(`history/<user>/index_<chat>.jsonl`, one line per pair, append-only) and
+optionally an embedding per pair (`emb_<chat>.jsonl`, stored with the pair
+hash and recomputed when the pair changes), so selection is a
+local top-k lookup.
+"""
+import os
+import re
+import json
+import math
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+EMBEDDING_MODEL = "text-embedding-3-small"
+HYBRID_MIN_SCORE = 0.35
+INDEX_CACHE_SIZE = 64            # chat indexes kept in memory
+
+LATIN_TOKEN_RE = re.compile(r"[a-z0-9_]+")
+CJK_RUN_RE = re.compile(r"[぀-ヿ㐀-䶿一-鿿가-힯]+")
+STOPWORDS = {
+    "a", "an", "the", "and", "or", "but", "is", "are", "was", "were", "be", "to", "of", "in",
+    "on", "for", "with", "at", "by", "it", "this", "that", "i", "you", "me", "my", "your",
+    "we", "do", "does", "did", "can", "could", "would", "should", "what", "how", "please",
+}
+
+_lock = threading.Lock()
+_indexes: "OrderedDict[tuple, dict]" = OrderedDict()
+
+def tokenize(text: str) -> list:
+    text = (text or "").lower()
+    tokens = [t for t in LATIN_TOKEN_RE.findall(text) if t not in STOPWORDS]
+    # CJK has no spaces: index single characters plus bigrams
+    for run in CJK_RUN_RE.findall(text):
+        tokens.extend(run)
+        tokens.extend(run[i:i+2] for i in range(len(run) - 1))
+    return tokens
+
+def index_path(user_id, chat_id) -> str:
+    return f"history/{user_id}/index_{chat_id}.jsonl"
+
+def embedding_path(user_id, chat_id) -> str:
+    return f"history/{user_id}/emb_{chat_id}.jsonl"
+
+def _new_index(size: int = 0) -> dict:
+    return {"docs": [], "hashes": [], "df": {}, "total_len": 0, "size": size}
+
+def _text_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:12]
+
+def _add_doc(index: dict, record: dict):
+    tf = record["tf"]
+    index["docs"].append(tf)
+    index["hashes"].append(record["h"])
+    index["total_len"] += sum(tf.values())
+    for term in tf:
+        index["df"][term] = index["df"].get(term, 0) + 1
+
+def _term_freq(text: str) -> dict:
+    tf = {}
+    for token in tokenize(text):
+        tf[token] = tf.get(token, 0) + 1
+    return tf
+
+def _load(user_id, chat_id) -> dict:
+    """Return the cached index, reloading it if the file changed underneath us."""
+    path = index_path(user_id, chat_id)
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    key = (str(user_id), str(chat_id))
+    index = _indexes.get(key)
+    if index is not None and index["size"] == size:
+        _indexes.move_to_end(key)
+        return index
+
+    index = _new_index(size)
+    if size:
+        with open(path) as f:
+            for line in f:
+                try:
+                    _add_doc(index, json.loads(line))
+                except json.JSONDecodeError:
+                    # Torn trailing line from an interrupted write, rebuilt on next update
+                    break
+    _indexes[key] = index
+    _indexes.move_to_end(key)
+    while len(_indexes) > INDEX_CACHE_SIZE:
+        _indexes.popitem(last=False)
+    return index
+
+def _truncate(path: str, index: dict, keep: int) -> dict:
+    """Index of the first `keep` pairs only, with the file rewritten to match."""
+    truncated = _new_index()
+    records = [{"h": h, "tf": tf} for h, tf in zip(index["hashes"][:keep], index["docs"][:keep])]
+    if not records:
+        if os.path.exists(path):
+            os.remove(path)
+        return truncated
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            _add_doc(truncated, record)
+    os.replace(tmp_path, path)
+    truncated["size"] = os.path.getsize(path)
+    return truncated
+
+def update_index(user_id, chat_id, pair_texts: list) -> dict:
+    """
+    Bring the index in line with `pair_texts` (text of every complete pair, oldest first).
+    Appends only the new pairs; pairs from the first one that no longer matches
+    (history shrank, edited, deleted and recreated) are dropped and re-indexed.
+    """
+    with _lock:
+        index = _load(user_id, chat_id)
+        path = index_path(user_id, chat_id)
+        indexed = len(index["docs"])
+        keep = 0
+        while keep < min(indexed, len(pair_texts)) and index["hashes"][keep] == _text_hash(pair_texts[keep]):
+            keep += 1
+        if keep < indexed:
+            index = _truncate(path, index, keep)
+            _indexes[(str(user_id), str(chat_id))] = index
+        new_texts = pair_texts[len(index["docs"]):]
+        if not new_texts:
+            return index
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "a") as f:
+            for text in new_texts:
+                record = {"h": _text_hash(text), "tf": _term_freq(text)}
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                _add_doc(index, record)
+        index["size"] = os.path.getsize(path)
+        return index
+
+def search(index: dict, query: str, candidates: int, top_k: int) -> list:
+    """
+    BM25 over the first `candidates` pairs.
+
+    Returns:
+        List of (pair_index, score), best first, only pairs sharing a term with the query
+    """
+    docs = index["docs"][:candidates]
+    if not docs:
+        return []
+    n_docs = len(index["docs"])
+    avg_len = index["total_len"] / n_docs if n_docs else 0
+    query_terms = set(tokenize(query))
+
+    scored = []
+    for i, tf in enumerate(docs):
+        doc_len = sum(tf.values())
+        score = 0.0
+        for term in query_terms:
+            freq = tf.get(term)
+            if not freq:
+                continue
+            df = index["df"].get(term, 0)
+            idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_len / avg_len) if avg_len else BM25_K1
+            score += idf * freq * (BM25_K1 + 1) / (freq + norm)
+        if score > 0:
+            scored.append((i, score))
+    scored.sort(key=lambda item: item[1], reverse=True)
+    return scored[:top_k]
+
+def _cosine(a: list, b: list) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+def load_embeddings(user_id, chat_id) -> list:
+    """Stored {"h": pair hash, "v": vector} records, in pair order."""
+    path = embedding_path(user_id, chat_id)
+    records = []
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                # Vectors stored before hashes were recorded cannot be validated
+                records.append(record if isinstance(record, dict) else {"h": None, "v": record})
+    return records
+
+def _valid_embeddings(user_id, chat_id, pair_texts: list) -> list:
+    """Stored records that still match their pairs; a stale tail is cut from the file."""
+    records = load_embeddings(user_id, chat_id)
+    keep = 0
+    while keep < min(len(records), len(pair_texts)) and records[keep]["h"] == _text_hash(pair_texts[keep]):
+        keep += 1
+    if keep < len(records):
+        # Edited or recreated chat: later vectors belong to other pairs
+        path = embedding_path(user_id, chat_id)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for record in records[:keep]:
+                f.write(json.dumps(record) + "\n")
+        os.replace(tmp_path, path)
+    return records[:keep]
+
+def _append_embeddings(user_id, chat_id, records: list):
+    path = embedding_path(user_id, chat_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+async def ensure_embeddings(client, user_id, chat_id, pair_texts: list) -> list:
+    """Embed pairs that have no matching vector yet (computed once per pair) and return all vectors."""
+    records = await asyncio.to_thread(_valid_embeddings, user_id, chat_id, pair_texts)
+    missing = pair_texts[len(records):]
+    if missing:
+        response = await client.embeddings.create(model=EMBEDDING_MODEL, input=[t or " " for t in missing])
+        new_records = [{"h": _text_hash(text), "v": item.embedding} for text, item in zip(missing, response.data)]
+        await asyncio.to_thread(_append_embeddings, user_id, chat_id, new_records)
+        records += new_records
+    return [record["v"] for record in records]
+
+async def hybrid_search(client, user_id, chat_id, index: dict, pair_texts: list, query: str, candidates: int, top_k: int) -> list:
+    """BM25 blended with embedding cosine similarity (both scaled to 0..1)."""
+    vectors = await ensure_embeddings(client, user_id, chat_id, pair_texts)
+    response = await client.embeddings.create(model=EMBEDDING_MODEL, input=[query or " "])
+    query_vector = response.data[0].embedding
+
+    bm25 = dict(search(index, query, candidates, candidates))
+    top_bm25 = max(bm25.values()) if bm25 else 0.0
+    scored = []
+    for i in range(min(candidates, len(vectors))):
+        lexical = bm25.get(i, 0.0) / top_bm25 if top_bm25 else 0.0
+        scored.append((i, 0.5 * lexical + 0.5 * _cosine(vectors[i], query_vector)))
+    scored = [item for item in scored if item[1] >= HYBRID_MIN_SCORE]
+    scored.sort(key=lambda item: item[1], reverse=True)
+    return scored[:top_k]
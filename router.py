@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+"""
+Local model router.
+
+Picks (model, reasoning, verbosity) for a message with a small deterministic
+classifier, so most requests never pay the extra round trip to the remote
+nano-model selector. The remote selector is only consulted when the local
+decision has low confidence, and every remote decision is logged so the
+thresholds can be re-learned with `python router.py learn`.
+"""
+import os
+import re
+import sys
+import json
+import time
+from collections import OrderedDict
+
+# Model configuration
+MODEL_NANO = "gpt-5-nano"    # High-throughput tasks, simple instruction-following or classification
+MODEL_MINI = "gpt-5-mini"    # Cost-optimized reasoning and chat; balances speed, cost, and capability
+MODEL_STANDARD = "gpt-5.1"   # Complex reasoning, broad world knowledge, code-heavy or multi-step agentic tasks
+
+# "local": local classifier, remote fallback on low confidence
+# "local_only": never call the remote selector
+# "remote": always call the remote selector (previous behaviour)
+ROUTER_MODE = os.environ.get("ROUTER_MODE", "local")
+ROUTER_CACHE_SIZE = 512
+ROUTER_LOG_FILE = "history/router_log.jsonl"
+ROUTER_THRESHOLDS_FILE = "history/router_thresholds.json"
+ROUTER_MIN_SAMPLES = 20      # minimum logged decisions before a threshold is re-learned
+
+# Mirrors the guideline table of the remote selection prompt
+TIERS = {
+    "greeting": (MODEL_NANO, "minimal", "low"),
+    "simple":   (MODEL_NANO, "minimal", "low"),
+    "chat":     (MODEL_MINI, "minimal", "medium"),
+    "tool":     (MODEL_MINI, "low", "low"),
+    "explain":  (MODEL_MINI, "low", "medium"),
+    "analysis": (MODEL_STANDARD, "medium", "medium"),
+    "code":     (MODEL_STANDARD, "high", "medium"),
+}
+
+DEFAULT_THRESHOLDS = {
+    "short_chars": 50,        # below this a plain message is a simple query
+    "long_chars": 600,        # above this a message is treated as analysis
+    "min_confidence": 0.6,    # below this the remote selector decides
+    # Prior confidence of each local rule, re-calibrated by `learn`
+    "rule_confidence": {
+        "code_fence": 0.95,
+        "code_hint": 0.75,
+        "greeting": 0.95,
+        "url": 0.9,
+        "tool_hint": 0.8,
+        "analysis_hint": 0.75,
+        "image": 0.7,
+        "long": 0.65,
+        "short": 0.7,
+        "default": 0.5,
+    },
+}
+
+GREETING_RE = re.compile(
+    r"^(hi|hello|hey|yo|thanks|thank you|thx|ok|okay|good (morning|night|evening)|bye|"
+    r"你好|您好|谢谢|早上好|晚安|こんにちは|ありがとう|おはよう)[\s!.?。！？~]*$",
+    re.IGNORECASE,
+)
+URL_RE = re.compile(r"https?://\S+|www\.\S+", re.IGNORECASE)
+CODE_HINT_RE = re.compile(
+    r"\b(def|class|import|function|return|traceback|exception|stack trace|segfault|"
+    r"compile|debug|refactor|regex|sql|python|javascript|typescript|rust|golang|java)\b|[{};]\s*$",
+    re.IGNORECASE | re.MULTILINE,
+)
+TOOL_HINT_RE = re.compile(
+    r"\b(weather|forecast|temperature|search|look up|latest|news|today|youtube|transcribe)\b|"
+    r"天气|搜索|新闻|天気|検索",
+    re.IGNORECASE,
+)
+ANALYSIS_HINT_RE = re.compile(
+    r"\b(compare|analy[sz]e|trade-?offs?|pros and cons|step by step|prove|derive|design|"
+    r"architecture|strategy|evaluate|why does|plan)\b|比较|分析|为什么|比較|なぜ",
+    re.IGNORECASE,
+)
+CJK_RE = re.compile(r"[぀-ヿ㐀-䶿一-鿿가-힯]")
+
+_decision_cache: "OrderedDict[tuple, tuple[str, str, str]]" = OrderedDict()
+_thresholds = None
+
+
+def normalize_message(user_message: str) -> str:
+    """Lowercase, collapse whitespace and drop trailing punctuation."""
+    text = " ".join(str(user_message or "").lower().split())
+    return text.rstrip(" !.?。！？~")
+
+
+def extract_features(user_message: str, has_image: bool = False) -> dict:
+    text = str(user_message or "")
+    stripped = text.strip()
+    cjk_chars = len(CJK_RE.findall(stripped))
+    return {
+        "length": len(stripped),
+        "lines": stripped.count("\n") + 1 if stripped else 0,
+        "code_fence": "```" in stripped,
+        "code_hint": bool(CODE_HINT_RE.search(stripped)),
+        "urls": len(URL_RE.findall(stripped)),
+        "youtube": "youtu" in stripped.lower(),
+        "has_image": bool(has_image),
+        "greeting": bool(GREETING_RE.match(stripped)),
+        "tool_hint": bool(TOOL_HINT_RE.search(stripped)),
+        "analysis_hint": bool(ANALYSIS_HINT_RE.search(stripped)),
+        "question": "?" in stripped or "？" in stripped,
+        "language": "cjk" if stripped and cjk_chars / len(stripped) > 0.3 else "latin",
+    }
+
+
+def _effective_length(features: dict) -> float:
+    # CJK packs roughly three latin characters of meaning into one
+    if features["language"] == "cjk":
+        return features["length"] * 3
+    return features["length"]
+
+
+def classify(features: dict, thresholds: dict = None) -> tuple[str, str, float]:
+    """
+    Map features to a tier.
+
+    Returns:
+        Tuple of (tier, rule, confidence)
+    """
+    thresholds = thresholds or load_thresholds()
+    confidence = thresholds["rule_confidence"]
+    length = _effective_length(features)
+
+    if features["code_fence"]:
+        rule, tier = "code_fence", "code"
+    elif features["greeting"]:
+        rule, tier = "greeting", "greeting"
+    elif features["urls"]:
+        rule, tier = "url", "tool"
+    elif features["code_hint"] and length >= thresholds["short_chars"]:
+        rule, tier = "code_hint", "code"
+    elif features["analysis_hint"] or length >= thresholds["long_chars"]:
+        rule = "analysis_hint" if features["analysis_hint"] else "long"
+        tier = "analysis"
+    elif features["has_image"]:
+        rule, tier = "image", "explain"
+    elif features["tool_hint"]:
+        rule, tier = "tool_hint", "tool"
+    elif length < thresholds["short_chars"]:
+        rule, tier = "short", "simple"
+    else:
+        rule, tier = "default", "chat"
+    return tier, rule, confidence.get(rule, DEFAULT_THRESHOLDS["rule_confidence"]["default"])
+
+
+def finalize_selection(model: str, reasoning: str, verbosity: str, has_tools: bool = True) -> tuple[str, str, str]:
+    """Validate a (model, reasoning, verbosity) selection and log it."""
+    if model not in [MODEL_NANO, MODEL_MINI, MODEL_STANDARD]:
+        model = MODEL_MINI  # Default to balanced model
+
+    # Validate reasoning based on model
+    if model == MODEL_STANDARD:
+        # gpt-5.1 supports none, minimal, low, medium, high
+        if reasoning not in ["none", "minimal", "low", "medium", "high"]:
+            reasoning = "none"
+    else:
+        # nano and mini only support minimal, low, medium, high (no "none")
+        if reasoning not in ["minimal", "low", "medium", "high"]:
+            reasoning = "minimal"
+
+    if verbosity not in ["low", "medium", "high"]:
+        verbosity = "medium"
+
+    # IMPORTANT: web_search tool requires reasoning >= "low"
+    # If reasoning is "minimal" or "none", upgrade to "low" when tools are available
+    if has_tools and reasoning in ["minimal", "none"]:
+        reasoning = "low"
+        print(f"⚠️ Upgraded reasoning to 'low' (required for web_search tool)")
+
+    # Determine emoji based on model and reasoning level
+    emoji_map = {
+        (MODEL_NANO, "minimal"): "⚡",
+        (MODEL_NANO, "low"): "⚡",
+        (MODEL_MINI, "minimal"): "💬",
+        (MODEL_MINI, "low"): "🔧",
+        (MODEL_STANDARD, "none"): "⚡",  # fastest option for 5.1
+        (MODEL_STANDARD, "minimal"): "📊",
+        (MODEL_STANDARD, "low"): "⚙️",
+        (MODEL_STANDARD, "medium"): "🧠",
+        (MODEL_STANDARD, "high"): "💻",
+    }
+    emoji = emoji_map.get((model, reasoning), "📊")
+
+    print(f"{emoji} Model: {model} | Reasoning: {reasoning} | Verbosity: {verbosity}")
+    return model, reasoning, verbosity
+
+
+def load_thresholds() -> dict:
+    global _thresholds
+    if _thresholds is None:
+        thresholds = json.loads(json.dumps(DEFAULT_THRESHOLDS))
+        if os.path.exists(ROUTER_THRESHOLDS_FILE):
+            try:
+                with open(ROUTER_THRESHOLDS_FILE) as f:
+                    learned = json.load(f)
+                rule_confidence = learned.pop("rule_confidence", {})
+                thresholds.update(learned)
+                thresholds["rule_confidence"].update(rule_confidence)
+            except Exception as e:
+                print(f"⚠️ Failed to load router thresholds ({str(e)}), using defaults")
+        _thresholds = thresholds
+    return _thresholds
+
+
+def _log_decision(features: dict, rule: str, confidence: float, selection: tuple, source: str):
+    try:
+        os.makedirs(os.path.dirname(ROUTER_LOG_FILE), exist_ok=True)
+        with open(ROUTER_LOG_FILE, "a") as f:
+            f.write(json.dumps({
+                "ts": time.time(),
+                "features": features,
+                "rule": rule,
+                "confidence": confidence,
+                "selection": list(selection),
+                "source": source,
+            }, ensure_ascii=False) + "\n")
+    except Exception:
+        # Logging must never break the chat flow
+        pass
+
+
+def _cache_put(key: tuple, selection: tuple):
+    _decision_cache[key] = selection
+    _decision_cache.move_to_end(key)
+    while len(_decision_cache) > ROUTER_CACHE_SIZE:
+        _decision_cache.popitem(last=False)
+
+
+async def route(user_message: str, has_image: bool = False, has_tools: bool = True, fallback=None) -> tuple[str, str, str]:
+    """
+    Select (model, reasoning, verbosity) for a message.
+
+    Args:
+        user_message: The user's input message
+        has_image: Whether an image is attached to the request
+        has_tools: Whether tools are available for this request
+        fallback: Remote selector coroutine `(user_message, has_tools) -> tuple`,
+            consulted only when the local decision has low confidence; it
+            returns None on failure, and the local decision is used uncached
+
+    Returns:
+        Tuple of (model_name, reasoning_effort, verbosity)
+    """
+    thresholds = load_thresholds()
+    features = extract_features(user_message, has_image)
+    tier, rule, confidence = classify(features, thresholds)
+
+    if ROUTER_MODE == "remote" and fallback is not None:
+        # Logged as well: remote decisions are what `learn` calibrates against
+        selection = await fallback(user_message, has_tools=has_tools)
+        if selection is None:
+            return _fallback_error(features, tier, rule, confidence, has_tools)
+        _log_decision(features, rule, confidence, selection, "remote")
+        return selection
+
+    key = (normalize_message(user_message), bool(has_image), bool(has_tools))
+    cached = _decision_cache.get(key)
+    if cached is not None:
+        _decision_cache.move_to_end(key)
+        print(f"🗂️ Router cache hit | Model: {cached[0]} | Reasoning: {cached[1]} | Verbosity: {cached[2]}")
+        return cached
+
+    if confidence >= thresholds["min_confidence"] or fallback is None or ROUTER_MODE == "local_only":
+        print(f"🧭 Local router: {tier} ({rule}, confidence {confidence:.2f})")
+        selection = finalize_selection(*TIERS[tier], has_tools=has_tools)
+        source = "local"
+    else:
+        print(f"🧭 Local router unsure ({rule}, confidence {confidence:.2f}), asking remote selector")
+        selection = await fallback(user_message, has_tools=has_tools)
+        if selection is None:
+            return _fallback_error(features, tier, rule, confidence, has_tools)
+        source = "remote"
+
+    _log_decision(features, rule, confidence, selection, source)
+    _cache_put(key, selection)
+    return selection
+
+
+def _fallback_error(features: dict, tier: str, rule: str, confidence: float, has_tools: bool) -> tuple[str, str, str]:
+    # Nobody decided this: not cached, and logged apart from remote decisions so `learn` skips it
+    print(f"🧭 Remote selector failed, using local router: {tier} ({rule}, confidence {confidence:.2f})")
+    selection = finalize_selection(*TIERS[tier], has_tools=has_tools)
+    _log_decision(features, rule, confidence, selection, "fallback_error")
+    return selection
+
+
+def _agrees(tier: str, selection: list) -> bool:
+    """Whether a logged selection matches the tier; several tiers share (model, verbosity)."""
+    model, _, verbosity = selection
+    t_model, _, t_verbosity = TIERS[tier]
+    return (t_model, t_verbosity) == (model, verbosity)
+
+
+def learn_thresholds(log_path: str = ROUTER_LOG_FILE) -> dict:
+    """
+    Re-learn length thresholds and per-rule confidence from logged remote decisions.
+    Note that logged reasoning has already been upgraded for tools, so tiers are
+    matched on (model, verbosity) only.
+    """
+    records = []
+    with open(log_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get("source") == "remote":
+                records.append(record)
+    if not records:
+        return {}
+
+    plain = [r for r in records if not (r["features"]["code_fence"] or r["features"]["urls"] or r["features"]["has_image"])]
+
+    def best_split(label) -> int:
+        # Pick the length cut that best separates label(r) for short vs long messages
+        lengths = sorted({_effective_length(r["features"]) for r in plain})
+        best_cut, best_correct = None, -1
+        for cut in lengths:
+            correct = sum(1 for r in plain if (_effective_length(r["features"]) < cut) == label(r))
+            if correct > best_correct:
+                best_cut, best_correct = cut, correct
+        return best_cut
+
+    learned = {}
+    if len(plain) >= ROUTER_MIN_SAMPLES:
+        short_cut = best_split(lambda r: r["selection"][0] == MODEL_NANO)
+        long_cut = best_split(lambda r: r["selection"][0] != MODEL_STANDARD)
+        if short_cut is not None:
+            learned["short_chars"] = int(short_cut)
+        if long_cut is not None:
+            learned["long_chars"] = int(max(long_cut, learned.get("short_chars", 0) + 1))
+
+    # Calibrate each rule's confidence to its agreement rate with the remote selector
+    thresholds = json.loads(json.dumps(DEFAULT_THRESHOLDS))
+    thresholds.update(learned)
+    agreement = {}
+    for r in records:
+        tier, rule, _ = classify(r["features"], thresholds)
+        hits, total = agreement.get(rule, (0, 0))
+        agreement[rule] = (hits + _agrees(tier, r["selection"]), total + 1)
+    learned["rule_confidence"] = {
+        rule: round(hits / total, 3) for rule, (hits, total) in agreement.items() if total >= ROUTER_MIN_SAMPLES
+    }
+    return learned
+
+
+if __name__ == "__main__":
+    # python router.py learn [log_path]
+    if len(sys.argv) >= 2 and sys.argv[1] == "learn":
+        log_path = sys.argv[2] if len(sys.argv) > 2 else ROUTER_LOG_FILE
+        learned = learn_thresholds(log_path)
+        if not learned:
+            print("No remote decisions logged yet.")
+            sys.exit(1)
+        os.makedirs(os.path.dirname(ROUTER_THRESHOLDS_FILE), exist_ok=True)
+        with open(ROUTER_THRESHOLDS_FILE, "w") as f:
+            json.dump(learned, f, indent=2)
+        print(f"✅ Router thresholds written to {ROUTER_THRESHOLDS_FILE}: {learned}")
+    else:
+        print("Usage: python router.py learn [log_path]")
@@ -0,0 +1,34 @@
+"""
+Persistence backends for chat state.
+
+STORAGE_BACKEND selects "files" (default, JSON/JSONL files under history/)
+or "sqlite" (one WAL database at SQLITE_PATH, safe for several bot workers
+on the same volume). Use `python -m storage.migrate` to copy files to SQLite.
+Histories are served from an in-process write-behind cache unless
+HISTORY_CACHE=0 (see storage.cache). The cache is not shared between
+processes: when several processes serve the same chats from one backend
+(e.g. SQLite), set HISTORY_CACHE=0.
+"""
+import os
+import threading
+
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "files")
+HISTORY_CACHE = os.environ.get("HISTORY_CACHE", "1") == "1"
+
+_storage = None
+_lock = threading.Lock()
+
+def get_storage():
+    global _storage
+    with _lock:
+        if _storage is None:
+            if STORAGE_BACKEND == "sqlite":
+                from storage.sqlite import SQLiteStorage
+                _storage = SQLiteStorage()
+            else:
+                from storage.files import FileStorage
+                _storage = FileStorage()
+            if HISTORY_CACHE:
+                from storage.cache import CachedStorage
+                _storage = CachedStorage(_storage)
+        return _storage
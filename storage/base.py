@@ -0,0 +1,81 @@
+# Chat list of a user who never saved one (not persisted by reads)
+DEFAULT_CHAT_LIST = ["default"]
+
+class Storage:
+    """
+    Interface shared by the storage backends.
+
+    Messages are the chat history lists used across the app, profiles are the
+    dicts written by hist.update_profile (sections plus "meta"), chat lists are
+    the Streamlit chat names of a user and verified users are Telegram ids.
+    Summaries are the per-chat compaction checkpoints written by compaction.py,
+    chains the last stored Responses API response of a chat (llm.RESPONSE_CHAINING).
+    """
+
+    # Chat history
+    def read_messages(self, user_id, chat_id, last_n: int = None) -> list:
+        raise NotImplementedError
+
+    def write_messages(self, user_id, chat_id, hist: list):
+        """Persist `hist` as the full chat; appending to the stored history must be cheap."""
+        raise NotImplementedError
+
+    def replace_messages(self, user_id, chat_id, hist: list):
+        """Rewrite the whole chat; for edits anywhere in the history (migrations)."""
+        raise NotImplementedError
+
+    def delete_messages(self, user_id, chat_id):
+        raise NotImplementedError
+
+    def list_chats(self, user_id) -> list:
+        """Ids of every chat of the user that has stored messages."""
+        raise NotImplementedError
+
+    def chat_updated_at(self, user_id, chat_id) -> float:
+        """Unix time of the chat's last message write, 0 if unknown."""
+        raise NotImplementedError
+
+    # Compaction summaries
+    def load_summary(self, user_id, chat_id) -> dict:
+        """{"summary", "covered", "covered_hash"} of the chat, or {} if never compacted."""
+        raise NotImplementedError
+
+    def save_summary(self, user_id, chat_id, summary: dict):
+        raise NotImplementedError
+
+    # Response chains
+    def load_chain(self, user_id, chat_id) -> dict:
+        """{"response_id", "covered", "created"} of the chat, or {} if none."""
+        raise NotImplementedError
+
+    def save_chain(self, user_id, chat_id, chain: dict):
+        raise NotImplementedError
+
+    # Profiles
+    def load_profile(self, user_id) -> dict:
+        raise NotImplementedError
+
+    def save_profile(self, user_id, profile: dict):
+        raise NotImplementedError
+
+    # Chat lists
+    def read_chat_list(self, user_id) -> list:
+        """Stored chat names, or DEFAULT_CHAT_LIST if the user has none; never writes."""
+        raise NotImplementedError
+
+    def write_chat_list(self, user_id, chat_list: list):
+        raise NotImplementedError
+
+    # Verified Telegram users
+    def read_verified_users(self) -> list:
+        raise NotImplementedError
+
+    def add_verified_user(self, user_id):
+        raise NotImplementedError
+
+    def verified_users_version(self):
+        """Cheap token that changes whenever the verified users change (see auth.py)."""
+        raise NotImplementedError
+
+    def list_users(self) -> list:
+        raise NotImplementedError
@@ -0,0 +1,232 @@
+"""
+Process-level cache of live conversations with write-behind persistence.
+
+Reads for active chats come from memory; writes update memory and mark the
+chat dirty, and a background thread flushes dirty chats to the wrapped
+backend every FLUSH_INTERVAL seconds and at interpreter exit. Chats are
+evicted least-recently-used once the estimated resident size passes
+HISTORY_CACHE_BYTES; dirty chats stay resident until they are flushed.
+Backend writes of one chat (flush, replace, delete) and the read that loads
+a cold chat are serialized by a per-chat lock, and a flush skips a snapshot
+that was replaced or deleted meanwhile, so an older snapshot never lands
+after a newer change. Cold reads run outside the cache-wide lock, so one
+slow load never stalls other chats.
+
+The cache is per process and never invalidated by other processes: several
+processes may share a backend only if each chat is served by one of them
+(as with bot_worker.py). Otherwise run them with HISTORY_CACHE=0.
+"""
+import os
+import json
+import time
+import atexit
+import threading
+from collections import OrderedDict
+import metrics
+from storage.base import Storage
+
+HISTORY_CACHE_BYTES = int(os.environ.get("HISTORY_CACHE_BYTES", str(64 * 1024 * 1024)))
+FLUSH_INTERVAL = float(os.environ.get("HISTORY_FLUSH_INTERVAL", "1.0"))
+KEY_LOCK_STRIPES = 64
+
+def _message_size(message) -> int:
+    return len(json.dumps(message, ensure_ascii=False, default=str))
+
+class _Entry:
+    __slots__ = ("messages", "size", "dirty")
+
+    def __init__(self, messages: list, size: int, dirty: bool = False):
+        self.messages = messages
+        self.size = size
+        self.dirty = dirty
+
+class CachedStorage(Storage):
+
+    def __init__(self, backend: Storage):
+        self.backend = backend
+        self._lock = threading.RLock()
+        self._entries: "OrderedDict[tuple, _Entry]" = OrderedDict()
+        self._resident = 0
+        # Lock order: a chat's key lock, then self._lock
+        self._key_locks = [threading.Lock() for _ in range(KEY_LOCK_STRIPES)]
+        self._stop = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, name="history-flush", daemon=True)
+        self._flusher.start()
+        atexit.register(self.close)
+
+    # Chat history
+    def read_messages(self, user_id, chat_id, last_n: int = None) -> list:
+        key = (str(user_id), str(chat_id))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                metrics.incr("history_cache.hit")
+                return self._slice(entry, last_n)
+        metrics.incr("history_cache.miss")
+        # The backend read holds only the chat's key lock, so other chats are not
+        # blocked, and a delete or replace cannot slip between read and insert
+        with self._key_lock(key):
+            with self._lock:
+                entry = self._entries.get(key)
+            if entry is None:
+                messages = self.backend.read_messages(user_id, chat_id)
+                with self._lock:
+                    # A write that landed meanwhile is newer than what we read
+                    entry = self._entries.get(key)
+                    if entry is None:
+                        entry = _Entry(messages, sum(_message_size(m) for m in messages))
+                        self._put(key, entry)
+            with self._lock:
+                return self._slice(entry, last_n)
+
+    @staticmethod
+    def _slice(entry: _Entry, last_n: int = None) -> list:
+        messages = entry.messages if last_n is None else entry.messages[-last_n:] if last_n else []
+        # Callers extend the list they get back, never hand out the cached one
+        return list(messages)
+
+    def write_messages(self, user_id, chat_id, hist: list):
+        key = (str(user_id), str(chat_id))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and len(hist) >= len(entry.messages) and hist[:1] == entry.messages[:1]:
+                # Usual turn: size only grows by the appended messages
+                size = entry.size + sum(_message_size(m) for m in hist[len(entry.messages):])
+            else:
+                size = sum(_message_size(m) for m in hist)
+            self._put(key, _Entry(list(hist), size, dirty=True))
+
+    def _key_lock(self, key: tuple) -> threading.Lock:
+        return self._key_locks[hash(key) % KEY_LOCK_STRIPES]
+
+    def replace_messages(self, user_id, chat_id, hist: list):
+        key = (str(user_id), str(chat_id))
+        with self._key_lock(key), self._lock:
+            # Written through, a later flush of the same chat only appends
+            self.backend.replace_messages(user_id, chat_id, hist)
+            self._put(key, _Entry(list(hist), sum(_message_size(m) for m in hist)))
+
+    def delete_messages(self, user_id, chat_id):
+        key = (str(user_id), str(chat_id))
+        with self._key_lock(key), self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._resident -= entry.size
+            self.backend.delete_messages(user_id, chat_id)
+
+    def list_chats(self, user_id) -> list:
+        with self._lock:
+            cached = {key[1] for key, entry in self._entries.items() if key[0] == str(user_id) and entry.messages}
+        return sorted(cached | set(self.backend.list_chats(user_id)))
+
+    def chat_updated_at(self, user_id, chat_id) -> float:
+        with self._lock:
+            entry = self._entries.get((str(user_id), str(chat_id)))
+            if entry is not None and entry.dirty:
+                # Not flushed yet, so newer than anything the backend has
+                return time.time()
+        return self.backend.chat_updated_at(user_id, chat_id)
+
+    def _put(self, key: tuple, entry: _Entry):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._resident -= old.size
+        self._entries[key] = entry
+        self._resident += entry.size
+        self._evict()
+
+    def _evict(self):
+        # Only clean chats are dropped; dirty ones wait for the next flush
+        for key in list(self._entries):
+            if self._resident <= HISTORY_CACHE_BYTES or len(self._entries) <= 1:
+                break
+            entry = self._entries[key]
+            if entry.dirty:
+                continue
+            del self._entries[key]
+            self._resident -= entry.size
+            metrics.incr("history_cache.evicted")
+        metrics.gauge("history_cache.resident_bytes", self._resident)
+
+    def flush(self) -> int:
+        """Persist every dirty chat. Returns the number of chats written."""
+        with self._lock:
+            dirty = [(key, entry) for key, entry in self._entries.items() if entry.dirty]
+        if not dirty:
+            return 0
+
+        start = time.time()
+        written = 0
+        for key, entry in dirty:
+            with self._key_lock(key):
+                with self._lock:
+                    if self._entries.get(key) is not entry:
+                        # Rewritten, replaced or deleted since the snapshot
+                        continue
+                try:
+                    self.backend.write_messages(*key, entry.messages)
+                except Exception as e:
+                    print(f"⚠️ History flush failed for {key[0]}/{key[1]} ({str(e)})")
+                    continue
+                with self._lock:
+                    # Cleared only once written, so the chat is not evicted and re-read mid-write
+                    entry.dirty = False
+                written += 1
+        with self._lock:
+            self._evict()
+        latency = time.time() - start
+        metrics.observe("history_cache.flush_latency", latency)
+        print(
+            f"💾 Flushed {written} chats in {round(latency,3)}s | "
+            f"Cache hit ratio: {round(metrics.ratio('history_cache.hit', 'history_cache.miss'),2)} | "
+            f"Resident: {round(self._resident/1024/1024,2)}MB"
+        )
+        return written
+
+    def _flush_loop(self):
+        while not self._stop.wait(FLUSH_INTERVAL):
+            self.flush()
+
+    def close(self):
+        self._stop.set()
+        self.flush()
+
+    # Everything else goes straight to the backend
+    def load_summary(self, user_id, chat_id) -> dict:
+        return self.backend.load_summary(user_id, chat_id)
+
+    def save_summary(self, user_id, chat_id, summary: dict):
+        self.backend.save_summary(user_id, chat_id, summary)
+
+    def load_chain(self, user_id, chat_id) -> dict:
+        return self.backend.load_chain(user_id, chat_id)
+
+    def save_chain(self, user_id, chat_id, chain: dict):
+        self.backend.save_chain(user_id, chat_id, chain)
+
+    def load_profile(self, user_id) -> dict:
+        return self.backend.load_profile(user_id)
+
+    def save_profile(self, user_id, profile: dict):
+        self.backend.save_profile(user_id, profile)
+
+    def read_chat_list(self, user_id) -> list:
+        return self.backend.read_chat_list(user_id)
+
+    def write_chat_list(self, user_id, chat_list: list):
+        self.backend.write_chat_list(user_id, chat_list)
+
+    def read_verified_users(self) -> list:
+        return self.backend.read_verified_users()
+
+    def add_verified_user(self, user_id):
+        self.backend.add_verified_user(user_id)
+
+    def verified_users_version(self):
+        return self.backend.verified_users_version()
+
+    def list_users(self) -> list:
+        with self._lock:
+            cached = {key[0] for key, entry in self._entries.items() if entry.messages}
+        return sorted(cached | set(self.backend.list_users()))
@@ -0,0 +1,125 @@
+import os
+import json
+import glob
+from storage.base import Storage, DEFAULT_CHAT_LIST
+from storage import jsonl_history
+
+HISTORY_ROOT = "history"
+CHAT_FILE = "chat_list.json"
+PROFILE_FILE = "profile.json"
+SUMMARY_FILE = "summary_{chat_id}.json"
+CHAIN_FILE = "chain_{chat_id}.json"
+VERIFIED_USERS_FILE = "verified_users.json"
+BLOB_DIR = "blobs"  # image_store blobs, not a user
+
+def _atomic_write_json(path: str, data, **kwargs):
+    parent = os.path.dirname(path)
+    if parent:
+        os.makedirs(parent, exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, **kwargs)
+    os.replace(tmp_path, path)
+
+class FileStorage(Storage):
+    """Original on-disk layout: one directory per user under history/, JSONL chat files."""
+
+    def read_messages(self, user_id, chat_id, last_n: int = None) -> list:
+        return jsonl_history.read(user_id, chat_id, last_n)
+
+    def write_messages(self, user_id, chat_id, hist: list):
+        jsonl_history.write(user_id, chat_id, hist)
+
+    def replace_messages(self, user_id, chat_id, hist: list):
+        jsonl_history.write(user_id, chat_id, hist, rewrite=True)
+
+    def delete_messages(self, user_id, chat_id):
+        jsonl_history.delete(user_id, chat_id)
+        for path in (self._summary_path(user_id, chat_id), self._chain_path(user_id, chat_id)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def list_chats(self, user_id) -> list:
+        chat_ids = set()
+        user_dir = os.path.join(HISTORY_ROOT, str(user_id))
+        for path in glob.glob(os.path.join(user_dir, "hist_*.json")) + glob.glob(os.path.join(user_dir, "hist_*.jsonl")):
+            name = os.path.basename(path)
+            chat_ids.add(name[len("hist_"):name.rindex(".json")])
+        return sorted(chat_ids)
+
+    def chat_updated_at(self, user_id, chat_id) -> float:
+        return jsonl_history.updated_at(user_id, chat_id)
+
+    def _summary_path(self, user_id, chat_id) -> str:
+        return os.path.join(HISTORY_ROOT, str(user_id), SUMMARY_FILE.format(chat_id=chat_id))
+
+    def load_summary(self, user_id, chat_id) -> dict:
+        path = self._summary_path(user_id, chat_id)
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+    def save_summary(self, user_id, chat_id, summary: dict):
+        _atomic_write_json(self._summary_path(user_id, chat_id), summary, indent=2, ensure_ascii=False)
+
+    def _chain_path(self, user_id, chat_id) -> str:
+        return os.path.join(HISTORY_ROOT, str(user_id), CHAIN_FILE.format(chat_id=chat_id))
+
+    def load_chain(self, user_id, chat_id) -> dict:
+        path = self._chain_path(user_id, chat_id)
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+    def save_chain(self, user_id, chat_id, chain: dict):
+        _atomic_write_json(self._chain_path(user_id, chat_id), chain)
+
+    def load_profile(self, user_id) -> dict:
+        path = os.path.join(HISTORY_ROOT, f"{user_id}/{PROFILE_FILE}")
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+    def save_profile(self, user_id, profile: dict):
+        path = os.path.join(HISTORY_ROOT, f"{user_id}/{PROFILE_FILE}")
+        _atomic_write_json(path, profile, indent=2, ensure_ascii=False)
+
+    def read_chat_list(self, user_id) -> list:
+        path = os.path.join(HISTORY_ROOT, f"{user_id}/{CHAT_FILE}")
+        if not os.path.exists(path):
+            return list(DEFAULT_CHAT_LIST)
+        with open(path) as f:
+            return json.load(f) or list(DEFAULT_CHAT_LIST)
+
+    def write_chat_list(self, user_id, chat_list: list):
+        path = os.path.join(HISTORY_ROOT, f"{user_id}/{CHAT_FILE}")
+        _atomic_write_json(path, chat_list, indent=4)
+
+    def read_verified_users(self) -> list:
+        if not os.path.exists(VERIFIED_USERS_FILE):
+            _atomic_write_json(VERIFIED_USERS_FILE, [])
+        with open(VERIFIED_USERS_FILE) as f:
+            return json.load(f)
+
+    def add_verified_user(self, user_id):
+        verified_users = self.read_verified_users()
+        if user_id not in verified_users:
+            verified_users.append(user_id)
+            _atomic_write_json(VERIFIED_USERS_FILE, verified_users, indent=4)
+
+    def verified_users_version(self):
+        if not os.path.exists(VERIFIED_USERS_FILE):
+            return None
+        stat = os.stat(VERIFIED_USERS_FILE)
+        return stat.st_mtime_ns, stat.st_size
+
+    def list_users(self) -> list:
+        if not os.path.exists(HISTORY_ROOT):
+            return []
+        return sorted(
+            name for name in os.listdir(HISTORY_ROOT)
+            if os.path.isdir(os.path.join(HISTORY_ROOT, name)) and name != BLOB_DIR
+        )
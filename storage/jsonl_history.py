@@ -0,0 +1,221 @@
+"""
+Append-only JSONL chat history.
+
+Each chat is `history/<user>/hist_<chat>.jsonl` (one JSON message per line)
+plus a sidecar `hist_<chat>.idx` of fixed-size (offset, length) entries, one
+per live message. The sidecar is authoritative: a turn appends two lines and
+two index entries, and the last N messages can be read by seeking into both
+files instead of parsing the whole conversation. No caller reads a tail yet:
+a turn writes back the whole list and summaries and the retrieval index use
+absolute message positions, so the turn path gains from the appends only.
+
+Rewrites (a shorter or edited history) only truncate the sidecar and append
+the new tail, leaving dead bytes in the data file; compaction rewrites the
+file once dead bytes pass COMPACT_DEAD_RATIO. Compaction writes both new
+files next to the old ones and commits them with a `.compact` marker, so a
+crash between the two renames is finished on the next access. Run
+`python -m storage.jsonl_history migrate` once to convert legacy
+`hist_<chat>.json` files (they are also migrated lazily on first read).
+"""
+import os
+import sys
+import json
+import glob
+import struct
+import threading
+
+ENTRY = struct.Struct("<QQ")     # (offset, length) of one message line
+COMPACT_DEAD_RATIO = 0.5         # compact when this share of the data file is dead
+COMPACT_CHECK_EVERY = 50         # also re-check after this many writes per chat
+
+_lock = threading.RLock()
+_writes_since_check: dict[tuple, int] = {}
+
+def _paths(user_id, chat_id) -> tuple[str, str, str]:
+    base = f"history/{user_id}/hist_{chat_id}"
+    return base + ".jsonl", base + ".idx", base + ".json"
+
+def _compact_paths(user_id, chat_id) -> tuple[str, str, str]:
+    data_path, idx_path, _ = _paths(user_id, chat_id)
+    return data_path + ".tmp", idx_path + ".tmp", f"history/{user_id}/hist_{chat_id}.compact"
+
+def _dumps(message) -> bytes:
+    return (json.dumps(message, ensure_ascii=False, separators=(",", ":"), default=str) + "\n").encode("utf-8")
+
+def _read_entries(idx_path: str, start: int = 0, stop: int = None) -> list:
+    if not os.path.exists(idx_path):
+        return []
+    with open(idx_path, "rb") as f:
+        f.seek(start * ENTRY.size)
+        size = None if stop is None else (stop - start) * ENTRY.size
+        raw = f.read() if size is None else f.read(size)
+    usable = len(raw) - len(raw) % ENTRY.size
+    return [ENTRY.unpack_from(raw, i) for i in range(0, usable, ENTRY.size)]
+
+def count(user_id, chat_id) -> int:
+    _, idx_path, _ = _paths(user_id, chat_id)
+    if not os.path.exists(idx_path):
+        return 0
+    return os.path.getsize(idx_path) // ENTRY.size
+
+def _read_lines(data_path: str, entries: list) -> list:
+    if not entries:
+        return []
+    base = entries[0][0]
+    end = max(offset + length for offset, length in entries)
+    with open(data_path, "rb") as f:
+        f.seek(base)
+        blob = f.read(end - base)
+    return [json.loads(blob[offset - base:offset - base + length]) for offset, length in entries]
+
+def read(user_id, chat_id, last_n: int = None) -> list:
+    """Return the chat's messages, or only the last `last_n` of them."""
+    with _lock:
+        _migrate_if_needed(user_id, chat_id)
+        data_path, idx_path, _ = _paths(user_id, chat_id)
+        total = count(user_id, chat_id)
+        start = 0 if last_n is None else max(0, total - last_n)
+        return _read_lines(data_path, _read_entries(idx_path, start, total))
+
+def _append(data_path: str, idx_path: str, messages: list):
+    os.makedirs(os.path.dirname(data_path), exist_ok=True)
+    entries = []
+    with open(data_path, "ab") as f:
+        offset = f.tell()
+        for message in messages:
+            line = _dumps(message)
+            f.write(line)
+            entries.append(ENTRY.pack(offset, len(line)))
+            offset += len(line)
+    # Data first, sidecar second: a crash in between only leaves dead bytes
+    with open(idx_path, "ab") as f:
+        f.write(b"".join(entries))
+
+def _truncate_index(idx_path: str, keep: int):
+    with open(idx_path, "r+b") as f:
+        f.truncate(keep * ENTRY.size)
+
+def write(user_id, chat_id, hist: list, rewrite: bool = False):
+    """
+    Persist `hist` as the chat's full history.
+    The common case (hist is the stored history plus new messages) only appends.
+    Only the last kept message is compared, so edits further back need `rewrite`.
+    """
+    with _lock:
+        _migrate_if_needed(user_id, chat_id)
+        data_path, idx_path, _ = _paths(user_id, chat_id)
+        stored = count(user_id, chat_id)
+
+        keep = 0 if rewrite else min(stored, len(hist))
+        if keep and _read_lines(data_path, _read_entries(idx_path, keep - 1, keep))[0] != json.loads(_dumps(hist[keep - 1])):
+            # Edited history: find the first message that differs
+            existing = read(user_id, chat_id)
+            keep = 0
+            while keep < len(existing) and keep < len(hist) and existing[keep] == json.loads(_dumps(hist[keep])):
+                keep += 1
+        if keep < stored:
+            _truncate_index(idx_path, keep)
+        if len(hist) > keep:
+            _append(data_path, idx_path, hist[keep:])
+
+        key = (str(user_id), str(chat_id))
+        _writes_since_check[key] = _writes_since_check.get(key, 0) + 1
+        if keep < stored or _writes_since_check[key] >= COMPACT_CHECK_EVERY:
+            _writes_since_check[key] = 0
+            maybe_compact(user_id, chat_id)
+
+def delete(user_id, chat_id):
+    with _lock:
+        for path in _paths(user_id, chat_id) + _compact_paths(user_id, chat_id):
+            if os.path.exists(path):
+                os.remove(path)
+
+def updated_at(user_id, chat_id) -> float:
+    """Modification time of the chat's sidecar (or legacy file), 0 if it has none."""
+    _, idx_path, legacy_path = _paths(user_id, chat_id)
+    for path in (idx_path, legacy_path):
+        if os.path.exists(path):
+            return os.path.getmtime(path)
+    return 0.0
+
+def dead_ratio(user_id, chat_id) -> float:
+    data_path, idx_path, _ = _paths(user_id, chat_id)
+    if not os.path.exists(data_path):
+        return 0.0
+    size = os.path.getsize(data_path)
+    live = sum(length for _, length in _read_entries(idx_path))
+    return (size - live) / size if size else 0.0
+
+def compact(user_id, chat_id):
+    """
+    Rewrite the chat with only live messages. The marker file is the commit
+    point: once it exists both new files are complete, and _finish_compaction
+    completes the two renames even after a crash between them.
+    """
+    with _lock:
+        messages = read(user_id, chat_id)
+        tmp_data, tmp_idx, marker = _compact_paths(user_id, chat_id)
+        for path in (tmp_data, tmp_idx):
+            if os.path.exists(path):
+                os.remove(path)
+        _append(tmp_data, tmp_idx, messages)
+        for path in (tmp_data, tmp_idx):
+            with open(path, "rb+") as f:
+                os.fsync(f.fileno())
+        with open(marker, "w") as f:
+            f.flush()
+            os.fsync(f.fileno())
+        _finish_compaction(user_id, chat_id)
+        print(f"🧹 Compacted history {user_id}/{chat_id}: {len(messages)} messages")
+
+def _finish_compaction(user_id, chat_id):
+    data_path, idx_path, _ = _paths(user_id, chat_id)
+    tmp_data, tmp_idx, marker = _compact_paths(user_id, chat_id)
+    if not os.path.exists(marker):
+        return
+    # Data first, then the sidecar; a file already moved is simply skipped
+    if os.path.exists(tmp_data):
+        os.replace(tmp_data, data_path)
+    if os.path.exists(tmp_idx):
+        os.replace(tmp_idx, idx_path)
+    os.remove(marker)
+
+def maybe_compact(user_id, chat_id):
+    if dead_ratio(user_id, chat_id) >= COMPACT_DEAD_RATIO:
+        compact(user_id, chat_id)
+
+def _migrate_if_needed(user_id, chat_id):
+    # An interrupted compaction is completed before the files are used
+    _finish_compaction(user_id, chat_id)
+    data_path, idx_path, legacy_path = _paths(user_id, chat_id)
+    if os.path.exists(legacy_path) and not os.path.exists(idx_path):
+        migrate_file(legacy_path)
+
+def migrate_file(legacy_path: str) -> int:
+    """Convert one legacy `hist_<chat>.json` file, keeping it as `.json.migrated`."""
+    with open(legacy_path) as f:
+        hist = json.load(f)
+    base = legacy_path[:-len(".json")]
+    data_path, idx_path = base + ".jsonl", base + ".idx"
+    for path in (data_path, idx_path):
+        if os.path.exists(path):
+            os.remove(path)
+    _append(data_path, idx_path, hist)
+    os.replace(legacy_path, legacy_path + ".migrated")
+    return len(hist)
+
+def migrate_all(root: str = "history") -> int:
+    migrated = 0
+    for legacy_path in sorted(glob.glob(os.path.join(root, "*", "hist_*.json"))):
+        n = migrate_file(legacy_path)
+        migrated += 1
+        print(f"✅ Migrated {legacy_path} ({n} messages)")
+    return migrated
+
+if __name__ == "__main__":
+    # python -m storage.jsonl_history migrate [history_root]
+    if len(sys.argv) >= 2 and sys.argv[1] == "migrate":
+        total = migrate_all(sys.argv[2] if len(sys.argv) > 2 else "history")
+        print(f"Migrated {total} chats.")
+    else:
+        print("Usage: python -m storage.jsonl_history migrate [history_root]")
@@ -0,0 +1,48 @@
+"""
+Copy file-based state into the SQLite backend.
+
+    python -m storage.migrate [sqlite_path]
+"""
+import os
+import sys
+from storage.files import FileStorage, HISTORY_ROOT
+from storage.sqlite import SQLiteStorage, SQLITE_PATH
+from storage import jsonl_history
+
+def migrate_to_sqlite(target: SQLiteStorage, source: FileStorage = None) -> dict:
+    source = source or FileStorage()
+    counts = {"users": 0, "chats": 0, "messages": 0, "verified_users": 0}
+
+    for user_id in source.list_users():
+        user_dir = os.path.join(HISTORY_ROOT, user_id)
+        counts["users"] += 1
+
+        if os.path.exists(os.path.join(user_dir, "chat_list.json")):
+            target.write_chat_list(user_id, source.read_chat_list(user_id))
+
+        profile = source.load_profile(user_id)
+        if profile:
+            target.save_profile(user_id, profile)
+
+        for chat_id in source.list_chats(user_id):
+            # Reading through jsonl_history also converts legacy .json files
+            hist = jsonl_history.read(user_id, chat_id)
+            target.write_messages(user_id, chat_id, hist)
+            summary = source.load_summary(user_id, chat_id)
+            if summary:
+                target.save_summary(user_id, chat_id, summary)
+            chain = source.load_chain(user_id, chat_id)
+            if chain:
+                target.save_chain(user_id, chat_id, chain)
+            counts["chats"] += 1
+            counts["messages"] += len(hist)
+
+    for user_id in source.read_verified_users():
+        target.add_verified_user(user_id)
+        counts["verified_users"] += 1
+    return counts
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else SQLITE_PATH
+    counts = migrate_to_sqlite(SQLiteStorage(path))
+    print(f"✅ Migrated into {path}: {counts}")
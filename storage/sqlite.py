@@ -0,0 +1,245 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from storage.base import Storage, DEFAULT_CHAT_LIST
+
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "history/state.db")
+BUSY_TIMEOUT_MS = 10000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    user_id TEXT NOT NULL,
+    chat_id TEXT NOT NULL,
+    seq     INTEGER NOT NULL,
+    body    TEXT NOT NULL,
+    PRIMARY KEY (user_id, chat_id, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS chats (
+    user_id    TEXT NOT NULL,
+    chat_id    TEXT NOT NULL,
+    position   INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (user_id, chat_id)
+);
+CREATE TABLE IF NOT EXISTS chat_activity (
+    user_id    TEXT NOT NULL,
+    chat_id    TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (user_id, chat_id)
+);
+CREATE TABLE IF NOT EXISTS summaries (
+    user_id    TEXT NOT NULL,
+    chat_id    TEXT NOT NULL,
+    body       TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (user_id, chat_id)
+);
+CREATE TABLE IF NOT EXISTS chains (
+    user_id    TEXT NOT NULL,
+    chat_id    TEXT NOT NULL,
+    body       TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (user_id, chat_id)
+);
+CREATE TABLE IF NOT EXISTS profiles (
+    user_id    TEXT PRIMARY KEY,
+    body       TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS verified_users (
+    user_id    PRIMARY KEY,
+    created_at REAL NOT NULL
+);
+"""
+
+def _dumps(message) -> str:
+    return json.dumps(message, ensure_ascii=False, separators=(",", ":"), default=str)
+
+def _touch(conn, user: str, chat: str):
+    conn.execute(
+        "INSERT OR REPLACE INTO chat_activity (user_id, chat_id, updated_at) VALUES (?, ?, ?)", (user, chat, time.time())
+    )
+
+class SQLiteStorage(Storage):
+    """
+    Single-file SQLite (WAL) backend, safe to share between processes.
+    Tail reads are a primary-key range scan on (user_id, chat_id, seq).
+    """
+
+    def __init__(self, path: str = SQLITE_PATH):
+        parent = os.path.dirname(path)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=BUSY_TIMEOUT_MS / 1000)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        self._conn.executescript(SCHEMA)
+
+    def _write(self, fn):
+        """Run fn(conn) in one IMMEDIATE transaction (takes the write lock up front)."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(self._conn)
+                self._conn.execute("COMMIT")
+                return result
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _query(self, sql: str, params: tuple = ()) -> list:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    # Chat history
+    def read_messages(self, user_id, chat_id, last_n: int = None) -> list:
+        if last_n is None:
+            rows = self._query(
+                "SELECT body FROM messages WHERE user_id=? AND chat_id=? ORDER BY seq",
+                (str(user_id), str(chat_id)),
+            )
+        else:
+            rows = self._query(
+                "SELECT body FROM (SELECT seq, body FROM messages WHERE user_id=? AND chat_id=? "
+                "ORDER BY seq DESC LIMIT ?) ORDER BY seq",
+                (str(user_id), str(chat_id), last_n),
+            )
+        return [json.loads(body) for (body,) in rows]
+
+    def write_messages(self, user_id, chat_id, hist: list):
+        user, chat = str(user_id), str(chat_id)
+
+        def apply(conn):
+            stored = conn.execute(
+                "SELECT COALESCE(MAX(seq) + 1, 0) FROM messages WHERE user_id=? AND chat_id=?", (user, chat)
+            ).fetchone()[0]
+            keep = min(stored, len(hist))
+            if keep:
+                (last,) = conn.execute(
+                    "SELECT body FROM messages WHERE user_id=? AND chat_id=? AND seq=?", (user, chat, keep - 1)
+                ).fetchone()
+                if last != _dumps(hist[keep - 1]):
+                    # Edited history: keep the common prefix only
+                    existing = conn.execute(
+                        "SELECT body FROM messages WHERE user_id=? AND chat_id=? AND seq<? ORDER BY seq",
+                        (user, chat, keep),
+                    ).fetchall()
+                    keep = 0
+                    while keep < len(existing) and existing[keep][0] == _dumps(hist[keep]):
+                        keep += 1
+            if keep < stored:
+                conn.execute("DELETE FROM messages WHERE user_id=? AND chat_id=? AND seq>=?", (user, chat, keep))
+            # Usual turn: only the appended messages are serialized and inserted
+            conn.executemany(
+                "INSERT INTO messages (user_id, chat_id, seq, body) VALUES (?, ?, ?, ?)",
+                [(user, chat, seq, _dumps(hist[seq])) for seq in range(keep, len(hist))],
+            )
+            _touch(conn, user, chat)
+        self._write(apply)
+
+    def replace_messages(self, user_id, chat_id, hist: list):
+        user, chat = str(user_id), str(chat_id)
+
+        def apply(conn):
+            conn.execute("DELETE FROM messages WHERE user_id=? AND chat_id=?", (user, chat))
+            conn.executemany(
+                "INSERT INTO messages (user_id, chat_id, seq, body) VALUES (?, ?, ?, ?)",
+                [(user, chat, seq, _dumps(message)) for seq, message in enumerate(hist)],
+            )
+            _touch(conn, user, chat)
+        self._write(apply)
+
+    def delete_messages(self, user_id, chat_id):
+        def apply(conn):
+            conn.execute("DELETE FROM messages WHERE user_id=? AND chat_id=?", (str(user_id), str(chat_id)))
+            conn.execute("DELETE FROM summaries WHERE user_id=? AND chat_id=?", (str(user_id), str(chat_id)))
+            conn.execute("DELETE FROM chains WHERE user_id=? AND chat_id=?", (str(user_id), str(chat_id)))
+            conn.execute("DELETE FROM chat_activity WHERE user_id=? AND chat_id=?", (str(user_id), str(chat_id)))
+        self._write(apply)
+
+    def list_chats(self, user_id) -> list:
+        rows = self._query("SELECT DISTINCT chat_id FROM messages WHERE user_id=? ORDER BY chat_id", (str(user_id),))
+        return [chat_id for (chat_id,) in rows]
+
+    def chat_updated_at(self, user_id, chat_id) -> float:
+        rows = self._query("SELECT updated_at FROM chat_activity WHERE user_id=? AND chat_id=?", (str(user_id), str(chat_id)))
+        return rows[0][0] if rows else 0.0
+
+    # Compaction summaries
+    def load_summary(self, user_id, chat_id) -> dict:
+        rows = self._query("SELECT body FROM summaries WHERE user_id=? AND chat_id=?", (str(user_id), str(chat_id)))
+        return json.loads(rows[0][0]) if rows else {}
+
+    def save_summary(self, user_id, chat_id, summary: dict):
+        self._write(lambda conn: conn.execute(
+            "INSERT INTO summaries (user_id, chat_id, body, updated_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(user_id, chat_id) DO UPDATE SET body=excluded.body, updated_at=excluded.updated_at",
+            (str(user_id), str(chat_id), _dumps(summary), time.time()),
+        ))
+
+    # Response chains
+    def load_chain(self, user_id, chat_id) -> dict:
+        rows = self._query("SELECT body FROM chains WHERE user_id=? AND chat_id=?", (str(user_id), str(chat_id)))
+        return json.loads(rows[0][0]) if rows else {}
+
+    def save_chain(self, user_id, chat_id, chain: dict):
+        self._write(lambda conn: conn.execute(
+            "INSERT INTO chains (user_id, chat_id, body, updated_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(user_id, chat_id) DO UPDATE SET body=excluded.body, updated_at=excluded.updated_at",
+            (str(user_id), str(chat_id), _dumps(chain), time.time()),
+        ))
+
+    # Profiles
+    def load_profile(self, user_id) -> dict:
+        rows = self._query("SELECT body FROM profiles WHERE user_id=?", (str(user_id),))
+        return json.loads(rows[0][0]) if rows else {}
+
+    def save_profile(self, user_id, profile: dict):
+        self._write(lambda conn: conn.execute(
+            "INSERT INTO profiles (user_id, body, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET body=excluded.body, updated_at=excluded.updated_at",
+            (str(user_id), _dumps(profile), time.time()),
+        ))
+
+    # Chat lists
+    def read_chat_list(self, user_id) -> list:
+        rows = self._query("SELECT chat_id FROM chats WHERE user_id=? ORDER BY position", (str(user_id),))
+        if not rows:
+            return list(DEFAULT_CHAT_LIST)
+        return [chat_id for (chat_id,) in rows]
+
+    def write_chat_list(self, user_id, chat_list: list):
+        user = str(user_id)
+        now = time.time()
+
+        def apply(conn):
+            conn.execute("DELETE FROM chats WHERE user_id=?", (user,))
+            conn.executemany(
+                "INSERT OR IGNORE INTO chats (user_id, chat_id, position, created_at) VALUES (?, ?, ?, ?)",
+                [(user, str(chat_id), position, now) for position, chat_id in enumerate(chat_list)],
+            )
+        self._write(apply)
+
+    # Verified Telegram users
+    def read_verified_users(self) -> list:
+        return [user_id for (user_id,) in self._query("SELECT user_id FROM verified_users ORDER BY created_at")]
+
+    def add_verified_user(self, user_id):
+        self._write(lambda conn: conn.execute(
+            "INSERT OR IGNORE INTO verified_users (user_id, created_at) VALUES (?, ?)", (user_id, time.time())
+        ))
+
+    def verified_users_version(self):
+        return tuple(self._query("SELECT COUNT(*), MAX(created_at) FROM verified_users")[0])
+
+    def list_users(self) -> list:
+        rows = self._query(
+            "SELECT user_id FROM messages GROUP BY user_id UNION SELECT user_id FROM profiles "
+            "UNION SELECT user_id FROM chats ORDER BY user_id"
+        )
+        return [user_id for (user_id,) in rows]
@@ -0,0 +1,104 @@
+"""
+Local stand-in for the Responses API, for exercising RESPONSE_CHAINING offline.
+
+    python stub_responses_server.py [port]
+    OPENAI_BASE_URL=http://127.0.0.1:8787/v1 OPENAI_API_KEY=stub RESPONSE_CHAINING=1 python bot.py
+
+Streams a canned echo answer, keeps every stored response in memory so
+`previous_response_id` chains resolve (unknown ids get a 404 like an expired
+chain), and logs the bytes received and the chain length of every request.
+"""
+import sys
+import json
+import time
+import uuid
+from aiohttp import web
+
+_responses: dict = {}   # response id -> {"input": [...], "previous": id}
+
+def _chain_length(response_id) -> int:
+    n = 0
+    while response_id in _responses:
+        n += len(_responses[response_id]["input"]) + 1
+        response_id = _responses[response_id]["previous"]
+    return n
+
+def _last_user_text(items: list) -> str:
+    for item in reversed(items):
+        if isinstance(item, dict) and item.get("role") == "user":
+            content = item.get("content")
+            if isinstance(content, list):
+                return " ".join(part.get("text", "") for part in content if part.get("type") == "input_text")
+            return str(content)
+    return ""
+
+def _sse(event: dict) -> bytes:
+    return f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8")
+
+def _response_object(response_id: str, model: str, status: str, text: str = None) -> dict:
+    output = []
+    if text is not None:
+        output.append({
+            "id": f"msg_{response_id}", "type": "message", "role": "assistant", "status": "completed",
+            "content": [{"type": "output_text", "text": text, "annotations": []}],
+        })
+    return {
+        "id": response_id, "object": "response", "created_at": int(time.time()), "model": model,
+        "status": status, "output": output, "parallel_tool_calls": True, "tool_choice": "auto", "tools": [],
+        "usage": {
+            "input_tokens": 0, "input_tokens_details": {"cached_tokens": 0},
+            "output_tokens": 0, "output_tokens_details": {"reasoning_tokens": 0}, "total_tokens": 0,
+        },
+    }
+
+async def create_response(request: web.Request) -> web.StreamResponse:
+    raw = await request.read()
+    body = json.loads(raw)
+    previous = body.get("previous_response_id")
+    if previous and previous not in _responses:
+        return web.json_response(
+            {"error": {"message": f"Previous response with id '{previous}' not found.", "type": "invalid_request_error",
+                       "param": "previous_response_id", "code": "previous_response_not_found"}},
+            status=404,
+        )
+    items = body.get("input") or []
+    if isinstance(items, str):
+        items = [{"role": "user", "content": items}]
+
+    response_id = f"resp_{uuid.uuid4().hex}"
+    if body.get("store", True):
+        _responses[response_id] = {"input": items, "previous": previous}
+    chain = _chain_length(previous)
+    print(f"📥 {len(raw)} bytes | {len(items)} new items | chained onto {chain} items | previous={previous}")
+
+    text = f"Echo: {_last_user_text(items) or '(tool outputs)'} [context: {chain + len(items)} items]"
+    model = body.get("model", "stub")
+    if not body.get("stream"):
+        return web.json_response(_response_object(response_id, model, "completed", text))
+
+    stream = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await stream.prepare(request)
+    events = [
+        {"type": "response.created", "response": _response_object(response_id, model, "in_progress")},
+        {"type": "response.output_item.added", "output_index": 0, "item": {
+            "id": f"msg_{response_id}", "type": "message", "role": "assistant", "status": "in_progress", "content": []}},
+        {"type": "response.content_part.added", "item_id": f"msg_{response_id}", "output_index": 0, "content_index": 0,
+         "part": {"type": "output_text", "text": "", "annotations": []}},
+    ]
+    for word in text.split(" "):
+        events.append({"type": "response.output_text.delta", "item_id": f"msg_{response_id}", "output_index": 0,
+                       "content_index": 0, "delta": word + " ", "logprobs": []})
+    events.append({"type": "response.completed", "response": _response_object(response_id, model, "completed", text)})
+    for sequence_number, event in enumerate(events):
+        event["sequence_number"] = sequence_number
+        await stream.write(_sse(event))
+    await stream.write_eof()
+    return stream
+
+def make_app() -> web.Application:
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_post("/v1/responses", create_response)
+    return app
+
+if __name__ == "__main__":
+    web.run_app(make_app(), host="127.0.0.1", port=int(sys.argv[1]) if len(sys.argv) > 1 else 8787)
@@ -0,0 +1,135 @@
+"""
+Streams a growing answer into Telegram messages.
+
+The stream consumer only appends deltas to a buffer; a separate renderer
+task edits the Telegram message with the latest buffer whenever it changed,
+so reading the OpenAI stream never waits on Telegram. Edits are spaced by
+the measured edit latency and back off after FloodWaitError. Every edit
+pushes the current text, so nothing stale is queued. Text past
+MESSAGE_LIMIT continues in follow-up messages, split at line or word
+boundaries.
+"""
+import time
+import asyncio
+from telethon.errors import FloodWaitError
+import metrics
+
+MESSAGE_LIMIT = 3000          # Telegram allows 4096 characters, leave room for markdown
+MIN_EDIT_INTERVAL = 0.3       # seconds between edits of one message
+EDIT_LATENCY_FACTOR = 2.0     # wait this many edit latencies between edits
+MAX_EDIT_INTERVAL = 5.0
+
+def split_message(text: str, limit: int = MESSAGE_LIMIT) -> list:
+    """
+    Split into chunks of at most `limit` characters, preferring line then word boundaries.
+    Cut points only depend on the text before them, so chunks stay stable while text grows.
+    """
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut < limit // 2:
+            cut = text.rfind(" ", 0, limit)
+        if cut < limit // 2:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n ")
+    parts.append(text)
+    return parts
+
+class StreamRenderer:
+
+    def __init__(self, client, chat_id, message):
+        self.client = client
+        self.chat_id = chat_id
+        self.messages = [message]
+        self.rendered = [None]
+        self.edits = [0]
+        self.text = ""
+        self._changed = asyncio.Event()
+        self._finished = asyncio.Event()
+        self._closed = False
+        self._latency = MIN_EDIT_INTERVAL / EDIT_LATENCY_FACTOR
+        self._backoff = 1.0
+        self._last_delta = None
+        self._task = asyncio.create_task(self._run())
+
+    def append(self, delta: str):
+        if not delta:
+            return
+        self.text += delta
+        self._last_delta = time.time()
+        self._changed.set()
+
+    async def finish(self, footer: str = "") -> str:
+        """Render the final text (plus footer) and wait for it. Returns the displayed text."""
+        if footer:
+            self.text += footer
+        self._closed = True
+        self._changed.set()
+        self._finished.set()
+        await self._task
+        if self._last_delta is not None:
+            metrics.observe("telegram.final_lag", time.time() - self._last_delta)
+        for edits in self.edits:
+            metrics.observe("telegram.edits_per_message", edits)
+        print(f"📨 Rendered {len(self.text)} chars in {len(self.messages)} messages with {sum(self.edits)} edits")
+        return self.text
+
+    def cancel(self):
+        self._task.cancel()
+
+    def _interval(self) -> float:
+        return min(MAX_EDIT_INTERVAL, max(MIN_EDIT_INTERVAL, EDIT_LATENCY_FACTOR * self._latency) * self._backoff)
+
+    async def _run(self):
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            closed = self._closed
+            if not await self._render(self.text):
+                # Interrupted by a flood wait, which already spaced the edits
+                continue
+            if closed:
+                return
+            # Pace the next edit, but render the final text at once
+            try:
+                await asyncio.wait_for(self._finished.wait(), self._interval())
+            except asyncio.TimeoutError:
+                pass
+
+    async def _render(self, text: str) -> bool:
+        """Show `text`; False when a flood wait interrupted it and it must be rendered again."""
+        for i, part in enumerate(split_message(text)):
+            if not part.strip():
+                continue
+            try:
+                await self._show(i, part)
+            except FloodWaitError as e:
+                metrics.incr("telegram.flood_waits")
+                self._backoff = min(self._backoff * 2, MAX_EDIT_INTERVAL / MIN_EDIT_INTERVAL)
+                print(f"⏳ Telegram flood wait {e.seconds}s")
+                await asyncio.sleep(e.seconds)
+                # The text moved on while waiting: render again from the current buffer
+                self._changed.set()
+                return False
+            except Exception as e:
+                print("Streaming Message Error:", e)
+        return True
+
+    async def _show(self, i: int, part: str):
+        if i < len(self.messages) and self.rendered[i] == part:
+            return
+        start = time.time()
+        if i < len(self.messages):
+            await self.messages[i].edit(part)
+            self.edits[i] += 1
+        else:
+            self.messages.append(await self.client.send_message(self.chat_id, part, parse_mode="md"))
+            self.rendered.append(None)
+            self.edits.append(0)
+        self.rendered[i] = part
+        latency = time.time() - start
+        metrics.observe("telegram.edit_latency", latency)
+        # Moving average of edit latency, and let the flood back-off decay
+        self._latency = 0.8 * self._latency + 0.2 * latency
+        self._backoff = max(1.0, self._backoff * 0.9)
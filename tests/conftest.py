@@ -0,0 +1,22 @@
+"""
+Offline tests: every module runs against a temporary working directory
+(all state lives under the relative `history/`) and never reaches OpenAI.
+
+    python -m pytest tests
+"""
+import os
+
+# Read at import time by the app modules
+os.environ.setdefault("OPENAI_API_KEY", "stub")
+# Write-behind flushes would land in whatever directory is current by then
+os.environ["HISTORY_CACHE"] = "0"
+
+import pytest
+import storage
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Fresh `history/` and a fresh storage backend for one test."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(storage, "_storage", None)
+    return tmp_path
@@ -0,0 +1,52 @@
+"""Offline profile rebuild through profile_batch's file-based Batch stand-in."""
+import json
+import os
+import profile_batch
+from storage import get_storage
+
+ANSWER = {
+    "assistant_response_preferences": [{"preference": "answer in English", "confidence": "high"}],
+    "notable_topic_highlights": [{"topic": "gardening", "confidence": "medium"}],
+    "helpful_user_insights": ["grows tomatoes"],
+}
+
+def _write_chat(storage, user_id, chat_id, text: str, mtime: float):
+    storage.write_messages(user_id, chat_id, [
+        {"role": "user", "content": text},
+        {"role": "assistant", "content": "noted"},
+    ])
+    # Chat recency comes from the sidecar's modification time
+    os.utime(f"history/{user_id}/hist_{chat_id}.idx", (mtime, mtime))
+
+def test_rebuild_through_local_stand_in(workdir):
+    storage = get_storage()
+    # Alphabetical order would put the newest chat ("a_new") first
+    _write_chat(storage, "alice", "a_new", "newest message", 3000)
+    _write_chat(storage, "alice", "b_old", "oldest message", 1000)
+    _write_chat(storage, "alice", "c_mid", "middle message", 2000)
+    _write_chat(storage, "bob", "default", "hello there", 1000)
+    storage.save_profile("bob", {"helpful_user_insights": ["likes chess"], "meta": {}})
+
+    fixture = workdir / "fixture.jsonl"
+    fixture.write_text(json.dumps({"custom_id": "profile:alice", "text": json.dumps(ANSWER)}) + "\n")
+    input_path = str(workdir / "batch" / "input.jsonl")
+
+    assert profile_batch.main(["--local", str(workdir / "local"), "--fixture", str(fixture), "--input", input_path]) == 0
+
+    # Each user's chats are concatenated oldest first, so the latest messages come last
+    with open(input_path) as f:
+        requests = {line["custom_id"]: line for line in map(json.loads, f)}
+    prompt = requests["profile:alice"]["body"]["input"][0]["content"]
+    assert prompt.index("oldest message") < prompt.index("middle message") < prompt.index("newest message")
+
+    # The answer is merged through the usual normalization and saved with its source count
+    alice = storage.load_profile("alice")
+    assert alice["assistant_response_preferences"] == ANSWER["assistant_response_preferences"]
+    assert alice["notable_topic_highlights"] == ANSWER["notable_topic_highlights"]
+    assert alice["helpful_user_insights"] == ANSWER["helpful_user_insights"]
+    assert alice["meta"]["source_messages"] == 6
+
+    # Without a fixture answer the stand-in echoes the current profile
+    bob = storage.load_profile("bob")
+    assert bob["helpful_user_insights"] == ["likes chess"]
+    assert bob["meta"]["source_messages"] == 2
@@ -0,0 +1,91 @@
+"""RESPONSE_CHAINING against stub_responses_server: chained turns send only the new input."""
+import asyncio
+import json
+from aiohttp import web
+from openai import AsyncOpenAI
+import llm
+import stub_responses_server as stub
+from hist import read_history, write_history
+from storage import get_storage
+
+TURNS = 5
+
+async def _serve():
+    """Start the stub on a free port; returns (runner, base_url, sizes of the /v1/responses requests)."""
+    sizes = []
+
+    @web.middleware
+    async def record_size(request, handler):
+        if request.path == "/v1/responses":
+            body = json.loads(await request.read())
+            # Selector calls of the router are not streamed; only count the turns
+            if body.get("stream"):
+                sizes.append(len(await request.read()))
+        return await handler(request)
+
+    app = stub.make_app()
+    app.middlewares.append(record_size)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}/v1", sizes
+
+async def _chat(user_id, turns: int) -> list:
+    for n in range(turns):
+        hist = read_history(user_id)
+        text = f"Question {n}: tell me something about the number {n} " + "and explain it in detail " * 20
+        stream, _ = await llm.llm(text, user_id, hist)
+        answer = ""
+        async for event in stream:
+            if event.type == "response.output_text.delta":
+                answer += event.delta
+        hist += [{"role": "user", "content": text}, {"role": "assistant", "content": answer}]
+        write_history(user_id, user_id, hist)
+    return read_history(user_id)
+
+def _run(monkeypatch, chaining: bool, user_id: str):
+    async def main():
+        runner, base_url, sizes = await _serve()
+        try:
+            monkeypatch.setattr(llm, "openai", AsyncOpenAI(api_key="stub", base_url=base_url))
+            monkeypatch.setattr(llm, "RESPONSE_CHAINING", chaining)
+            hist = await _chat(user_id, TURNS)
+        finally:
+            await runner.cleanup()
+        return hist, sizes
+    return asyncio.run(main())
+
+def test_chained_turns_continue_the_previous_response(workdir, monkeypatch):
+    monkeypatch.setattr(stub, "_responses", {})
+    hist, sizes = _run(monkeypatch, chaining=True, user_id="chained")
+
+    assert len(hist) == 2 * TURNS
+    chain = get_storage().load_chain("chained", "chained")
+    # The stored chain covers the whole written history and is known to the server
+    assert chain["covered"] == len(hist)
+    assert chain["response_id"] in stub._responses
+
+    # Walk the chain back from the last response: one link per turn, each
+    # carrying only the time message and the new user message
+    links = []
+    response_id = chain["response_id"]
+    while response_id is not None:
+        links.append(stub._responses[response_id])
+        response_id = stub._responses[response_id]["previous"]
+    assert len(links) == TURNS
+    assert all(len(link["input"]) == 2 for link in links)
+
+    # The payload stays flat instead of growing with the history
+    assert len(sizes) == TURNS
+    assert max(sizes[1:]) - min(sizes[1:]) < 256
+
+def test_unchained_turns_resend_the_context(workdir, monkeypatch):
+    monkeypatch.setattr(stub, "_responses", {})
+    _, chained_sizes = _run(monkeypatch, chaining=True, user_id="chained")
+    _, full_sizes = _run(monkeypatch, chaining=False, user_id="full")
+
+    assert get_storage().load_chain("full", "full") == {}
+    assert full_sizes[-1] > full_sizes[0]
+    assert full_sizes[-1] > 2 * chained_sizes[-1]
@@ -8,24 +8,31 @@ REGISTERED_TOOL_DESCRIPTIONS = []
 
 TOOL_DISPLAY: dict[str, str] = {}
 
+# Per-tool execution timeout in seconds, enforced by tools.executor
+DEFAULT_TOOL_TIMEOUT = 30
+TOOL_TIMEOUTS: dict[str, float] = {}
+
 def tool(name: str,
          description: str,
          parameters: dict,
          strict: bool = False,
          display_name: Optional[str] = None,
+         timeout: float = DEFAULT_TOOL_TIMEOUT,
         ):
     """
     Decorator:
       1) Attach __tool_meta__ to the function
       2) Add the function object to REGISTERED_TOOLS
       3) Add the wrapped dict to REGISTERED_TOOL_DESCRIPTIONS
+      4) Record the execution timeout in TOOL_TIMEOUTS
     """
     def deco(func):
         meta = {
             "name":        name,
             "description": description,
             "parameters":  parameters,
-            "strict":      strict
+            "strict":      strict,
+            "timeout":     timeout,
         }
         # Attach metadata to the function object (for later use)
         func.__tool_meta__ = meta
@@ -41,5 +48,6 @@ def tool(name: str,
             "strict":      strict
         })
         TOOL_DISPLAY[name] = display_name or name
+        TOOL_TIMEOUTS[name] = timeout
         return func
     return deco
\ No newline at end of file
@@ -0,0 +1,72 @@
+import os
+import time
+import asyncio
+import inspect
+import functools
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from tools.decorator import REGISTERED_TOOLS, TOOL_TIMEOUTS, DEFAULT_TOOL_TIMEOUT
+
+# Blocking tools run here so a slow download never stalls the event loop
+TOOL_WORKERS = int(os.environ.get("TOOL_WORKERS", "8"))
+_pool = ThreadPoolExecutor(max_workers=TOOL_WORKERS, thread_name_prefix="tool")
+
+class ToolCancelled(Exception):
+    """Raised inside a blocking tool when its cancel_event is set."""
+
+def _accepts_cancel_event(fn) -> bool:
+    return "cancel_event" in inspect.signature(fn).parameters
+
+async def execute_tool(name: str, args: dict):
+    """
+    Run a registered tool with its declared timeout.
+
+    Coroutine tools are awaited on the loop, plain functions run in the bounded
+    thread pool. Tools that take a `cancel_event` argument receive a
+    threading.Event that is set on timeout or when the calling task is
+    cancelled (e.g. the user abandoned the request), so they can stop early.
+    """
+    fn = REGISTERED_TOOLS.get(name)
+    if not fn:
+        raise ValueError(f"Unknown tool: {name}")
+
+    timeout = TOOL_TIMEOUTS.get(name, DEFAULT_TOOL_TIMEOUT)
+    cancel_event = threading.Event()
+    kwargs = dict(args)
+    if _accepts_cancel_event(fn):
+        kwargs["cancel_event"] = cancel_event
+
+    start = time.time()
+    try:
+        if inspect.iscoroutinefunction(fn):
+            return await asyncio.wait_for(fn(**kwargs), timeout)
+        loop = asyncio.get_running_loop()
+        return await asyncio.wait_for(loop.run_in_executor(_pool, functools.partial(fn, **kwargs)), timeout)
+    except asyncio.TimeoutError:
+        print(f"⏰ Tool {name} timed out after {timeout}s")
+        return f"Error: {name} timed out after {timeout}s"
+    except asyncio.CancelledError:
+        print(f"🛑 Tool {name} cancelled")
+        raise
+    finally:
+        # Stops cooperative blocking tools still running in the pool
+        cancel_event.set()
+        print(f"🔧 Tool {name} | Cost: {round(time.time()-start,2)}s")
+
+def run_cancellable(cmd: list, cancel_event: threading.Event = None, poll_interval: float = 0.5, **kwargs) -> subprocess.CompletedProcess:
+    """
+    Drop-in for subprocess.run(cmd, **kwargs) that kills the child process
+    once cancel_event is set.
+    """
+    with subprocess.Popen(cmd, **kwargs) as p:
+        while True:
+            try:
+                stdout, stderr = p.communicate(timeout=poll_interval)
+                break
+            except subprocess.TimeoutExpired:
+                if cancel_event is not None and cancel_event.is_set():
+                    p.kill()
+                    p.communicate()
+                    raise ToolCancelled(f"Cancelled: {' '.join(cmd[:2])}")
+    return subprocess.CompletedProcess(cmd, p.returncode, stdout, stderr)
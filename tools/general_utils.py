@@ -7,6 +7,8 @@ import aiohttp
 import asyncio
 from tools.decorator import tool
 
+HTTP_TIMEOUT = 10
+
 @tool(
     name = "get_weather",
     description = "Get weather data for provided coordinates in celsius.",
@@ -20,10 +22,11 @@ from tools.decorator import tool
         "additionalProperties": False
         },
     strict = True,
-    display_name = "🌤️ Weather"
+    display_name = "🌤️ Weather",
+    timeout = 15,
 )
 def get_weather(latitude, longitude):
-    response = requests.get(f"https://api.open-meteo.com/v1/forecast?latitude={latitude}&longitude={longitude}&hourly=temperature_2m,weather_code,rain")
+    response = requests.get(f"https://api.open-meteo.com/v1/forecast?latitude={latitude}&longitude={longitude}&hourly=temperature_2m,weather_code,rain", timeout=HTTP_TIMEOUT)
     data = response.json()
     return data
 
@@ -39,7 +42,8 @@ def get_weather(latitude, longitude):
         "additionalProperties": False
     },
     strict = True,
-    display_name = "⌚️ Time"
+    display_name = "⌚️ Time",
+    timeout = 5,
 )
 def get_current_time(time_zone_hours=9) -> str:
     tz = timezone(timedelta(hours=time_zone_hours))
@@ -57,11 +61,12 @@ def get_current_time(time_zone_hours=9) -> str:
         "additionalProperties": False
     },
     strict = True,
-    display_name = "📦 Web Crawler"
+    display_name = "📦 Web Crawler",
+    timeout = 20,
 )
 def web_crawler(website_url) -> str:
     try:
-        response = requests.get(website_url)
+        response = requests.get(website_url, timeout=HTTP_TIMEOUT)
         if response.status_code == 200:
             soup = BeautifulSoup(response.text, "html.parser")
             text = soup.get_text(separator="\n", strip=True)
@@ -1,13 +1,11 @@
 from tools.general_utils import get_weather, get_current_time, web_crawler
 from tools.web_search import web_search
 from tools.ytb_transcribe import ytb_transcribe
-from tools.decorator import REGISTERED_TOOLS, TOOL_DISPLAY
+from tools.decorator import TOOL_DISPLAY
+from tools.executor import execute_tool
 
-def call_function(name: str, args: dict):
-    fn = REGISTERED_TOOLS.get(name)
-    if not fn:
-        raise ValueError(f"Unknown tool: {name}")
-    return fn(**args)
+async def call_function(name: str, args: dict):
+    return await execute_tool(name, args)
 
 def tool_msg_beautify(tools: list[dict]):
     lines = []
@@ -56,7 +56,8 @@ async def website_evaluate(web_snippet, keywords, question):
         "additionalProperties": False
     },
     strict = True,
-    display_name = "🛜 web_search"
+    display_name = "🛜 web_search",
+    timeout = 60,
 )
 async def web_search(keywords, question):
     """
@@ -8,6 +8,7 @@ import time
 import random
 from openai import OpenAI
 from tools.decorator import tool
+from tools.executor import run_cancellable
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -25,12 +26,13 @@ openai = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
         "additionalProperties": False
         },
     strict = True,
-    display_name = "📺 Youtube Transcribe"
+    display_name = "📺 Youtube Transcribe",
+    timeout = 600,
 )
-def ytb_transcribe(url) -> str:
+def ytb_transcribe(url, cancel_event=None) -> str:
 
     check_yt_dlp()
-    update_yt_dlp()
+    update_yt_dlp(cancel_event)
 
     tmpdir_audio = None
     tmpdir_script = None
@@ -39,18 +41,20 @@ def ytb_transcribe(url) -> str:
         if not url:
             return "Didn't find valid YouTube urls."
         
-        download_script_task = download_youtube_subtitles(url)
+        download_script_task = download_youtube_subtitles(url, cancel_event)
         script_files, tmpdir_script = download_script_task
         print(f"Downloaded, transcription is saved at temprorary path: {tmpdir_script}")
         print(script_files, tmpdir_script)
 
         if(len(script_files) == 0):
-            download_task = download_youtube_audio(url)
+            download_task = download_youtube_audio(url, cancel_event)
             audio_files, tmpdir_audio = download_task
             print(f"Downloaded, audio is saved at temprorary path:: {tmpdir_audio}")
             print(audio_files, tmpdir_audio)
 
             for file_path in audio_files:
+                if cancel_event is not None and cancel_event.is_set():
+                    return "Cancelled."
                 print("Transcribing audio file:")
                 with open(file_path, "rb") as audio_file:
                     transcription = openai.audio.transcriptions.create(
@@ -82,22 +86,23 @@ def check_yt_dlp():
     except Exception:
         raise RuntimeError("Did not find yt-dlp, please install it first.\n")
 
-def update_yt_dlp():
-    p = subprocess.run(
+def update_yt_dlp(cancel_event=None):
+    p = run_cancellable(
         ["yt-dlp","-U"],
+        cancel_event,
         stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True
     )
     if p.returncode != 0:
         raise RuntimeError("Failed to update: yt-dlp \n" + p.stdout.strip())
     return p.stdout.strip()
 
-def download_youtube_audio(url):
+def download_youtube_audio(url, cancel_event=None):
 
     tmpdir = tempfile.mkdtemp(prefix="yt_dl_")
     outtpl = os.path.join(tmpdir, "%(title).15s.%(ext)s")
 
     cmd = ["yt-dlp", url, "-t", "mp3","-o", outtpl]
-    p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    p = run_cancellable(cmd, cancel_event, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
     if p.returncode:
         shutil.rmtree(tmpdir, ignore_errors=True)
         raise RuntimeError("Failed to Download\n" + p.stderr)
@@ -122,10 +127,11 @@ def srt_to_plain_text(filepath: str, joiner: str = " ") -> str:
             lines.append(line)
     return joiner.join(lines)
 
-def list_subs(url: str) -> Tuple[bool, str]:
+def list_subs(url: str, cancel_event=None) -> Tuple[bool, str]:
 
-    p = subprocess.run(
+    p = run_cancellable(
         ["yt-dlp", "--list-subs", url],
+        cancel_event,
         stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
     )
     if p.returncode != 0:
@@ -171,9 +177,10 @@ def list_subs(url: str) -> Tuple[bool, str]:
 
 def download_youtube_subtitles(
     url: str,
+    cancel_event=None,
 ) -> Tuple[str, str]:
 
-    is_manual_sub, sub = list_subs(url)
+    is_manual_sub, sub = list_subs(url, cancel_event)
     if is_manual_sub is None:
         return "", None
     print(f"Subtitles found: {sub}, is_manual_sub: {is_manual_sub}")
@@ -195,8 +202,9 @@ def download_youtube_subtitles(
     cmd += ["--convert-subs", "srt"]
 
     print(cmd)
-    p = subprocess.run(
+    p = run_cancellable(
         cmd,
+        cancel_event,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
         text=True
@@ -0,0 +1,106 @@
+"""
+Per-chat ordered turn queues drained by a bounded worker pool.
+
+Each chat has a FIFO of pending turns, so turns of one conversation run one
+after another and never race on its history. Chats with work wait in a ready
+ring; TURN_WORKERS workers take the chat at its head, run one turn and put
+the chat back at the tail if more turns are queued, so a burst from one user
+cannot starve the others and at most TURN_WORKERS turns (and OpenAI streams)
+run at once. Every turn runs as its own task, so cancelling it leaves the
+worker alive.
+"""
+import os
+import time
+import asyncio
+from collections import deque
+import metrics
+
+TURN_WORKERS = int(os.environ.get("TURN_WORKERS", "4"))
+
+class TurnScheduler:
+
+    def __init__(self, handler, workers: int = TURN_WORKERS):
+        self.handler = handler
+        self.workers = workers
+        self._queues: dict = {}
+        self._running: set = set()
+        self._scheduled: set = set()      # chats currently in the ready ring
+        self._ready = None
+        self._busy = 0
+
+    def _start(self):
+        # Created lazily so everything binds to the loop that serves events
+        self._ready = asyncio.Queue()
+        for i in range(self.workers):
+            asyncio.create_task(self._worker(), name=f"turn-worker-{i}")
+
+    def submit(self, chat_key, *args) -> int:
+        """
+        Queue `handler(*args)` behind the chat's earlier turns.
+        Returns how many turns or chats are ahead of it (0 when it starts right away).
+        """
+        if self._ready is None:
+            self._start()
+        queue = self._queues.setdefault(chat_key, deque())
+        ahead = len(queue) + (chat_key in self._running)
+        queue.append((time.time(), args))
+        if chat_key not in self._running and chat_key not in self._scheduled:
+            # Chat had no work: it joins the ready ring
+            self._scheduled.add(chat_key)
+            self._ready.put_nowait(chat_key)
+        if ahead == 0:
+            # Waits for a worker if more chats are ready than workers are idle
+            ahead = max(0, self._ready.qsize() - (self.workers - self._busy))
+        self._report()
+        return ahead
+
+    def drop(self, chat_key) -> list:
+        """Discard the chat's queued (not yet running) turns. Returns their handler arguments."""
+        queue = self._queues.get(chat_key)
+        dropped = [args for _, args in queue] if queue else []
+        if queue:
+            # The chat may still sit in the ready ring; workers skip it when empty
+            queue.clear()
+            metrics.incr("turn_queue.dropped", len(dropped))
+        self._report()
+        return dropped
+
+    def depth(self, chat_key=None) -> int:
+        if chat_key is not None:
+            return len(self._queues.get(chat_key, ()))
+        return sum(len(q) for q in self._queues.values())
+
+    def _report(self):
+        metrics.gauge("turn_queue.depth", self.depth())
+        metrics.gauge("turn_queue.waiting_chats", sum(1 for q in self._queues.values() if q))
+        metrics.gauge("turn_queue.busy_workers", self._busy)
+
+    async def _worker(self):
+        while True:
+            chat_key = await self._ready.get()
+            self._scheduled.discard(chat_key)
+            queue = self._queues.get(chat_key)
+            if not queue:
+                self._queues.pop(chat_key, None)
+                continue
+            queued_at, args = queue.popleft()
+            metrics.observe("turn_queue.wait", time.time() - queued_at)
+            self._running.add(chat_key)
+            self._busy += 1
+            self._report()
+            try:
+                task = asyncio.create_task(self.handler(*args))
+                # wait() does not raise when the turn is cancelled or fails
+                await asyncio.wait({task})
+                if not task.cancelled() and task.exception() is not None:
+                    print("Turn failed:", task.exception())
+            finally:
+                self._busy -= 1
+                self._running.discard(chat_key)
+                if queue:
+                    # Back to the tail: round-robin across chats
+                    self._scheduled.add(chat_key)
+                    self._ready.put_nowait(chat_key)
+                elif self._queues.get(chat_key) is queue:
+                    del self._queues[chat_key]
+                self._report()
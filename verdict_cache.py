@@ -0,0 +1,149 @@
+"""
+Cache of LLM relevance verdicts for history pairs.
+
+Keyed by (pair content hash, normalized query bucket). Hot entries live in an
+in-process LRU; evicted and new entries are spilled to
+`history/<user>/verdicts.json` so they survive restarts. A spill file is
+loaded on an LRU miss and only the last VERDICT_DISK_USERS of them stay
+resident; flush() writes a user's file and drops it from memory. Also
+memoizes the image-free text rendering of each pair that the judge prompt is
+built from.
+"""
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+import metrics
+from retrieval import tokenize
+
+VERDICT_CACHE_SIZE = 4096        # in-memory entries across all users
+VERDICT_DISK_LIMIT = 5000        # spilled entries kept per user
+VERDICT_DISK_USERS = 8           # spill files kept loaded (dirty ones stay until flushed)
+PAIR_TEXT_CACHE_SIZE = 2048
+
+_lock = threading.Lock()
+_memory: "OrderedDict[tuple, bool]" = OrderedDict()
+_disk: "OrderedDict[str, dict]" = OrderedDict()    # user -> {"pair|bucket": verdict}
+_dirty: set = set()
+_pair_texts: "OrderedDict[str, str]" = OrderedDict()
+
+def _spill_path(user_id) -> str:
+    return f"history/{user_id}/verdicts.json"
+
+def _jsonable(record):
+    # History views (hist.HistoryRecord) hash as their cleaned message
+    return record.as_dict() if hasattr(record, "as_dict") else str(record)
+
+def pair_hash(record_pair: list) -> str:
+    raw = json.dumps(record_pair, sort_keys=True, ensure_ascii=False, default=_jsonable)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+def query_bucket(query: str) -> str:
+    """Order- and punctuation-insensitive bucket, so rephrased repeats share verdicts."""
+    terms = " ".join(sorted(set(tokenize(query))))
+    return hashlib.sha1(terms.encode("utf-8")).hexdigest()[:16]
+
+def pair_text(record_pair: list, render) -> tuple[str, str]:
+    """Return (pair_hash, text), rendering with `render(record_pair)` only on a miss."""
+    key = pair_hash(record_pair)
+    with _lock:
+        text = _pair_texts.get(key)
+        if text is not None:
+            _pair_texts.move_to_end(key)
+            return key, text
+    text = render(record_pair)
+    with _lock:
+        _pair_texts[key] = text
+        while len(_pair_texts) > PAIR_TEXT_CACHE_SIZE:
+            _pair_texts.popitem(last=False)
+    return key, text
+
+def _load_disk(user_id) -> dict:
+    user = str(user_id)
+    if user in _disk:
+        _disk.move_to_end(user)
+        return _disk[user]
+    entries = {}
+    path = _spill_path(user)
+    if os.path.exists(path):
+        try:
+            with open(path) as f:
+                entries = json.load(f)
+        except Exception:
+            entries = {}
+    _disk[user] = entries
+    # Unflushed spills are kept; they are dropped by flush()
+    for other in [u for u in _disk if u not in _dirty and u != user][:max(0, len(_disk) - VERDICT_DISK_USERS)]:
+        del _disk[other]
+    return entries
+
+def get(user_id, key: str, bucket: str):
+    """Return the cached verdict or None."""
+    mem_key = (str(user_id), key, bucket)
+    with _lock:
+        if mem_key in _memory:
+            _memory.move_to_end(mem_key)
+            metrics.incr("verdict_cache.hit")
+            return _memory[mem_key]
+        verdict = _load_disk(user_id).get(f"{key}|{bucket}")
+        if verdict is not None:
+            _memory[mem_key] = verdict
+            _evict()
+            metrics.incr("verdict_cache.hit")
+            metrics.incr("verdict_cache.disk_hit")
+            return verdict
+    metrics.incr("verdict_cache.miss")
+    return None
+
+def put(user_id, key: str, bucket: str, verdict: bool):
+    with _lock:
+        _memory[(str(user_id), key, bucket)] = verdict
+        _evict()
+        disk = _load_disk(user_id)
+        disk[f"{key}|{bucket}"] = verdict
+        while len(disk) > VERDICT_DISK_LIMIT:
+            disk.pop(next(iter(disk)))
+        _dirty.add(str(user_id))
+
+def _evict():
+    while len(_memory) > VERDICT_CACHE_SIZE:
+        _memory.popitem(last=False)
+        metrics.incr("verdict_cache.evicted")
+
+def flush(user_id):
+    """Write the user's spill file if it changed."""
+    user = str(user_id)
+    with _lock:
+        if user not in _dirty:
+            return
+        _dirty.discard(user)
+        entries = dict(_disk.get(user, {}))
+    path = _spill_path(user)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        print(f"⚠️ Failed to spill verdict cache ({str(e)})")
+        with _lock:
+            _dirty.add(user)
+        return
+    with _lock:
+        # The file has everything; reloaded on the next LRU miss
+        if user not in _dirty:
+            _disk.pop(user, None)
+
+def stats() -> dict:
+    snapshot = metrics.snapshot()["counters"]
+    return {
+        "hits": snapshot.get("verdict_cache.hit", 0),
+        "misses": snapshot.get("verdict_cache.miss", 0),
+        "disk_hits": snapshot.get("verdict_cache.disk_hit", 0),
+        "evicted": snapshot.get("verdict_cache.evicted", 0),
+        "hit_ratio": metrics.ratio("verdict_cache.hit", "verdict_cache.miss"),
+        "resident": len(_memory),
+        "spills_loaded": len(_disk),
+    }
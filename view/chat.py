@@ -1,43 +1,32 @@
 import streamlit as st
 import asyncio
 import time
-import json
 from llm import llm
-from hist import read_history, write_history, encode_image, update_profile
+from hist import read_history, write_history, clear_history
+import image_store
+import image_prep
+from history_format import assistant_message, display_text
+from profile_jobs import schedule_profile_update
+from compaction import schedule_compaction
 from tools.tools_description import tool_msg_beautify
 import sys
-from io import BytesIO
-import os
-from PIL import Image
-
-CHAT_FILE = "chat_list.json"
-
-def check_path(user_id:str):
-    if not os.path.exists(f"history/{user_id}"):
-        os.makedirs(f"history/{user_id}")
+from storage import get_storage
 
 def read_chat_list(user_id:str):
-    check_path(user_id)
-    if not os.path.exists(f"history/{user_id}/{CHAT_FILE}"):
-        with open(f"history/{user_id}/{CHAT_FILE}", 'w') as file:
-            json.dump(["default"], file)
-    with open(f"history/{user_id}/{CHAT_FILE}", 'r') as file:
-        return json.load(file)
+    return get_storage().read_chat_list(user_id)
 
 def write_chat_list(user_id:str, chat_list):
-    with open(f"history/{user_id}/{CHAT_FILE}", 'w') as file:
-        json.dump(chat_list, file, indent=4)
+    get_storage().write_chat_list(user_id, chat_list)
 
 def delete_chat(user_id:str, chat_name):
-    with open(f"history/{user_id}/{CHAT_FILE}", 'r') as file:
-        chat_list = json.load(file)
-        i = chat_list.index(chat_name)
-        chat_list.pop(i)
-        if(len(chat_list)==0):
-            write_chat_list(user_id, ["default"])
-        else:
-            write_chat_list(user_id, chat_list)
-        os.remove(f"history/{user_id}/hist_{chat_name}.json")
+    chat_list = read_chat_list(user_id)
+    i = chat_list.index(chat_name)
+    chat_list.pop(i)
+    if(len(chat_list)==0):
+        write_chat_list(user_id, ["default"])
+    else:
+        write_chat_list(user_id, chat_list)
+    clear_history(user_id, chat_name)
 
 async def main() -> int:    
     
@@ -112,7 +101,7 @@ async def main() -> int:
                                 st.markdown(item["text"])
                         if item["type"] == "input_image":
                             with st.chat_message("user"):
-                                st.image(item["image_url"])
+                                st.image(image_store.local_path(item["image_url"]))
                 elif message["role"] == "system":
                     continue
                 elif message["role"] == "user":
@@ -120,7 +109,7 @@ async def main() -> int:
                         st.markdown(message["content"])
                 else:
                     with st.chat_message("AI"):
-                        st.markdown(message["content"])
+                        st.markdown(display_text(message))
                 
             # New　Message
             if user_input is not None:
@@ -131,23 +120,20 @@ async def main() -> int:
                     print("---")
                     placeholder_user.markdown(user_input.text)
                     photo = None
+                    detail = "auto"
                     # if input has photo          
                     if user_input["files"]:
                         bytes_data = user_input["files"][0].read()
-                        img = Image.open(BytesIO(bytes_data))
-                        if not os.path.exists(st.session_state.active_chat):
-                            os.mkdir(st.session_state.active_chat)
-                        new_file_name = user_input["files"][0].name + '.png'
-                        new_file_name = f'{st.session_state.name}/{st.session_state.active_chat}/{new_file_name}'
-                        img.save(new_file_name, 'PNG')
-                        photo = encode_image(new_file_name)
-                        st.image(new_file_name) 
+                        image_bytes, detail = await image_prep.prepare(bytes_data)
+                        photo = image_store.put_bytes(image_bytes)
+                        st.image(image_store.local_path(photo))
                         hist_user_message = {
                             "role": "user",
                             "content": [
                                 {"type": "input_text", "text": user_input.text},
                                 {"type": "input_image",
-                                "image_url": new_file_name,
+                                "image_url": photo,
+                                "detail": detail,
                                 },
                             ],
                         }
@@ -166,10 +152,11 @@ async def main() -> int:
                     # 2. initial two buffer
                     reasoning_msg = "### 🧠 Reasoning\n"
                     output_msg    = "### 💬 Output\n"
+                    answer        = ""
 
                     # 3. obtain streaming response
                     start = time.time()
-                    stream, tools = await llm(user_input.text, st.session_state.name, st.session_state.chat_history, photo)
+                    stream, tools = await llm(user_input.text, st.session_state.name, st.session_state.chat_history, photo, chat_id=st.session_state.active_chat, photo_detail=detail)
                     print("---")
                     print(f"Starting Response takes {time.time() - start}s")
                     print("---")
@@ -186,6 +173,7 @@ async def main() -> int:
                             )
                         elif event.type == "response.output_text.delta":
                             output_msg += delta
+                            answer += delta
                             placeholder_output.markdown(
                                 output_msg
                             )
@@ -205,16 +193,14 @@ async def main() -> int:
 
                 st.session_state.chat_history.extend([
                     hist_user_message,
-                    {
-                        "role": "assistant",
-                        "content": history_content
-                    }
+                    assistant_message(answer, display=history_content),
                 ])
 
-                write_history(st.session_state.name, st.session_state.active_chat, st.session_state.chat_history)
+                await asyncio.to_thread(write_history, st.session_state.name, st.session_state.active_chat, st.session_state.chat_history)
 
-                # Update user profile after saving complete conversation
-                await update_profile(st.session_state.name, st.session_state.chat_history)
+                # Merge this turn into the user profile and fold old messages into the chat summary in the background
+                schedule_profile_update(st.session_state.name, st.session_state.chat_history[-2:])
+                schedule_compaction(st.session_state.name, st.session_state.active_chat)
 
 if __name__ == "__main__":
     sys.exit(asyncio.run(main()))